@@ -449,7 +449,9 @@ class MayanEventEnrichmentConfig(MayanAppConfig):
                     'mayan_event_enrichment: patched_list failed, falling back to original: %s', e
                 )
                 return _original_list(self_view, request, *args, **kwargs)
-        APIEventListView.list = patched_list
+        # Opt-in profiling (see profiling.py); patched_list itself when it is off
+        from mayan_event_enrichment.profiling import profiled
+        APIEventListView.list = profiled(patched_list, 'events-list')
 
     def _connect_save_target_before_delete(self):
         """Connect signals to capture document metadata when a document record is about to be deleted."""
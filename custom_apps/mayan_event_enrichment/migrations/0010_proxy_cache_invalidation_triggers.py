@@ -0,0 +1,74 @@
+"""
+Migration: NOTIFY the enrichment proxy when its cached lookup tables change.
+
+mayan_proxy.py caches document type labels, document -> document type and
+event -> deleted document lookups, and LISTENs on the `mayan_proxy_invalidate`
+channel. These statement-level triggers send the changed table name as the
+payload so the proxy can drop the matching cache.
+
+Idempotent: triggers are only created on tables that exist.
+"""
+
+from django.db import migrations
+
+
+TRIGGERS = (
+    # (trigger name, table, events)
+    ('mayan_proxy_notify_deletedinfo', 'mayan_event_enrichment_trasheddocumentdeletedinfo', 'INSERT OR UPDATE OR DELETE OR TRUNCATE'),
+    ('mayan_proxy_notify_documenttype', 'documents_documenttype', 'INSERT OR UPDATE OR DELETE OR TRUNCATE'),
+    ('mayan_proxy_notify_document', 'documents_document', 'INSERT OR UPDATE OF document_type_id OR DELETE OR TRUNCATE'),
+)
+
+CREATE_FUNCTION_SQL = """
+    CREATE OR REPLACE FUNCTION mayan_proxy_notify_invalidate() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('mayan_proxy_invalidate', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+
+def _create_trigger_sql(name, table, events):
+    return f"""
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = '{table}') THEN
+                DROP TRIGGER IF EXISTS {name} ON {table};
+                CREATE TRIGGER {name}
+                    AFTER {events} ON {table}
+                    FOR EACH STATEMENT EXECUTE FUNCTION mayan_proxy_notify_invalidate();
+            END IF;
+        END $$;
+    """
+
+
+def _drop_trigger_sql(name, table, events):
+    return f"""
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = '{table}') THEN
+                DROP TRIGGER IF EXISTS {name} ON {table};
+            END IF;
+        END $$;
+    """
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mayan_event_enrichment', '0009_rename_app_to_mayan_event_enrichment'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=CREATE_FUNCTION_SQL,
+            reverse_sql="DROP FUNCTION IF EXISTS mayan_proxy_notify_invalidate();",
+        ),
+    ] + [
+        migrations.RunSQL(
+            sql=_create_trigger_sql(*trigger),
+            reverse_sql=_drop_trigger_sql(*trigger),
+        )
+        for trigger in TRIGGERS
+    ]
@@ -0,0 +1,41 @@
+"""
+Migration: NOTIFY the enrichment proxy when the events list changes.
+
+mayan_proxy.py caches enriched /api/v4/events/ pages and drops them on any
+notification on `mayan_proxy_invalidate`. New, changed or deleted actions and
+the DeletedCabinetEvent rows merged into the list must therefore notify too.
+Reuses mayan_proxy_notify_invalidate() and the trigger SQL from migration 0010.
+
+Idempotent: triggers are only created on tables that exist.
+"""
+
+import importlib
+
+from django.db import migrations
+
+# Migration modules start with a digit, so they cannot be named in an import statement
+_triggers_0010 = importlib.import_module('.0010_proxy_cache_invalidation_triggers', __package__)
+_create_trigger_sql = _triggers_0010._create_trigger_sql
+_drop_trigger_sql = _triggers_0010._drop_trigger_sql
+
+
+TRIGGERS = (
+    # (trigger name, table, events)
+    ('mayan_proxy_notify_action', 'actstream_action', 'INSERT OR UPDATE OR DELETE OR TRUNCATE'),
+    ('mayan_proxy_notify_deletedcabinetevent', 'mayan_event_enrichment_deletedcabinetevent', 'INSERT OR UPDATE OR DELETE OR TRUNCATE'),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mayan_event_enrichment', '0010_proxy_cache_invalidation_triggers'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=_create_trigger_sql(*trigger),
+            reverse_sql=_drop_trigger_sql(*trigger),
+        )
+        for trigger in TRIGGERS
+    ]
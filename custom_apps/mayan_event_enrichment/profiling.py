@@ -0,0 +1,85 @@
+"""
+Opt-in cProfile profiling for the patched events list view.
+
+Configured through the environment of the Mayan app container:
+
+    MAYAN_EVENT_ENRICHMENT_PROFILE_EVERY     profile 1 in N list calls (0: off)
+    MAYAN_EVENT_ENRICHMENT_PROFILE_TOKEN     also profile calls whose X-Mayan-Profile header
+                                             carries this token (the proxy sends its
+                                             PROFILE_UPSTREAM_TOKEN on the requests it profiles)
+    MAYAN_EVENT_ENRICHMENT_PROFILE_DIR       where the pstats files are written
+    MAYAN_EVENT_ENRICHMENT_PROFILE_KEEP      newest profiles kept in the directory
+
+With neither EVERY nor TOKEN set the view is left unwrapped. Sampled stacks
+("collapsed" profiles) are the proxy's business: this side only writes
+cProfile dumps, named like the proxy's so the two sort together.
+"""
+import cProfile
+import functools
+import hmac
+import itertools
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PROFILE_EVERY = int(os.environ.get('MAYAN_EVENT_ENRICHMENT_PROFILE_EVERY', 0) or 0)
+PROFILE_TOKEN = os.environ.get('MAYAN_EVENT_ENRICHMENT_PROFILE_TOKEN', '')
+PROFILE_DIR = os.environ.get(
+    'MAYAN_EVENT_ENRICHMENT_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'mayan-event-enrichment-profiles')
+)
+PROFILE_KEEP = int(os.environ.get('MAYAN_EVENT_ENRICHMENT_PROFILE_KEEP', 100))
+
+
+def profiled(view_method, name):
+    """
+    Wrap a view method (self, request, ...) so that 1 in PROFILE_EVERY calls,
+    and those the proxy asks for, run under cProfile, one at a time; returned
+    unchanged while profiling is not configured.
+    """
+    if not (PROFILE_EVERY or PROFILE_TOKEN):
+        return view_method
+    logger.info(
+        'mayan_event_enrichment: profiling %s (1 in %s calls) into %s', name, PROFILE_EVERY or 'no', PROFILE_DIR
+    )
+    token = PROFILE_TOKEN.encode('utf-8')
+    counter = itertools.count(1)
+    busy = threading.Lock()
+
+    @functools.wraps(view_method)
+    def wrapper(self_view, request, *args, **kwargs):
+        header = request.headers.get('X-Mayan-Profile', '').encode('utf-8', 'surrogateescape')
+        requested = bool(token and header) and hmac.compare_digest(header, token)
+        sampled = PROFILE_EVERY and next(counter) % PROFILE_EVERY == 0
+        if not (sampled or requested) or not busy.acquire(blocking=False):
+            return view_method(self_view, request, *args, **kwargs)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(view_method, self_view, request, *args, **kwargs)
+        finally:
+            busy.release()
+            request_id = request.headers.get('X-Request-ID', '')[:64]
+            _dump(profiler, f"{name}-{request_id}" if request_id else name)
+
+    return wrapper
+
+
+def _dump(profiler, label):
+    """Write one profile into PROFILE_DIR, then delete all but the newest PROFILE_KEEP."""
+    now = time.time()
+    # Sortable by name, which is how the oldest are found
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(now)) + f".{int(now % 1 * 1000):03d}"
+    label = re.sub(r'[^A-Za-z0-9._-]+', '_', label)
+    path = os.path.join(PROFILE_DIR, f"profile-{stamp}-{os.getpid()}-{label}.pstats")
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(path)
+        names = sorted(name for name in os.listdir(PROFILE_DIR) if name.startswith('profile-'))
+        for name in names[:max(0, len(names) - PROFILE_KEEP)]:
+            os.unlink(os.path.join(PROFILE_DIR, name))
+    except OSError as e:
+        logger.warning('mayan_event_enrichment: could not write profile %s: %s', path, e)
@@ -1,12 +1,66 @@
+import asyncio
+import atexit
+import base64
+import bisect
+import codecs
+import cProfile
+import email.utils
+import fcntl
+import functools
+import hashlib
+import hmac
 import http.server
+import io
+import ipaddress
+import itertools
+import math
+import queue
+import random
+import re
+import select
+import selectors
+import signal
+import socket
 import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
 import requests
 import json
 import logging
+import logging.handlers
 import sys
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import urllib3.exceptions
 
 import os
 
+try:
+    import brotli
+except ImportError:
+    # Optional: without it enriched pages are only offered gzip-compressed
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    # Optional: without it events pages are parsed and serialized by the json module
+    orjson = None
+
+
+def _env_bool(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 # Configuration
 PORT = int(os.environ.get("PROXY_PORT", 8075))
 TARGET_URL = os.environ.get("TARGET_URL", "http://mayan-app:8000")
@@ -16,104 +70,3111 @@ DB_PORT = int(os.environ.get("DB_PORT", 5432))
 DB_NAME = os.environ.get("DB_NAME", "mayan")
 DB_USER = os.environ.get("DB_USER", "postgres")
 DB_PASSWORD = os.environ.get("DB_PASSWORD", "")
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", 5))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.environ.get("DB_POOL_HEALTHCHECK_INTERVAL", 30))
+# Lookup time limits: each query is capped at DB_STATEMENT_TIMEOUT_MS and all lookups of
+# one request share ENRICH_DEADLINE seconds (0 disables either). After DB_BREAKER_THRESHOLD
+# consecutive DB failures lookups stop for DB_BREAKER_COOLDOWN seconds and pages are
+# served unenriched with an X-Mayan-Degraded header.
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 250))
+ENRICH_DEADLINE = float(os.environ.get("ENRICH_DEADLINE", 0.5))
+DB_BREAKER_THRESHOLD = int(os.environ.get("DB_BREAKER_THRESHOLD", 5))
+DB_BREAKER_COOLDOWN = float(os.environ.get("DB_BREAKER_COOLDOWN", 10))
+# In-process lookup cache; entries are dropped on NOTIFY from the triggers installed by
+# mayan_event_enrichment migration 0010 (channel name must match)
+LOOKUP_CACHE_SIZE = int(os.environ.get("LOOKUP_CACHE_SIZE", 10000))
+LOOKUP_CACHE_TTL = float(os.environ.get("LOOKUP_CACHE_TTL", 600))
+LOOKUP_CACHE_NEGATIVE_TTL = float(os.environ.get("LOOKUP_CACHE_NEGATIVE_TTL", 30))
+DB_NOTIFY_CHANNEL = os.environ.get("DB_NOTIFY_CHANNEL", "mayan_proxy_invalidate")
+# Enriched events pages, per path/query/auth identity/Accept; any NOTIFY (e.g. a new event)
+# drops them. Only application/json pages that Vary on nothing outside that key are kept
+EVENTS_CACHE_TTL = float(os.environ.get("EVENTS_CACHE_TTL", 10))
+EVENTS_CACHE_SIZE = int(os.environ.get("EVENTS_CACHE_SIZE", 1000))
+EVENTS_CACHE_MAX_BODY = int(os.environ.get("EVENTS_CACHE_MAX_BODY", 2 * 1024 * 1024))
+# Identical events GETs (same page cache key) arriving while one is in flight wait up to
+# COALESCE_WAIT seconds for its enriched page instead of fetching their own. Pages over
+# COALESCE_MAX_BODY, non-200 or non-JSON responses and pages that Vary on headers outside
+# the key are not shared; waiters then fetch themselves
+COALESCE_REQUESTS = _env_bool("COALESCE_REQUESTS", True)
+COALESCE_MAX_BODY = int(os.environ.get("COALESCE_MAX_BODY", EVENTS_CACHE_MAX_BODY))
+COALESCE_WAIT = float(os.environ.get("COALESCE_WAIT", 30))
+# Concurrency engine: "threaded" (bounded worker pool; one selector thread waits on idle
+# connections) or "asyncio" (the event loop waits on idle connections and reads request
+# heads; the pool serves requests). Either way PROXY_WORKERS bounds requests being served
+PROXY_MODE = os.environ.get("PROXY_MODE", "threaded").lower()
+PROXY_WORKERS = int(os.environ.get("PROXY_WORKERS", 32))
+PROXY_MAX_CONNECTIONS = int(os.environ.get("PROXY_MAX_CONNECTIONS", 256))
+PROXY_LISTEN_BACKLOG = int(os.environ.get("PROXY_LISTEN_BACKLOG", 128))
+# Prefork: worker processes sharing the port via SO_REUSEPORT (0 = one per CPU).
+# On SIGTERM in-flight requests get PROXY_DRAIN_TIMEOUT seconds to finish; keep it
+# under the container stop grace period (10s for docker by default)
+PROXY_PROCESSES = int(os.environ.get("PROXY_PROCESSES", 1)) or os.cpu_count() or 1
+PROXY_DRAIN_TIMEOUT = float(os.environ.get("PROXY_DRAIN_TIMEOUT", 8))
+# Upstream connection pool (keep-alive to Mayan) and client keep-alive
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", PROXY_WORKERS))
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", 2))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 5))
+# Mayan replicas to balance across (least outstanding requests); defaults to TARGET_URL alone.
+# With several, each is probed every UPSTREAM_HEALTH_INTERVAL seconds (0 = never) and taken
+# out of rotation after UPSTREAM_HEALTH_FAILURES failed probes or a failed connect. A request
+# whose connect fails is tried on up to UPSTREAM_FAILOVER_ATTEMPTS other replicas, for
+# UPSTREAM_FAILOVER_METHODS "all" (nothing was sent yet) or only "idempotent" ones.
+UPSTREAM_URLS = [url.strip().rstrip('/') for url in os.environ.get("UPSTREAM_URLS", TARGET_URL).split(",") if url.strip()]
+UPSTREAM_HEALTH_PATH = os.environ.get("UPSTREAM_HEALTH_PATH", "/")
+UPSTREAM_HEALTH_INTERVAL = float(os.environ.get("UPSTREAM_HEALTH_INTERVAL", 5))
+UPSTREAM_HEALTH_TIMEOUT = float(os.environ.get("UPSTREAM_HEALTH_TIMEOUT", 2))
+UPSTREAM_HEALTH_FAILURES = int(os.environ.get("UPSTREAM_HEALTH_FAILURES", 2))
+UPSTREAM_FAILOVER_ATTEMPTS = int(os.environ.get("UPSTREAM_FAILOVER_ATTEMPTS", 1))
+UPSTREAM_FAILOVER_METHODS = os.environ.get("UPSTREAM_FAILOVER_METHODS", "all").lower()
+# Client keep-alive: connections waiting for their next request hold no worker (one selector
+# watches them) and are closed after CLIENT_IDLE_TIMEOUT seconds, or earlier when
+# PROXY_MAX_CONNECTIONS is reached and a new client needs the slot. Once a request has
+# started, each read from or write to the client may block for CLIENT_IO_TIMEOUT seconds
+CLIENT_IDLE_TIMEOUT = float(os.environ.get("CLIENT_IDLE_TIMEOUT", 30))
+CLIENT_IO_TIMEOUT = float(os.environ.get("CLIENT_IO_TIMEOUT", 30))
+# Opt-in disk cache for document file downloads and page images (set DOWNLOAD_CACHE_DIR).
+# Bodies with an ETag or Last-Modified are kept up to DOWNLOAD_CACHE_MAX_BYTES in total across
+# the PROXY_PROCESSES sharing the directory (least recently used go first) and
+# DOWNLOAD_CACHE_MAX_ENTRY each. Every hit is still
+# revalidated with Mayan using the client's credentials, so permissions keep applying; only
+# the body then comes from disk (sendfile, with Range support). Requests for a key being
+# filled wait up to DOWNLOAD_CACHE_FILL_WAIT seconds for it instead of downloading it too
+DOWNLOAD_CACHE_DIR = os.environ.get("DOWNLOAD_CACHE_DIR", "")
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get("DOWNLOAD_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+DOWNLOAD_CACHE_MAX_ENTRY = int(os.environ.get("DOWNLOAD_CACHE_MAX_ENTRY", 256 * 1024 * 1024))
+DOWNLOAD_CACHE_FILL_WAIT = float(os.environ.get("DOWNLOAD_CACHE_FILL_WAIT", 60))
+# Admission control in front of Mayan's (sync) gunicorn workers, per route class: at most
+# ADMIT_<CLASS>_CONCURRENCY requests are in flight upstream and ADMIT_<CLASS>_QUEUE more wait
+# their turn, each for up to ADMIT_QUEUE_TIMEOUT seconds. Anything beyond that gets a 503 with
+# Retry-After: ADMIT_RETRY_AFTER right away. A concurrency of 0 (the default) disables the
+# limit for a class, so admission control is opt-in. Size the concurrencies to Mayan's
+# gunicorn worker count (MAYAN_GUNICORN_WORKERS) and the queues to the bursts clients make:
+# "download" also covers page images, which a document preview grid requests by the dozen.
+# Limits are per proxy process; waiting requests hold a worker, so keep the sums of
+# concurrency and queue below PROXY_WORKERS
+ADMIT_EVENTS_CONCURRENCY = int(os.environ.get("ADMIT_EVENTS_CONCURRENCY", 0))
+ADMIT_EVENTS_QUEUE = int(os.environ.get("ADMIT_EVENTS_QUEUE", 8))
+ADMIT_DOWNLOAD_CONCURRENCY = int(os.environ.get("ADMIT_DOWNLOAD_CONCURRENCY", 0))
+ADMIT_DOWNLOAD_QUEUE = int(os.environ.get("ADMIT_DOWNLOAD_QUEUE", 4))
+ADMIT_OTHER_CONCURRENCY = int(os.environ.get("ADMIT_OTHER_CONCURRENCY", 0))
+ADMIT_OTHER_QUEUE = int(os.environ.get("ADMIT_OTHER_QUEUE", 8))
+ADMIT_QUEUE_TIMEOUT = float(os.environ.get("ADMIT_QUEUE_TIMEOUT", 10))
+ADMIT_RETRY_AFTER = int(os.environ.get("ADMIT_RETRY_AFTER", 2))
+# Live feed of new events at /__proxy/events/feed: server-sent events, or a long poll for
+# clients not asking for text/event-stream. One poller per auth scope reads up to
+# FEED_MAX_PAGES pages of FEED_PAGE_SIZE events every FEED_POLL_INTERVAL seconds while anyone
+# listens (and FEED_IDLE_TIMEOUT seconds after), keeping the last FEED_HISTORY events for
+# Last-Event-ID resume. A subscriber FEED_SUBSCRIBER_BUFFER events behind is disconnected and
+# resumes from the history on reconnect. Each subscriber holds a worker: at most
+# FEED_MAX_SUBSCRIBERS at once
+FEED_POLL_INTERVAL = float(os.environ.get("FEED_POLL_INTERVAL", 2))
+FEED_PAGE_SIZE = int(os.environ.get("FEED_PAGE_SIZE", 100))
+FEED_MAX_PAGES = int(os.environ.get("FEED_MAX_PAGES", 5))
+FEED_HISTORY = int(os.environ.get("FEED_HISTORY", 1000))
+FEED_SUBSCRIBER_BUFFER = int(os.environ.get("FEED_SUBSCRIBER_BUFFER", 256))
+FEED_MAX_SUBSCRIBERS = int(os.environ.get("FEED_MAX_SUBSCRIBERS", max(1, PROXY_WORKERS // 2)))
+FEED_IDLE_TIMEOUT = float(os.environ.get("FEED_IDLE_TIMEOUT", 60))
+FEED_HEARTBEAT = float(os.environ.get("FEED_HEARTBEAT", 15))
+FEED_LONG_POLL_TIMEOUT = float(os.environ.get("FEED_LONG_POLL_TIMEOUT", 25))
+# Request bodies are forwarded in chunks of this size; chunked uploads are spooled
+# (in memory up to UPLOAD_SPOOL_MAX_MEMORY, then on disk) to learn their length
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 64 * 1024))
+UPLOAD_SPOOL_MAX_MEMORY = int(os.environ.get("UPLOAD_SPOOL_MAX_MEMORY", 1024 * 1024))
+# Streaming rewrite of events pages: enrich `results` in batches as they arrive
+STREAM_REWRITE = _env_bool("STREAM_REWRITE")
+STREAM_REWRITE_BATCH = int(os.environ.get("STREAM_REWRITE_BATCH", 50))
+# Enriched events pages are compressed for clients that accept it (br if available, else gzip);
+# passthrough responses keep Mayan's own encoding byte-for-byte
+COMPRESS_ENRICHED = _env_bool("COMPRESS_ENRICHED", True)
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 5))
+# JSON codec for events pages: "auto" (orjson when installed) or "stdlib". Both read the same
+# values and write them as the same compact UTF-8 bytes (floats aside, see OrjsonCodec)
+JSON_BACKEND = os.environ.get("JSON_BACKEND", "auto").lower()
+# Logging: "text" or "json" lines. Records are written by a background thread; routine
+# access lines (PASS, PROXY, CACHED, COALESCED, NOT MODIFIED) are kept with probability
+# LOG_SAMPLE_RATE, while errors and requests slower than LOG_SLOW_REQUEST seconds always are.
+# When more than LOG_QUEUE_SIZE records are waiting, new info/debug ones are dropped and
+# warnings/errors are written synchronously
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1))
+LOG_SLOW_REQUEST = float(os.environ.get("LOG_SLOW_REQUEST", 1))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# Slow requests also get their full timing breakdown appended, one JSON object per line, to
+# SLOW_REQUEST_LOG (when set; reopened after logrotate moves it)
+SLOW_REQUEST_LOG = os.environ.get("SLOW_REQUEST_LOG", "")
+# Request id header: taken from the client when well-formed (else generated), sent to Mayan
+# and returned with the response next to its Server-Timing breakdown
+REQUEST_ID_HEADER = os.environ.get("REQUEST_ID_HEADER", "X-Request-ID")
+# /__proxy/stats and /__proxy/metrics (which show backend URLs and file paths) only answer
+# clients from PROXY_ADMIN_ALLOW (comma-separated addresses or networks; loopback by default)
+# or sending the header X-Proxy-Admin-Token: <PROXY_ADMIN_TOKEN>; others get 403. The same
+# token guards /__proxy/profile (PROFILE_ADMIN_TOKEN is read when PROXY_ADMIN_TOKEN is unset)
+PROXY_ADMIN_ALLOW = [
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.environ.get("PROXY_ADMIN_ALLOW", "127.0.0.0/8,::1").split(",") if network.strip()
+]
+PROXY_ADMIN_TOKEN = os.environ.get("PROXY_ADMIN_TOKEN", "") or os.environ.get("PROFILE_ADMIN_TOKEN", "")
+# Traffic recording for mayan_proxy_replay.py: with RECORD_DIR set, every process writes the
+# requests it proxies (credentials pseudonymized, uploads reduced to their size) and Mayan's
+# responses (bodies up to RECORD_MAX_BODY; larger ones by size) to a JSON-lines file there,
+# until RECORD_MAX_BYTES are written. Bodies hold document metadata: treat files as DB dumps.
+# Exchanges beyond RECORD_QUEUE_SIZE, or RECORD_QUEUE_BYTES of bodies, waiting for the
+# writer are dropped (and counted)
+RECORD_DIR = os.environ.get("RECORD_DIR", "")
+RECORD_MAX_BODY = int(os.environ.get("RECORD_MAX_BODY", 4 * 1024 * 1024))
+RECORD_MAX_BYTES = int(os.environ.get("RECORD_MAX_BYTES", 512 * 1024 * 1024))
+RECORD_QUEUE_SIZE = int(os.environ.get("RECORD_QUEUE_SIZE", 1000))
+RECORD_QUEUE_BYTES = int(os.environ.get("RECORD_QUEUE_BYTES", 64 * 1024 * 1024))
+# Profiling: 1 in PROFILE_SAMPLE_EVERY proxied requests (0: off) is profiled, one at a time,
+# into PROFILE_DIR as cProfile "pstats" or sampled "collapsed" stacks; only the newest
+# PROFILE_KEEP files are kept. POST /__proxy/profile?every=N[&format=...] with the header
+# X-Proxy-Admin-Token: <PROXY_ADMIN_TOKEN> changes this at runtime (in the worker it reaches).
+# With PROFILE_UPSTREAM_TOKEN set, profiled requests carry it to Mayan as X-Mayan-Profile, so
+# the events app profiles them too when its MAYAN_EVENT_ENRICHMENT_PROFILE_TOKEN is the same.
+# Keep it distinct from the admin token: it travels to Mayan with every profiled request
+PROFILE_SAMPLE_EVERY = int(os.environ.get("PROFILE_SAMPLE_EVERY", 0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "mayan-proxy-profiles"))
+PROFILE_FORMAT = os.environ.get("PROFILE_FORMAT", "pstats").lower()
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 100))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+PROFILE_UPSTREAM_TOKEN = os.environ.get("PROFILE_UPSTREAM_TOKEN", "")
 TARGET_URLS = [
     TARGET_URL.rstrip('/'), 
     "http://mayan-app:8000", 
 ]
+# Each replica builds absolute URLs from the Host it was reached at, so those are rewritten too
+TARGET_URLS += [url for url in UPSTREAM_URLS if url not in TARGET_URLS]
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line; request lines also carry their access fields (latencies etc.)."""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".%03dZ" % record.msecs,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        access = getattr(record, "access", None)
+        if access:
+            entry.update(access)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Setup logging
+logger = logging.getLogger("MayanProxy")
+slow_logger = logging.getLogger("MayanProxy.slow")
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(
+    JsonLogFormatter() if LOG_FORMAT == "json" else logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+)
+# Slow-request breakdowns only go to their own file
+_log_handler.addFilter(lambda record: record.name != slow_logger.name)
+_log_handlers = [_log_handler]
+if SLOW_REQUEST_LOG:
+    _slow_log_handler = logging.handlers.WatchedFileHandler(SLOW_REQUEST_LOG)
+    _slow_log_handler.setFormatter(JsonLogFormatter())
+    _slow_log_handler.addFilter(lambda record: record.name == slow_logger.name)
+    _log_handlers.append(_slow_log_handler)
+logging.basicConfig(level=LOG_LEVEL, handlers=_log_handlers)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the log writer falls behind.
+
+    Only records below WARNING are dropped. Warnings and errors (slow requests
+    included) are then written synchronously by the thread that logged them.
+    """
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno < logging.WARNING:
+                _DroppingQueueHandler.dropped += 1
+                return
+            for handler in _log_handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+_log_listener = None
+
+
+def start_background_logging():
+    """Write log records from a listener thread so request threads only enqueue them."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    logging.getLogger().handlers = [_DroppingQueueHandler(log_queue)]
+    _log_listener = logging.handlers.QueueListener(log_queue, *_log_handlers, respect_handler_level=True)
+    _log_listener.start()
+
+
+def stop_background_logging():
+    """Flush the queued records and go back to writing synchronously."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+        logging.getLogger().handlers = list(_log_handlers)
+
+
+def _restart_background_logging():
+    # Only the forking thread survives fork(): a prefork worker needs its own listener
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener = None
+        start_background_logging()
+
+
+atexit.register(stop_background_logging)
+os.register_at_fork(after_in_child=_restart_background_logging)
+
+# Headers that describe a single connection and must not be forwarded (RFC 9110 7.6.1)
+HOP_BY_HOP_HEADERS = frozenset((
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade',
+))
+# Only these may be replayed against Mayan after a connection or read failure
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+
+# Access lines of these kinds are subject to LOG_SAMPLE_RATE
+SAMPLED_ACCESS_KINDS = frozenset(("PASS", "PROXY", "CACHED", "COALESCED", "NOT MODIFIED"))
+
+# Routes are grouped into a few classes for metrics (and admission control). "events" are
+# the routes the enrichers rewrite, matched the same way (see EnricherRegistry.plan_for)
+_DOWNLOAD_PATH_RE = re.compile(r"/files/\d+/download/|/pages/\d+/image/|/versions/\d+/export/")
+
+
+def _route_class(path):
+    if _enrichers.plan_for(path) is not None:
+        return "events"
+    if _DOWNLOAD_PATH_RE.search(path):
+        return "download"
+    return "other"
+
+
+class _Metric:
+    """Base for the in-process Prometheus metrics: one value per label tuple.
+
+    Updates take a per-metric lock and touch a dict entry, which keeps them
+    cheap enough for every request on the handler hot path.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def _labels(self, labelvalues):
+        if not self.labelnames:
+            return ""
+        pairs = ",".join(
+            '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in zip(self.labelnames, labelvalues)
+        )
+        return "{%s}" % pairs
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            items = list(self._values.items())
+        for labelvalues, value in sorted(items):
+            lines.extend(self._render_value(labelvalues, value))
+        return lines
+
+    def _render_value(self, labelvalues, value):
+        return [f"{self.name}{self._labels(labelvalues)} {value}"]
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def dec(self, amount=1, *labelvalues):
+        self.inc(-amount, *labelvalues)
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                # per-bucket counts (last one is +Inf), sum
+                state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def _render_value(self, labelvalues, value):
+        counts, total = value[0][:], value[1]
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self._bucket_labels(labelvalues, bound)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(labelvalues)} {total}")
+        lines.append(f"{self.name}_count{self._labels(labelvalues)} {cumulative}")
+        return lines
+
+    def _bucket_labels(self, labelvalues, bound):
+        le = 'le="%s"' % bound
+        labels = self._labels(labelvalues)
+        return "{%s,%s}" % (labels[1:-1], le) if labels else "{%s}" % le
+
+
+_METRICS = []
+_m_requests = Counter("mayan_proxy_requests_total", "Proxied requests by route class and status code.", ("route", "code"))
+_m_request_seconds = Histogram("mayan_proxy_request_duration_seconds", "Time to serve a proxied request.", ("route",))
+_m_in_flight = Gauge("mayan_proxy_requests_in_flight", "Requests currently being served.", ("route",))
+_m_upstream_ttfb = Histogram("mayan_proxy_upstream_ttfb_seconds", "Time until Mayan's response headers arrived.", ("route",))
+_m_enrichment_seconds = Histogram("mayan_proxy_enrichment_duration_seconds", "Time spent parsing, fixing and serializing events pages.", ("mode",))
+_m_db_query_seconds = Histogram("mayan_proxy_db_query_duration_seconds", "Enrichment lookup latency by prepared statement.", ("statement",))
+_m_bytes_in = Counter("mayan_proxy_request_body_bytes_total", "Request body bytes received from clients.", ("route",))
+_m_degraded = Counter("mayan_proxy_enrichment_degraded_total", "Events pages served not (fully) enriched, by reason.", ("reason",))
+_m_coalesced = Counter("mayan_proxy_coalesced_requests_total", "Events requests that waited on an identical in-flight request, by outcome.", ("outcome",))
+_m_admission_wait_seconds = Histogram("mayan_proxy_admission_wait_seconds", "Time admitted requests queued for an upstream slot.", ("route",))
+_m_admission_rejected = Counter("mayan_proxy_admission_rejected_total", "Requests answered 503 by admission control, by reason.", ("route", "reason"))
+_m_upstream_failovers = Counter("mayan_proxy_upstream_failovers_total", "Requests sent to another replica after a failed connect.")
+_m_bytes_out = Counter("mayan_proxy_response_bytes_total", "Response bytes (headers and body) sent to clients.", ("route",))
+
+
+_upstream_session = None
+_upstream_session_lock = threading.Lock()
+
+
+def _get_upstream_session():
+    """Return the process-wide pooled requests.Session used to reach Mayan."""
+    global _upstream_session
+    if _upstream_session is None:
+        with _upstream_session_lock:
+            if _upstream_session is None:
+                retry = Retry(
+                    total=UPSTREAM_RETRIES,
+                    # With replicas to fail over to, a refused connect moves on instead of retrying here
+                    connect=UPSTREAM_RETRIES if len(UPSTREAM_URLS) == 1 else 0,
+                    read=UPSTREAM_RETRIES,
+                    status=0,
+                    allowed_methods=IDEMPOTENT_METHODS,
+                    backoff_factor=0.05,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=UPSTREAM_POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _upstream_session = session
+    return _upstream_session
+
+
+def _upstream_request(method, url, **kwargs):
+    """Send a request to Mayan over the pooled session.
+
+    Pooled connections Mayan has closed while they sat idle are discarded by
+    urllib3 when taken from the pool, so they cost no retry.
+    """
+    kwargs.setdefault("timeout", (UPSTREAM_CONNECT_TIMEOUT, None))
+    return _get_upstream_session().request(method, url, **kwargs)
+
+
+def _is_connect_failure(error):
+    """True when a requests error means no connection was made, so nothing reached Mayan."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError) or not error.args:
+        return False
+    reason = getattr(error.args[0], "reason", error.args[0])
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+
+class UpstreamBackend:
+    """One Mayan replica and its load/health bookkeeping (guarded by the balancer's lock)."""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.healthy = True
+        self.failed_checks = 0
+        self.requests = 0
+        self.connect_failures = 0
+
+
+class UpstreamBalancer:
+    """Least-outstanding-requests choice among the healthy replicas.
+
+    Ties rotate so idle replicas share the load. When every replica is marked
+    down they are all used anyway: a stale health verdict must not turn into a
+    full outage.
+    """
+
+    def __init__(self, urls):
+        self.backends = [UpstreamBackend(url) for url in urls]
+        self.failovers = 0
+        self._rotation = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude=()):
+        """Pick a backend for one request; release() it when the response is done."""
+        with self._lock:
+            if len(self.backends) == 1:
+                backend = self.backends[0]
+            else:
+                candidates = [b for b in self.backends if b.healthy and b not in exclude]
+                candidates = candidates or [b for b in self.backends if b not in exclude] or self.backends
+                self._rotation = (self._rotation + 1) % len(candidates)
+                candidates = candidates[self._rotation:] + candidates[:self._rotation]
+                backend = min(candidates, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            backend.requests += 1
+        return backend
+
+    def release(self, backend):
+        with self._lock:
+            backend.outstanding -= 1
+
+    def connect_failed(self, backend):
+        with self._lock:
+            backend.connect_failures += 1
+            # Only the health checker can bring a replica back
+            if _upstream_health_checker.is_alive():
+                self._set_health(backend, False)
+
+    def check_result(self, backend, ok):
+        with self._lock:
+            if ok:
+                backend.failed_checks = 0
+                self._set_health(backend, True)
+            else:
+                backend.failed_checks += 1
+                if backend.failed_checks >= UPSTREAM_HEALTH_FAILURES:
+                    self._set_health(backend, False)
+
+    def _set_health(self, backend, healthy):
+        if backend.healthy != healthy:
+            backend.healthy = healthy
+            if healthy:
+                logger.info(f"Upstream {backend.url} is back in rotation")
+            else:
+                logger.warning(f"Upstream {backend.url} taken out of rotation")
+
+    def can_fail_over(self, method, body, tried):
+        """Whether a request whose connect failed may be sent to another replica."""
+        if len(tried) > UPSTREAM_FAILOVER_ATTEMPTS or len(tried) >= len(self.backends):
+            return False
+        if UPSTREAM_FAILOVER_METHODS == "idempotent" and method not in IDEMPOTENT_METHODS:
+            return False
+        # The body has to be replayable from the start
+        return body is None or body.position == 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                backend.url: {
+                    "healthy": backend.healthy,
+                    "outstanding": backend.outstanding,
+                    "requests": backend.requests,
+                    "connect_failures": backend.connect_failures,
+                }
+                for backend in self.backends
+            }
+
+
+_upstream_balancer = UpstreamBalancer(UPSTREAM_URLS)
+
+
+class UpstreamHealthChecker(threading.Thread):
+    """Probes every replica's UPSTREAM_HEALTH_PATH; any answer below 500 counts as healthy."""
+
+    def __init__(self, balancer):
+        super().__init__(name="upstream-health", daemon=True)
+        self.balancer = balancer
+
+    def run(self):
+        session = requests.Session()
+        while True:
+            for backend in self.balancer.backends:
+                try:
+                    response = session.get(
+                        f"{backend.url}{UPSTREAM_HEALTH_PATH}",
+                        timeout=UPSTREAM_HEALTH_TIMEOUT, allow_redirects=False, stream=True,
+                    )
+                    response.close()
+                    ok = response.status_code < 500
+                except requests.RequestException as e:
+                    logger.debug("Health check of %s failed: %s", backend.url, e)
+                    ok = False
+                self.balancer.check_result(backend, ok)
+            time.sleep(UPSTREAM_HEALTH_INTERVAL)
+
+
+_upstream_health_checker = UpstreamHealthChecker(_upstream_balancer)
+
+
+def start_upstream_health_checks():
+    """Start probing the replicas (only useful, and only done, when there are several)."""
+    if len(UPSTREAM_URLS) > 1 and UPSTREAM_HEALTH_INTERVAL > 0 and not _upstream_health_checker.is_alive():
+        _upstream_health_checker.start()
+
+
+class AdmissionRejected(Exception):
+    """No upstream slot for this request: its class's wait queue is full or the wait timed out."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionGate:
+    """Concurrency limit with a bounded FIFO wait queue for one route class.
+
+    A released slot is handed straight to the longest waiting request, so
+    newcomers cannot overtake the queue.
+    """
+
+    def __init__(self, route, limit, queue_size, timeout=ADMIT_QUEUE_TIMEOUT):
+        self.route = route
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a slot, waiting in line if needed; returns the seconds waited.
+
+        Raises AdmissionRejected when the queue is full or the wait times out.
+        """
+        if self.limit <= 0:
+            return 0.0
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                self.admitted += 1
+                return 0.0
+            if len(self._waiters) >= self.queue_size:
+                self.rejected += 1
+                raise AdmissionRejected("queue_full")
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        start = time.perf_counter()
+        if not waiter.wait(self.timeout):
+            with self._lock:
+                # The slot may have been handed over just as the wait timed out
+                if not waiter.is_set():
+                    self._waiters.remove(waiter)
+                    self.rejected += 1
+                    raise AdmissionRejected("timeout")
+        with self._lock:
+            self.admitted += 1
+        return time.perf_counter() - start
+
+    def release(self):
+        if self.limit <= 0:
+            return
+        with self._lock:
+            if self._waiters:
+                # The slot passes to the next in line; `active` stays the same
+                self._waiters.popleft().set()
+            else:
+                self.active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "active": self.active,
+                "waiting": len(self._waiters),
+                "queue_size": self.queue_size,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+# One gate per _route_class, so slow downloads never hold up events pages or other calls
+_admission_gates = {
+    "events": AdmissionGate("events", ADMIT_EVENTS_CONCURRENCY, ADMIT_EVENTS_QUEUE),
+    "download": AdmissionGate("download", ADMIT_DOWNLOAD_CONCURRENCY, ADMIT_DOWNLOAD_QUEUE),
+    "other": AdmissionGate("other", ADMIT_OTHER_CONCURRENCY, ADMIT_OTHER_QUEUE),
+}
+
+
+# Server-side prepared statements created on each pooled connection: name -> (argument types, SQL).
+# All lookups are set-based so one page of events costs a fixed number of round trips.
+DB_PREPARED_STATEMENTS = {
+    "mp_event_document_ids": (
+        "bigint[]",
+        "SELECT DISTINCT ON (event_id) event_id, document_id"
+        " FROM mayan_event_enrichment_trasheddocumentdeletedinfo"
+        " WHERE event_id = ANY($1) ORDER BY event_id, id DESC",
+    ),
+    "mp_document_type_labels": (
+        "bigint[]",
+        "SELECT id, label FROM documents_documenttype WHERE id = ANY($1)",
+    ),
+    "mp_document_type_ids": (
+        "bigint[]",
+        "SELECT id, document_type_id FROM documents_document WHERE id = ANY($1)",
+    ),
+    "mp_trashed_document_type_ids": (
+        "bigint[]",
+        "SELECT id, document_type_id FROM documents_trasheddocument WHERE id = ANY($1)",
+    ),
+}
+
+
+class DBPoolTimeout(Exception):
+    """No pooled DB connection became free within DB_POOL_TIMEOUT."""
+
+
+class DBUnavailable(Exception):
+    """Lookups are suspended by the circuit breaker after repeated DB failures."""
+
+
+class EnrichmentDeadlineExceeded(Exception):
+    """The request's enrichment budget (ENRICH_DEADLINE) is used up."""
+
+
+class EnrichmentBudget:
+    """Time allowance shared by the enrichment lookups of one request.
+
+    The clock starts with the first lookup, so time spent waiting on Mayan does
+    not count against it. `degraded` records why a lookup was skipped or failed,
+    which leaves the page (partly) unenriched. `db_seconds` and `db_lookups`
+    add up the lookups that went to the database, for Server-Timing.
+    """
+
+    def __init__(self, seconds=ENRICH_DEADLINE):
+        self.seconds = seconds
+        self.deadline = None
+        self.degraded = None
+        self.db_seconds = 0.0
+        self.db_lookups = 0
+
+    def remaining(self):
+        """Seconds left, or None when there is no deadline."""
+        if self.seconds <= 0:
+            return None
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.seconds
+        return self.deadline - time.monotonic()
+
+
+_enrichment = threading.local()
+
+
+@contextmanager
+def enrichment_budget(seconds=ENRICH_DEADLINE):
+    """Give the lookups made by this thread inside the block one shared budget."""
+    budget = _enrichment.budget = EnrichmentBudget(seconds)
+    try:
+        yield budget
+    finally:
+        _enrichment.budget = None
+
+
+def _current_budget():
+    return getattr(_enrichment, "budget", None)
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and rejects calls for `cooldown` seconds.
+
+    After the cooldown one probe call is let through (one per cooldown); its
+    success closes the breaker again, its failure keeps it open.
+    """
+
+    def __init__(self, name, threshold=DB_BREAKER_THRESHOLD, cooldown=DB_BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.trips = 0
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        if self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.cooldown:
+                return False
+            self._opened_at = now
+            return True
+
+    def record_success(self):
+        if self._failures or self._opened_at is not None:
+            with self._lock:
+                if self._opened_at is not None:
+                    logger.info(f"{self.name} circuit closed, lookups resumed")
+                self._failures = 0
+                self._opened_at = None
+
+    def record_failure(self):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.threshold:
+                return
+            if self._opened_at is None:
+                self.trips += 1
+                logger.warning(
+                    f"{self.name} circuit open after {self._failures} consecutive failures, "
+                    f"skipping lookups for {self.cooldown}s"
+                )
+            self._opened_at = time.monotonic()
+
+
+class _PooledConnection:
+    """A psycopg2 connection plus the bookkeeping the pool keeps for it."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.prepared = set()
+        self.last_used = time.monotonic()
+        self.broken = False
+        # Session statement_timeout in ms; None when unknown (e.g. after an error)
+        self.statement_timeout = DB_STATEMENT_TIMEOUT_MS
+
+
+class DBPool:
+    """Process-wide psycopg2 connection pool for the enrichment lookups.
+
+    Connections are opened lazily up to `maxconn`, run in autocommit mode and
+    carry the DB_PREPARED_STATEMENTS. A connection that sat idle longer than
+    DB_POOL_HEALTHCHECK_INTERVAL is pinged before reuse, and a query that fails
+    with a connection error is retried once on a fresh connection. Queries are
+    bounded by DB_STATEMENT_TIMEOUT_MS and the caller's EnrichmentBudget, and a
+    circuit breaker per statement stops one while it keeps failing (a lock on a
+    single table only suspends the lookup that reads it).
+    """
+
+    def __init__(self, maxconn=DB_POOL_MAX):
+        self.maxconn = maxconn
+        self.breakers = {name: CircuitBreaker(f"DB lookup {name}") for name in DB_PREPARED_STATEMENTS}
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._counters = {
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "checkouts": 0,
+            "checkout_timeouts": 0,
+            "health_check_failures": 0,
+            "reconnects": 0,
+            "queries": 0,
+            "query_errors": 0,
+            "statement_timeouts": 0,
+            "breaker_rejections": 0,
+        }
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(max=self.maxconn, idle=len(self._idle), in_use=self._in_use)
+        stats.update(
+            breaker_trips=sum(breaker.trips for breaker in self.breakers.values()),
+            breaker_open=sum(breaker.is_open for breaker in self.breakers.values()),
+        )
+        return stats
+
+    def _connect(self):
+        import psycopg2
+        conn = psycopg2.connect(
+            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+            connect_timeout=DB_CONNECT_TIMEOUT, application_name="mayan_proxy",
+            options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+        )
+        conn.autocommit = True
+        self._count("connections_opened")
+        pooled = _PooledConnection(conn)
+        for name in DB_PREPARED_STATEMENTS:
+            try:
+                self._prepare(pooled, name)
+            except psycopg2.Error as e:
+                # e.g. documents_trasheddocument missing on this Mayan version; retried on use
+                logger.debug("PREPARE %s failed: %s", name, e)
+        return pooled
+
+    def _prepare(self, pooled, name):
+        arg_types, sql = DB_PREPARED_STATEMENTS[name]
+        with pooled.conn.cursor() as cur:
+            cur.execute(f"PREPARE {name} ({arg_types}) AS {sql}")
+        pooled.prepared.add(name)
+
+    def _close(self, pooled):
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+        self._count("connections_closed")
+
+    def _is_healthy(self, pooled):
+        if pooled.conn.closed:
+            return False
+        if time.monotonic() - pooled.last_used < DB_POOL_HEALTHCHECK_INTERVAL:
+            return True
+        try:
+            with pooled.conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                return self._connect()
+            if self._is_healthy(pooled):
+                return pooled
+            self._count("health_check_failures")
+            self._close(pooled)
+
+    @contextmanager
+    def connection(self, timeout=DB_POOL_TIMEOUT):
+        """Check out a connection for the duration of the block."""
+        if not self._slots.acquire(timeout=timeout):
+            self._count("checkout_timeouts")
+            raise DBPoolTimeout(f"no DB connection available within {timeout:.3f}s")
+        pooled = None
+        try:
+            pooled = self._checkout()
+            with self._lock:
+                self._in_use += 1
+                self._counters["checkouts"] += 1
+            yield pooled
+        finally:
+            if pooled is not None:
+                with self._lock:
+                    self._in_use -= 1
+                if pooled.broken or pooled.conn.closed:
+                    self._close(pooled)
+                else:
+                    pooled.last_used = time.monotonic()
+                    with self._lock:
+                        self._idle.append(pooled)
+            self._slots.release()
+
+    def execute(self, name, params):
+        """Run a prepared statement and return all rows.
+
+        A connection-level failure marks the connection broken and the statement
+        is retried once on a new connection; any other error propagates. Raises
+        DBUnavailable while the circuit breaker is open and
+        EnrichmentDeadlineExceeded once the current request's budget is spent.
+        """
+        import psycopg2
+        breaker = self.breakers[name]
+        if not breaker.allow():
+            self._count("breaker_rejections")
+            raise DBUnavailable(f"{name} suspended after repeated failures")
+        try:
+            rows = self._execute(name, params, _current_budget())
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, DBPoolTimeout):
+            # Includes QueryCanceled, i.e. a statement timeout
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return rows
+
+    def _execute(self, name, params, budget):
+        import psycopg2
+        import psycopg2.errors
+        start = time.perf_counter()
+        for attempt in (1, 2):
+            timeout = self._statement_timeout(budget)
+            checkout_timeout = DB_POOL_TIMEOUT if timeout is None else min(DB_POOL_TIMEOUT, timeout / 1000)
+            with self.connection(checkout_timeout) as pooled:
+                try:
+                    if name not in pooled.prepared:
+                        self._prepare(pooled, name)
+                    placeholders = ", ".join(["%s"] * len(params))
+                    sql = f"EXECUTE {name} ({placeholders})"
+                    session_timeout = timeout or 0
+                    if session_timeout != pooled.statement_timeout:
+                        # Same round trip as the query itself
+                        sql = f"SET statement_timeout = {session_timeout}; {sql}"
+                        pooled.statement_timeout = None
+                    with pooled.conn.cursor() as cur:
+                        cur.execute(sql, params)
+                        rows = cur.fetchall()
+                    pooled.statement_timeout = session_timeout
+                    self._count("queries")
+                    _m_db_query_seconds.observe(time.perf_counter() - start, name)
+                    return rows
+                except psycopg2.errors.QueryCanceled:
+                    # The connection itself is fine; a retry would only exceed the budget
+                    self._count("statement_timeouts")
+                    raise
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    pooled.broken = True
+                    self._count("query_errors")
+                    if attempt == 2:
+                        raise
+                    self._count("reconnects")
+                except Exception:
+                    self._count("query_errors")
+                    raise
+
+    @staticmethod
+    def _statement_timeout(budget):
+        """statement_timeout (ms) for the next query: the configured cap or what is left of the budget."""
+        timeout = DB_STATEMENT_TIMEOUT_MS or None
+        remaining = budget.remaining() if budget is not None else None
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise EnrichmentDeadlineExceeded(f"enrichment deadline of {budget.seconds}s exceeded")
+        remaining_ms = max(1, math.ceil(remaining * 1000))
+        return remaining_ms if timeout is None else min(timeout, remaining_ms)
+
+
+_db_pool = DBPool()
+
+
+def _as_int(value):
+    """int(value), or None when value is missing or not an integer."""
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _int_set(values):
+    return {v for v in (_as_int(value) for value in values) if v is not None}
+
+
+class LookupCache:
+    """Bounded LRU cache with per-entry TTL for the enrichment lookups.
+
+    Misses are remembered too (as None) for LOOKUP_CACHE_NEGATIVE_TTL. Every
+    clear() bumps `generation`; a lookup that started before an invalidation
+    must not store what it read, so set_many() drops writes from an older
+    generation.
+    """
+
+    def __init__(self, name, max_entries=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL, negative_ttl=LOOKUP_CACHE_NEGATIVE_TTL):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get_many(self, keys):
+        """Return ({key: value} for cached keys, set of missing keys)."""
+        found, missing = {}, set()
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is None or entry[0] < now:
+                    if entry is not None:
+                        del self._data[key]
+                    missing.add(key)
+                    continue
+                self._data.move_to_end(key)
+                found[key] = entry[1]
+            self._counters["hits"] += len(found)
+            self._counters["misses"] += len(missing)
+        return found, missing
+
+    def set_many(self, mapping, generation):
+        now = time.monotonic()
+        with self._lock:
+            if generation != self.generation:
+                return
+            for key, value in mapping.items():
+                ttl = self.ttl if value is not None else self.negative_ttl
+                self._data[key] = (now + ttl, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+            self._counters["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(size=len(self._data), max_entries=self.max_entries)
+        return stats
+
+
+_event_document_cache = LookupCache("event_document_id")
+_document_type_label_cache = LookupCache("document_type_label")
+_document_type_id_cache = LookupCache("document_type_id")
+
+_events_page_cache = LookupCache("events_page", max_entries=EVENTS_CACHE_SIZE, ttl=EVENTS_CACHE_TTL)
+
+# Table named in the NOTIFY payload -> lookup caches whose entries it can invalidate.
+# Every notification also drops the enriched events pages built from these tables.
+_CACHES_BY_TABLE = {
+    "mayan_event_enrichment_trasheddocumentdeletedinfo": (_event_document_cache,),
+    "documents_documenttype": (_document_type_label_cache,),
+    "documents_document": (_document_type_id_cache,),
+    "actstream_action": (),
+    "mayan_event_enrichment_deletedcabinetevent": (),
+}
+_LOOKUP_CACHES = (_event_document_cache, _document_type_label_cache, _document_type_id_cache)
+_ALL_CACHES = _LOOKUP_CACHES + (_events_page_cache,)
+
+
+class CacheInvalidationListener(threading.Thread):
+    """LISTENs on DB_NOTIFY_CHANNEL and clears the lookup caches named by each notification.
+
+    The caches are only consulted while `live` is set: the listener is
+    connected and the notify triggers exist. Whenever it is not (startup,
+    lost connection, migration not applied) lookups go straight to the DB,
+    so a change can never be missed and served stale.
+    """
+
+    RECONNECT_DELAY = 5
+    TRIGGER_CHECK_SQL = (
+        "SELECT DISTINCT c.relname FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid"
+        " WHERE t.tgname LIKE 'mayan_proxy_notify_%'"
+    )
+
+    def __init__(self):
+        super().__init__(name="cache-invalidation", daemon=True)
+        self.live = False
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                logger.warning(f"Lookup cache listener disconnected: {e}")
+            self._set_live(False)
+            time.sleep(self.RECONNECT_DELAY)
+
+    def _set_live(self, live):
+        # Anything may have changed while we were not listening
+        for cache in _ALL_CACHES:
+            cache.clear()
+        self.live = live
+
+    def _listen(self):
+        import psycopg2
+        conn = psycopg2.connect(
+            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+            connect_timeout=DB_CONNECT_TIMEOUT, application_name="mayan_proxy_listener",
+        )
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {DB_NOTIFY_CHANNEL}")
+                cur.execute(self.TRIGGER_CHECK_SQL)
+                missing = set(_CACHES_BY_TABLE) - {row[0] for row in cur.fetchall()}
+            if missing:
+                logger.warning(
+                    f"Lookup cache disabled: notify triggers missing on {sorted(missing)} "
+                    "(run mayan_event_enrichment migrations)"
+                )
+                time.sleep(60)
+                return
+            self._set_live(True)
+            logger.info(f"Lookup cache enabled (LISTEN {DB_NOTIFY_CHANNEL})")
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    # Idle: make sure the connection is still there
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    for cache in _CACHES_BY_TABLE.get(notify.payload, _LOOKUP_CACHES):
+                        cache.clear()
+                    _events_page_cache.clear()
+        finally:
+            conn.close()
+
+
+_cache_listener = CacheInvalidationListener()
+
+
+def start_cache_listener():
+    """Enable the lookup cache (no-op when LOOKUP_CACHE_SIZE is 0)."""
+    if LOOKUP_CACHE_SIZE > 0 and not _cache_listener.is_alive():
+        _cache_listener.start()
+
+
+def _cached_lookup(cache, ids, fetch, what):
+    """Resolve ids through `cache`, fetching only the misses with one `fetch(ids)` call.
+
+    Returns {id: value} for the ids that exist; lookup failures are logged,
+    recorded on the request's EnrichmentBudget and yield whatever was cached.
+    """
+    ids = _int_set(ids)
+    if not ids:
+        return {}
+    if not _cache_listener.live:
+        found, missing = {}, ids
+    else:
+        found, missing = cache.get_many(ids)
+    if missing:
+        generation = cache.generation
+        budget = _current_budget()
+        start = time.perf_counter()
+        try:
+            fetched = fetch(missing)
+        except Exception as e:
+            logger.debug("DB lookup failed for %s %s: %s", what, sorted(missing), e)
+            if budget is not None and budget.degraded is None:
+                budget.degraded = _degraded_reason(e)
+        else:
+            if _cache_listener.live:
+                cache.set_many({key: fetched.get(key) for key in missing}, generation)
+            found.update(fetched)
+        finally:
+            if budget is not None:
+                budget.db_seconds += time.perf_counter() - start
+                budget.db_lookups += 1
+    return {key: value for key, value in found.items() if value is not None}
+
+
+def _degraded_reason(error):
+    """Short reason for the X-Mayan-Degraded header."""
+    if isinstance(error, DBUnavailable):
+        return "circuit-open"
+    if isinstance(error, EnrichmentDeadlineExceeded):
+        return "deadline"
+    if type(error).__name__ == "QueryCanceled":
+        return "statement-timeout"
+    return "db-error"
+
+
+def _fetch_document_ids_for_events(ids):
+    rows = _db_pool.execute("mp_event_document_ids", (sorted(ids),))
+    return {int(event_id): str(document_id) for event_id, document_id in rows}
+
+
+def _fetch_document_type_labels(ids):
+    rows = _db_pool.execute("mp_document_type_labels", (sorted(ids),))
+    return {int(doc_type_id): str(label) for doc_type_id, label in rows}
+
+
+def _fetch_document_type_ids_from_documents(ids):
+    import psycopg2.errors
+    found = {}
+    for doc_id, doc_type_id in _db_pool.execute("mp_document_type_ids", (sorted(ids),)):
+        found[int(doc_id)] = int(doc_type_id)
+    missing = ids - found.keys()
+    if missing:
+        try:
+            rows = _db_pool.execute("mp_trashed_document_type_ids", (sorted(missing),))
+        except psycopg2.errors.UndefinedTable:
+            # Mayan versions where TrashedDocument is a proxy model have no such table
+            rows = ()
+        for doc_id, doc_type_id in rows:
+            found[int(doc_id)] = int(doc_type_id)
+    return found
+
+
+def _get_document_ids_for_events(event_ids):
+    """Look up document_id from TrashedDocumentDeletedInfo for many event ids. Returns {event_id: str}."""
+    return _cached_lookup(_event_document_cache, event_ids, _fetch_document_ids_for_events, "events")
+
+
+def _get_document_type_labels(doc_type_ids):
+    """Look up DocumentType labels from documents_documenttype for many ids. Returns {id: str}."""
+    return _cached_lookup(_document_type_label_cache, doc_type_ids, _fetch_document_type_labels, "document_types")
+
+
+def _get_document_type_ids_from_documents(doc_ids):
+    """Look up document_type_id from documents_document, then documents_trasheddocument for the misses. Returns {doc_id: int}."""
+    return _cached_lookup(_document_type_id_cache, doc_ids, _fetch_document_type_ids_from_documents, "documents")
+
+
+def _rewrite_urls_and_collect_events(data, proxy_base, plan, matches):
+    """Rewrite internal Mayan URLs in place and sort out the events `plan`'s enrichers handle.
+
+    Single pass over the JSON tree; each matching event is appended to
+    matches[enricher]. Returns True if any string was rewritten.
+    """
+    changed = False
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if isinstance(v, str):
+                for t_url in TARGET_URLS:
+                    if t_url in v:
+                        v = data[k] = v.replace(t_url, proxy_base)
+                        changed = True
+            elif isinstance(v, (dict, list)):
+                if _rewrite_urls_and_collect_events(v, proxy_base, plan, matches):
+                    changed = True
+        if 'verb' in data:
+            for enricher in plan.enrichers_for(data['verb']):
+                matches.setdefault(enricher, []).append(data)
+    elif isinstance(data, list):
+        for i, item in enumerate(data):
+            if isinstance(item, (dict, list)):
+                if _rewrite_urls_and_collect_events(item, proxy_base, plan, matches):
+                    changed = True
+            elif isinstance(item, str):
+                for t_url in TARGET_URLS:
+                    if t_url in item:
+                        item = data[i] = item.replace(t_url, proxy_base)
+                        changed = True
+    return changed
+
+
+def _enrich_trashed_document_events(events):
+    """Fix the target of every collected trashed_document_deleted event on a page.
+
+    Three phases: inspect each event and gather the ids it needs, resolve all of
+    them with set-based queries (each distinct id fetched once), then apply the
+    results. Returns True if any event was changed.
+    """
+    changed = False
+    pending = []
+    event_ids, doc_ids, doc_type_ids = set(), set(), set()
+
+    # 1. Collect
+    for data in events:
+        target = data.get('target')
+        obj_id = _as_int(data.get('target_object_id'))
+
+        # Always create/update target dict for trashed_document_deleted
+        if not isinstance(target, dict):
+            data['target'] = target = {'id': obj_id}
+            changed = True
+            logger.debug(f"Fixed 'Unable to find serializer' for event {data.get('id')}")
+
+        # Determine document_id based on target content type
+        target_ct = data.get('target_content_type', {})
+        model = target_ct.get('model') if isinstance(target_ct, dict) else None
+
+        if model == 'document':
+            # target_object_id IS the document id when target is Document
+            if target.get('document_id') != obj_id:
+                target['document_id'] = obj_id
+                changed = True
+                logger.debug(f"Event {data.get('id')}: Set document_id={obj_id} (from Document target)")
+            # Add document_type for extraction: document_data.get('document_type', {}).get('label')
+            if not isinstance(target.get('document_type'), dict) and obj_id is not None:
+                doc_ids.add(obj_id)
+                pending.append((model, data, target, obj_id))
+
+        elif model == 'documenttype':
+            # target_object_id is the document TYPE id, NOT the deleted doc id;
+            # the real document_id comes from TrashedDocumentDeletedInfo by event_id
+            event_id = _as_int(data.get('id'))
+            if event_id is not None:
+                event_ids.add(event_id)
+            doc_type_id = obj_id if obj_id is not None else _as_int(target.get('document_type_id'))
+            if target.pop('document_type_id', None) is not None:
+                changed = True
+            needs_label = not isinstance(target.get('document_type'), dict) and doc_type_id is not None
+            if needs_label:
+                doc_type_ids.add(doc_type_id)
+            pending.append((model, data, target, (event_id, doc_type_id, needs_label)))
+
+    if not pending:
+        return changed
+
+    # 2. Resolve
+    budget = _current_budget()
+    doc_ids_by_event = _get_document_ids_for_events(event_ids)
+    doc_type_ids_by_doc = _get_document_type_ids_from_documents(doc_ids)
+    labels = _get_document_type_labels(doc_type_ids | set(doc_type_ids_by_doc.values()))
+
+    # 3. Apply
+    for model, data, target, key in pending:
+        if model == 'document':
+            doc_type_id = doc_type_ids_by_doc.get(key)
+            doc_type_label = labels.get(doc_type_id)
+            if doc_type_label is not None:
+                target['document_type'] = {'id': doc_type_id, 'label': doc_type_label}
+                changed = True
+            continue
+
+        event_id, doc_type_id, needs_label = key
+        obj_id = data.get('target_object_id')
+        doc_id = _as_int(doc_ids_by_event.get(event_id))
+        if doc_id is not None:
+            target['id'] = doc_id
+            target['document_id'] = doc_id
+            logger.debug(f"Event {event_id}: Set id={doc_id} and document_id={doc_id} (from DB lookup, doc_type={obj_id})")
+        elif budget is not None and budget.degraded:
+            # The lookup may not have run: leave document_id out rather than claim there is none
+            pass
+        else:
+            target['document_id'] = None
+            logger.warning(f"Event {event_id}: Could not find document_id in DB for doc_type={obj_id}")
+        changed = True
+        if needs_label:
+            doc_type_label = labels.get(doc_type_id)
+            if doc_type_label is not None:
+                target['document_type'] = {'id': doc_type_id, 'label': doc_type_label}
+    return changed
+
+
+class Enricher:
+    """One enrichment of events pages: the routes and verbs it handles and its batch resolver.
+
+    `routes` are request path prefixes. `verbs` are Mayan verb ids
+    ("documents.trashed_document_deleted") or bare verb names, which match in
+    any namespace. `resolve(events)` gets all of a page's matching events in one
+    call, fixes them in place (batching whatever it looks up) and returns True
+    if it changed any.
+    """
+
+    __slots__ = ('name', 'routes', 'verbs', 'resolve')
+
+    def __init__(self, name, routes, verbs, resolve):
+        self.name = name
+        self.routes = tuple(routes)
+        self.verbs = tuple(verbs)
+        self.resolve = resolve
+
+
+class EnrichmentPlan:
+    """The enrichers of one route, dispatched by verb and resolved in registration order."""
+
+    def __init__(self, enrichers):
+        self.enrichers = tuple(enrichers)
+        by_verb = {}
+        for enricher in self.enrichers:
+            for verb in enricher.verbs:
+                by_verb.setdefault(verb, []).append(enricher)
+        self._by_verb = {verb: tuple(enrichers) for verb, enrichers in by_verb.items()}
+        self._verbs = tuple(by_verb)
+        self._verb_bytes = tuple(verb.encode('utf-8') for verb in by_verb)
+
+    def mentions(self, body):
+        """Whether raw JSON text or bytes may hold an event to enrich (if not, only URLs need rewriting)."""
+        verbs = self._verb_bytes if isinstance(body, bytes) else self._verbs
+        return any(verb in body for verb in verbs)
+
+    def enrichers_for(self, verb):
+        """Enrichers handling an event's `verb` value (a dict with an id, or the id itself)."""
+        verb_id = verb.get('id') if isinstance(verb, dict) else str(verb)
+        if not isinstance(verb_id, str):
+            return ()
+        found = self._by_verb.get(verb_id, ())
+        name = verb_id.rpartition('.')[2]
+        if name != verb_id:
+            found += self._by_verb.get(name, ())
+        return found
+
+    def resolve(self, matches):
+        """Run each enricher once over the events collected for it; True if any changed."""
+        changed = False
+        for enricher in self.enrichers:
+            events = matches.get(enricher)
+            if events and enricher.resolve(events):
+                changed = True
+        return changed
+
+
+class EnricherRegistry:
+    """Registered enrichers, compiled into a dispatch table of route prefix -> EnrichmentPlan.
+
+    A prefix's plan holds every enricher with a route that covers it, so the
+    longest matching prefix decides what a request gets.
+    """
+
+    def __init__(self):
+        self._enrichers = []
+        self._routes = None
+        self._lock = threading.Lock()
+
+    def register(self, enricher):
+        with self._lock:
+            self._enrichers.append(enricher)
+            self._routes = None
+
+    def plan_for(self, path):
+        """The plan for a request path (the query is ignored), or None if nothing enriches it."""
+        routes = self._routes
+        if routes is None:
+            routes = self._compile()
+        path = path.split('?', 1)[0]
+        for prefix, plan in routes:
+            if path.startswith(prefix):
+                return plan
+        return None
+
+    def _compile(self):
+        with self._lock:
+            prefixes = sorted({route for enricher in self._enrichers for route in enricher.routes}, key=len, reverse=True)
+            self._routes = [
+                (prefix, EnrichmentPlan(
+                    enricher for enricher in self._enrichers
+                    if any(prefix.startswith(route) for route in enricher.routes)
+                ))
+                for prefix in prefixes
+            ]
+            return self._routes
+
+
+_enrichers = EnricherRegistry()
+register_enricher = _enrichers.register
+
+EVENTS_API_PATH = "/api/v4/events/"
+TRASHED_VERB = "trashed_document_deleted"
+register_enricher(Enricher("trashed_document", (EVENTS_API_PATH,), (TRASHED_VERB,), _enrich_trashed_document_events))
+# Events pages that no enricher applies to still get their URLs rewritten
+_URLS_ONLY = EnrichmentPlan(())
+
+
+def _fix_events_data(data, proxy_base, plan):
+    """Rewrite internal URLs in a whole page and run `plan`'s enrichers over its events.
+
+    The JSON is walked once, sorting the events out to the enrichers for their
+    verb; each enricher then resolves its events with one batched call per page
+    instead of lookups per event.
+    """
+    if not isinstance(data, (dict, list)):
+        return False
+    matches = {}
+    changed = _rewrite_urls_and_collect_events(data, proxy_base, plan, matches)
+    if matches and plan.resolve(matches):
+        changed = True
+    return changed
+
+
+class FeedUnavailable(Exception):
+    """The feed cannot take another subscriber (FEED_MAX_SUBSCRIBERS)."""
+
+
+class FeedSubscriber:
+    """Events not yet sent to one feed client (guarded by its feed's condition)."""
+
+    __slots__ = ("cursor", "events", "dropped")
+
+    def __init__(self, cursor):
+        # Id of the newest event this subscriber has (or should be treated as having) seen
+        self.cursor = cursor
+        self.events = deque()
+        self.dropped = False
+
+
+class EventFeed(threading.Thread):
+    """Polls Mayan's events list for one auth scope and fans new events out to its subscribers.
+
+    Events are enriched once, here, and handed to every subscriber as (id, event)
+    pairs in ascending id order. The first poll only sets the baseline: clients
+    without a Last-Event-ID get events that arrive after they subscribed.
+    """
+
+    def __init__(self, feeds, key, headers, proxy_base):
+        super().__init__(name="event-feed", daemon=True)
+        self.feeds = feeds
+        self.key = key
+        self.headers = headers
+        self.proxy_base = proxy_base
+        self.history = deque(maxlen=FEED_HISTORY)
+        self.last_id = None
+        # Status of the upstream refusal (401, 403, ...) that stopped this feed
+        self.error = None
+        self.stopped = False
+        self.subscribers = set()
+        self.idle_since = time.monotonic()
+        self.cond = threading.Condition()
+
+    def subscribe(self, after=None):
+        """Add a subscriber, pre-filled with the retained events newer than `after`."""
+        with self.cond:
+            subscriber = FeedSubscriber(after if after is not None else self.last_id)
+            if after is not None:
+                subscriber.events.extend(item for item in self.history if item[0] > after)
+                if subscriber.events:
+                    subscriber.cursor = subscriber.events[-1][0]
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.cond:
+            self.subscribers.discard(subscriber)
+            if not self.subscribers:
+                self.idle_since = time.monotonic()
+
+    def next_events(self, subscriber, timeout):
+        """Wait up to `timeout` seconds for events; returns the (possibly empty) list of them."""
+        with self.cond:
+            if not subscriber.events and not subscriber.dropped and not self.stopped:
+                self.cond.wait(timeout)
+            events = list(subscriber.events)
+            subscriber.events.clear()
+            return events
+
+    def run(self):
+        while True:
+            if self.feeds.retire_if_idle(self):
+                return
+            try:
+                self._poll()
+            except Exception as e:
+                logger.warning(f"Event feed poll failed: {e}")
+            if self.error is not None:
+                logger.info(f"Event feed stopped: Mayan answered {self.error}")
+                self.feeds.retire(self)
+                return
+            time.sleep(FEED_POLL_INTERVAL)
+
+    def _poll(self):
+        """Fetch the events newer than the last poll and publish them."""
+        new = []
+        for page in range(1, FEED_MAX_PAGES + 1):
+            results, has_next = self._fetch_page(page)
+            if results is None:
+                return
+            fresh = [
+                (event_id, event) for event_id, event in
+                ((_as_int(event.get('id')), event) for event in results if isinstance(event, dict))
+                if event_id is not None and (self.last_id is None or event_id > self.last_id)
+            ]
+            new.extend(fresh)
+            # Pages are newest first: once one reaches known events the rest are older
+            if self.last_id is None or len(fresh) < len(results) or not has_next:
+                break
+        else:
+            logger.warning(f"Event feed: more than {FEED_MAX_PAGES} pages of new events, older ones skipped")
+        new.sort(key=lambda item: item[0])
+        self._publish(new, baseline=self.last_id is None)
+
+    def _fetch_page(self, page):
+        """One enriched page of Mayan's events list: (results, has_next), or (None, False) on error."""
+        backend = _upstream_balancer.acquire()
+        try:
+            response = _upstream_request(
+                "GET",
+                f"{backend.url}{EVENTS_API_PATH}?page={page}&page_size={FEED_PAGE_SIZE}",
+                headers=self.headers,
+                allow_redirects=False,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT, 30),
+            )
+        finally:
+            _upstream_balancer.release(backend)
+        if response.status_code in (401, 403):
+            self.error = response.status_code
+            return None, False
+        if response.status_code != 200:
+            logger.warning(f"Event feed poll got {response.status_code} from {backend.url}")
+            return None, False
+        data = _json_codec.loads(response.content)
+        if not isinstance(data, dict) or not isinstance(data.get('results'), list):
+            logger.warning("Event feed poll got something other than an events page")
+            return None, False
+        with enrichment_budget():
+            _fix_events_data(data['results'], self.proxy_base, _enrichers.plan_for(EVENTS_API_PATH) or _URLS_ONLY)
+        return data['results'], bool(data.get('next'))
+
+    def _publish(self, new, baseline):
+        with self.cond:
+            self.history.extend(new)
+            if new:
+                self.last_id = new[-1][0]
+            elif baseline:
+                self.last_id = 0
+            for subscriber in list(self.subscribers):
+                if subscriber.cursor is None:
+                    # Subscribed before the baseline: only later events are new to it
+                    subscriber.cursor = self.last_id
+                    continue
+                pending = [item for item in new if item[0] > subscriber.cursor]
+                if not pending:
+                    continue
+                room = FEED_SUBSCRIBER_BUFFER - len(subscriber.events)
+                if len(pending) > room:
+                    # Too far behind: it gets what fits, then is dropped and resumes after
+                    # that from the history when it reconnects
+                    pending = pending[:max(room, 0)]
+                    subscriber.dropped = True
+                    self.subscribers.discard(subscriber)
+                    self.feeds.dropped += 1
+                if pending:
+                    subscriber.events.extend(pending)
+                    subscriber.cursor = pending[-1][0]
+            self.cond.notify_all()
+
+
+class EventFeeds:
+    """The running EventFeed per auth scope, started by the first subscriber."""
+
+    def __init__(self, max_subscribers=FEED_MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self.dropped = 0
+        self._feeds = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key, headers, proxy_base, after=None):
+        """Return (feed, subscriber) for a client; raises FeedUnavailable when full."""
+        with self._lock:
+            if sum(len(feed.subscribers) for feed in self._feeds.values()) >= self.max_subscribers:
+                raise FeedUnavailable()
+            feed = self._feeds.get(key)
+            if feed is None:
+                feed = self._feeds[key] = EventFeed(self, key, headers, proxy_base)
+                feed.start()
+            return feed, feed.subscribe(after)
+
+    def retire_if_idle(self, feed):
+        """Stop `feed` if nobody listened for FEED_IDLE_TIMEOUT seconds; True if it was stopped."""
+        with self._lock, feed.cond:
+            if feed.subscribers or time.monotonic() - feed.idle_since < FEED_IDLE_TIMEOUT:
+                return False
+            self._retire(feed)
+            return True
+
+    def retire(self, feed):
+        with self._lock, feed.cond:
+            self._retire(feed)
+
+    def _retire(self, feed):
+        if self._feeds.get(feed.key) is feed:
+            del self._feeds[feed.key]
+        feed.stopped = True
+        feed.cond.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "feeds": len(self._feeds),
+                "subscribers": sum(len(feed.subscribers) for feed in self._feeds.values()),
+                "dropped": self.dropped,
+            }
+
+
+_event_feeds = EventFeeds()
+
+
+def render_metrics():
+    """Prometheus text exposition for /__proxy/metrics: hot-path metrics plus pool and cache stats."""
+    lines = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    stats = get_proxy_stats()
+    for key, value in stats["db_pool"].items():
+        if key in ("max", "idle", "in_use", "breaker_open"):
+            name = f"mayan_proxy_db_pool_{key}"
+            lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        else:
+            name = f"mayan_proxy_db_pool_{key}_total"
+            lines += [f"# TYPE {name} counter", f"{name} {value}"]
+    upstream = stats["upstream"]
+    for key, kind in (("healthy", "gauge"), ("outstanding", "gauge"), ("requests", "counter"), ("connect_failures", "counter")):
+        name = f"mayan_proxy_upstream_{key}" + ("_total" if kind == "counter" else "")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f'{name}{{backend="{url}"}} {int(values[key])}' for url, values in upstream.items())
+    for key in ("active", "waiting"):
+        name = f"mayan_proxy_admission_{key}"
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f'{name}{{route="{route}"}} {values[key]}' for route, values in stats["admission"].items())
+    lines += [
+        "# TYPE mayan_proxy_log_records_dropped_total counter",
+        f"mayan_proxy_log_records_dropped_total {_DroppingQueueHandler.dropped}",
+    ]
+    caches = dict(stats["lookup_cache"])
+    lines += ["# TYPE mayan_proxy_cache_live gauge", f"mayan_proxy_cache_live {int(caches.pop('live'))}"]
+    for key in ("hits", "misses", "evictions", "invalidations", "size"):
+        name = f"mayan_proxy_cache_{key}" if key == "size" else f"mayan_proxy_cache_{key}_total"
+        lines.append(f"# TYPE {name} {'gauge' if key == 'size' else 'counter'}")
+        lines.extend(f'{name}{{cache="{cache}"}} {values[key]}' for cache, values in caches.items())
+    return "\n".join(lines) + "\n"
+
+
+def get_proxy_stats():
+    """Runtime statistics served at /__proxy/stats."""
+    return {
+        "upstream": _upstream_balancer.stats(),
+        "admission": {route: gate.stats() for route, gate in _admission_gates.items()},
+        "coalescing": _events_flights.stats(),
+        "download_cache": _download_cache.stats() if _download_cache is not None else None,
+        "event_feeds": _event_feeds.stats(),
+        "recording": _traffic_recorder.stats() if _traffic_recorder is not None else None,
+        "profiling": _profiler.stats(),
+        "db_pool": _db_pool.stats(),
+        "lookup_cache": {
+            "live": _cache_listener.live,
+            **{cache.name: cache.stats() for cache in _ALL_CACHES},
+        },
+    }
+
+
+@functools.lru_cache(maxsize=256)
+def _url_rewrite_rules(proxy_base):
+    """Compiled URL rewrite for one upstream/host pair: (str pattern, str repl, bytes pattern, bytes repl)."""
+    urls = sorted({url for url in TARGET_URLS if url}, key=len, reverse=True)
+    alternation = "|".join(re.escape(url) for url in urls)
+    # proxy_base comes from request headers; JSON-escape it before splicing it into a string literal
+    replacement = json.dumps(proxy_base)[1:-1].replace("\\", "\\\\")
+    return re.compile(alternation), replacement, re.compile(alternation.encode('ascii')), replacement.encode('ascii')
+
+
+def _rewrite_urls_in_text(text, proxy_base):
+    """Rewrite internal Mayan URLs inside raw JSON text. Returns (text, number of rewrites)."""
+    pattern, replacement, _, _ = _url_rewrite_rules(proxy_base)
+    return pattern.subn(replacement, text)
+
+
+def _rewrite_urls_in_bytes(data, proxy_base):
+    """Rewrite internal Mayan URLs inside a raw JSON body. Returns (body, number of rewrites)."""
+    _, _, pattern, replacement = _url_rewrite_rules(proxy_base)
+    return pattern.subn(replacement, data)
+
+
+class _NonFiniteFloat(float):
+    """NaN or +/-Infinity read from JSON (see OrjsonCodec)."""
+
+
+def _parse_json_float(text):
+    value = float(text)
+    return value if math.isfinite(value) else _NonFiniteFloat(value)
+
+
+# Decoding hooks for every JSON the proxy reads and may write back
+_JSON_FLOAT_HOOKS = {"parse_float": _parse_json_float, "parse_constant": _NonFiniteFloat}
+
+
+class StdlibJsonCodec:
+    """Parses and serializes events pages with the json module.
+
+    dumps() returns compact UTF-8 bytes with non-ASCII characters unescaped.
+    """
+
+    name = "stdlib"
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data, **_JSON_FLOAT_HOOKS)
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).encode('utf-8')
+
+
+# Digits to "0", everything else to " ": a run of 19 zeros then marks a number that may
+# not fit in 64 bits
+_DIGIT_RUNS = bytes(0x30 if 0x30 <= byte <= 0x39 else 0x20 for byte in range(256))
+_LONG_DIGIT_RUN = b"0" * 19
+
+
+class OrjsonCodec(StdlibJsonCodec):
+    """orjson with the json module's semantics: the stdlib codec handles whatever orjson
+    would refuse or change.
+
+    On input that is non-UTF-8 text, NaN and Infinity (which orjson refuses) and
+    integers beyond 64 bits, which orjson reads as floats. Any run of 19 digits
+    sends the page to the stdlib codec, which costs a translate() of the body
+    rather than a walk of the parsed page. On output, integers beyond 64 bits
+    and non-finite floats, which orjson writes as null; the stdlib codec reads
+    the latter as _NonFiniteFloat, a float subclass orjson refuses to write.
+    Floats can come out in a different notation of the same value (1e300 for
+    1e+300).
+    """
+
+    name = "orjson"
+
+    def loads(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8', 'surrogatepass')
+        if _LONG_DIGIT_RUN in data.translate(_DIGIT_RUNS):
+            return super().loads(data)
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return super().loads(data)
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            return super().dumps(obj)
+
+
+def _make_json_codec(backend=JSON_BACKEND):
+    if backend not in ("auto", "stdlib"):
+        raise ValueError(f"Unknown JSON_BACKEND {backend!r} (expected 'auto' or 'stdlib')")
+    return OrjsonCodec() if backend == "auto" and orjson is not None else StdlibJsonCodec()
+
+
+_json_codec = _make_json_codec()
+
+
+class NotStreamable(Exception):
+    """The body does not look like a paginated events page; buffer it instead."""
+
+
+class StreamingEventsRewriter:
+    """Incrementally rewrite a paginated events body: {..., "results": [...], ...}.
+
+    feed() takes decoded text as it arrives and returns the pieces that are
+    ready to send. Text around the `results` array is passed through with URL
+    rewriting; each array element is parsed as soon as it is complete and the
+    elements are enriched in batches of `batch_size`, so memory is bounded by
+    one batch rather than by the page. Elements that needed no change are
+    forwarded as the original text.
+
+    NotStreamable is raised (before anything was produced) when the body is not
+    a JSON object with a top-level `results` array; buffered() then returns the
+    text consumed so far.
+    """
+
+    RESULTS_ARRAY_RE = re.compile(r'"results"\s*:\s*\[')
+    MAX_PREFIX = 64 * 1024
+    WHITESPACE_RE = re.compile(r'\s*')
+
+    def __init__(self, proxy_base, plan, batch_size=STREAM_REWRITE_BATCH):
+        self.proxy_base = proxy_base
+        self.plan = plan
+        self.batch_size = batch_size
+        self.changed = False
+        self.elapsed = 0.0
+        self._decoder = json.JSONDecoder(**_JSON_FLOAT_HOOKS)
+        self._buf = ""
+        self._state = "prefix"
+        self._expect_value = True
+        self._batch = []
+        self._emitted = 0
+
+    def buffered(self):
+        return self._buf
+
+    def feed(self, text, final=False):
+        start = time.perf_counter()
+        try:
+            return self._feed(text, final)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def _feed(self, text, final):
+        self._buf += text
+        out = []
+        if self._state == "prefix":
+            match = self.RESULTS_ARRAY_RE.search(self._buf)
+            if match is None:
+                if final or len(self._buf) > self.MAX_PREFIX:
+                    raise NotStreamable("no top-level results array")
+                return out
+            head = self._buf[:match.start()]
+            # Only stream the flat DRF page shape: one opening brace, no arrays before `results`
+            if not head.lstrip().startswith("{") or head.count("{") != 1 or "[" in head:
+                raise NotStreamable("unexpected page layout")
+            out.append(self._rewrite_text(self._buf[:match.end()]))
+            self._buf = self._buf[match.end():]
+            self._state = "results"
+        if self._state == "results":
+            self._parse_results(final)
+            if self._state == "suffix" or len(self._batch) >= self.batch_size:
+                out.extend(self._flush())
+            if self._state == "suffix":
+                out.append("]")
+        if self._state == "suffix" and final:
+            out.append(self._rewrite_text(self._buf))
+            self._buf = ""
+        return out
+
+    def close(self):
+        """Signal end of input; returns the remaining pieces."""
+        out = self.feed("", final=True)
+        if self._state != "suffix":
+            raise ValueError("events body ended inside the results array")
+        return out
+
+    def _rewrite_text(self, text):
+        rewritten, count = _rewrite_urls_in_text(text, self.proxy_base)
+        if count:
+            self.changed = True
+        return rewritten
+
+    def _parse_results(self, final):
+        buf = self._buf
+        pos = 0
+        while True:
+            pos = self.WHITESPACE_RE.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            char = buf[pos]
+            if char == "]" and (not self._expect_value or not self._batch and not self._emitted):
+                pos += 1
+                self._state = "suffix"
+                break
+            if not self._expect_value:
+                if char != ",":
+                    raise ValueError(f"unexpected {char!r} in results array")
+                self._expect_value = True
+                pos += 1
+                continue
+            try:
+                element, end = self._decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break  # element not complete yet
+            if end >= len(buf) and not final:
+                break  # a number/literal could still continue in the next chunk
+            self._batch.append((element, buf[pos:end]))
+            self._expect_value = False
+            pos = end
+        self._buf = buf[pos:]
+
+    def _flush(self):
+        if not self._batch:
+            return []
+        matches = {}
+        pieces = []
+        for element, raw in self._batch:
+            if not self.plan.mentions(raw):
+                # Fast path: nothing to enrich, rewrite URLs in the original text
+                pieces.append(self._rewrite_text(raw))
+                continue
+            if _rewrite_urls_and_collect_events(element, self.proxy_base, self.plan, matches):
+                self.changed = True
+            pieces.append(element)
+        if matches and self.plan.resolve(matches):
+            self.changed = True
+        out = []
+        for piece in pieces:
+            if not isinstance(piece, str):
+                piece = _json_codec.dumps(piece).decode('utf-8')
+            out.append("," + piece if self._emitted else piece)
+            self._emitted += 1
+        self._batch = []
+        return out
+
+
+class CachedPage:
+    """An enriched events page ready to be replayed: headers, body and strong ETag."""
+
+    __slots__ = ("status", "headers", "body", "etag", "encoded", "lock")
+
+    def __init__(self, status, headers, body, etag):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        # Compressed variants by content-coding, filled on first use
+        self.encoded = {}
+        self.lock = threading.Lock()
+
+
+def _strong_etag(body):
+    return '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def _etag_matches(if_none_match, etag):
+    """If-None-Match check (weak comparison, as RFC 9110 13.1.2 requires)."""
+    if not if_none_match:
+        return False
+    candidates = {tag.strip() for tag in if_none_match.split(",")}
+    if "*" in candidates:
+        return True
+    return etag in {tag[2:] if tag.startswith("W/") else tag for tag in candidates}
+
+
+def _events_cache_enabled():
+    return EVENTS_CACHE_TTL > 0 and EVENTS_CACHE_SIZE > 0 and _cache_listener.live
+
+
+# Request headers an events page cache key covers (see _events_cache_key); Accept-Encoding
+# is negotiated by the proxy itself
+_EVENTS_PAGE_KEY_HEADERS = frozenset(('authorization', 'cookie', 'accept-language', 'accept', 'accept-encoding'))
+
+
+def _reusable_page(response):
+    """Whether an events response may be replayed to other requests with its cache key:
+    JSON, and not varying on a request header the key leaves out."""
+    content_type = response.headers.get('Content-Type', '')
+    if content_type.split(';', 1)[0].strip().lower() != 'application/json':
+        return False
+    vary = response.headers.get('Vary', '')
+    return all(name.strip().lower() in _EVENTS_PAGE_KEY_HEADERS for name in vary.split(',') if name.strip())
+
+
+class _Flight:
+    """One in-flight events request that identical requests can wait on."""
+
+    __slots__ = ("key", "page", "done")
+
+    def __init__(self, key):
+        self.key = key
+        self.page = None
+        self.done = threading.Event()
+
+
+class SingleFlight:
+    """Coalesces concurrent identical events requests onto one upstream fetch and enrichment.
+
+    The first request for a key leads: it fetches and enriches the page and
+    publishes it with finish(). Requests joining meanwhile wait for that page;
+    when the leader has nothing to share (error, non-200, not JSON, too large)
+    they get None and fetch on their own.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Return (flight, True) for a new leader, or (flight, False) to wait on an existing one."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = _Flight(key)
+            return flight, True
+
+    def finish(self, flight, page=None):
+        """Hand the leader's page (None: not shareable) to the waiters; later calls are no-ops."""
+        with self._lock:
+            if self._flights.get(flight.key) is not flight:
+                return
+            del self._flights[flight.key]
+        flight.page = page
+        flight.done.set()
+
+    @staticmethod
+    def wait(flight, timeout=COALESCE_WAIT):
+        flight.done.wait(timeout)
+        return flight.page
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights)}
+
+
+_events_flights = SingleFlight()
+
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class DownloadCacheEntry:
+    """A cached download: body file, its size, validators and the headers to replay."""
+
+    __slots__ = ("key", "path", "size", "etag", "last_modified", "headers")
+
+    def __init__(self, key, path, size, etag, last_modified, headers):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.headers = headers
+
+    def matches(self, response):
+        """True if `response` carries this entry's validators (so the body is the same)."""
+        etag = response.headers.get('ETag')
+        if self.etag or etag:
+            return etag == self.etag
+        return response.headers.get('Last-Modified') == self.last_modified
+
+
+# A fill's temporary file untouched for this long belongs to no running fill
+_DOWNLOAD_CACHE_STALE_TMP = 3600
+
+
+class DownloadCache:
+    """LRU of document file and page image bodies on local disk (DOWNLOAD_CACHE_DIR).
+
+    The directory is shared by the worker processes and is itself the index:
+    each entry is a body file plus a JSON sidecar with its validators and
+    headers, both named after the key's digest. Lookups read the sidecar and
+    touch it, so sidecar mtimes give the LRU order in every process. Entries
+    are stored, replaced and removed only under an flock on `.lock`, which also
+    covers the scan that evicts the least recently used above `max_bytes` (and
+    deletes orphaned files), so the cap holds across processes. Cold keys are
+    filled by one request while identical ones in the same process wait.
+    """
+
+    def __init__(self, directory, max_bytes=DOWNLOAD_CACHE_MAX_BYTES, max_entry=DOWNLOAD_CACHE_MAX_ENTRY):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self.fills = SingleFlight()
+        # Counted per process
+        self.hits = self.misses = self.stored = self.evictions = 0
+        self._lock = threading.Lock()
+        self._lock_path = os.path.join(directory, ".lock")
+        os.makedirs(directory, exist_ok=True)
+        with self._locked():
+            self._remove_stale_tmp()
+            self._evict(self._scan())
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive across threads and processes."""
+        # Opened per use: flock() locks belong to the open file description, which
+        # descriptors inherited across fork share, so a long-lived one opened before
+        # the prefork workers start would not keep them apart
+        with open(self._lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.blake2b(key.encode('utf-8', 'surrogateescape'), digest_size=20).hexdigest()
+
+    def _sidecar(self, key):
+        return os.path.join(self.directory, self._digest(key) + ".json")
+
+    @staticmethod
+    def _body_name(sidecar):
+        """The body file a sidecar refers to, or None if it is missing or unreadable."""
+        try:
+            with open(sidecar, encoding='utf-8') as f:
+                return json.load(f)["body"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def get(self, key):
+        sidecar = self._sidecar(key)
+        try:
+            with open(sidecar, encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta["key"] != key:
+                raise ValueError("key mismatch")
+            entry = DownloadCacheEntry(
+                key, os.path.join(self.directory, meta["body"]), meta["size"], meta["etag"],
+                meta["last_modified"], [tuple(header) for header in meta["headers"]],
+            )
+            # Recency for the LRU order
+            os.utime(sidecar)
+        except FileNotFoundError:
+            entry = None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable download cache entry {sidecar}: {e}")
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def open(self, entry):
+        """Open an entry's body, or return None (and forget it) if it is gone or was replaced."""
+        try:
+            f = open(entry.path, 'rb')
+        except FileNotFoundError:
+            self.discard(entry.key, entry)
+            return None
+        if os.fstat(f.fileno()).st_size != entry.size:
+            f.close()
+            self.discard(entry.key, entry)
+            return None
+        return f
+
+    def new_body_file(self):
+        """A temporary file for a fill; pass its name to store() or unlink it."""
+        return tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False)
+
+    def store(self, key, tmp_path, size, etag, last_modified, headers):
+        """Move a completely written body into the cache and return its entry."""
+        digest = self._digest(key)
+        # Every version gets its own body file, so readers of the previous one are unaffected
+        body_name = f"{digest}-{os.path.basename(tmp_path)[:-len('.tmp')]}.body"
+        body_path = os.path.join(self.directory, body_name)
+        sidecar = os.path.join(self.directory, digest + ".json")
+        with self._locked():
+            previous = self._body_name(sidecar)
+            os.replace(tmp_path, body_path)
+            with open(sidecar + ".tmp", "w", encoding='utf-8') as f:
+                json.dump({
+                    "key": key, "body": body_name, "size": size,
+                    "etag": etag, "last_modified": last_modified, "headers": headers,
+                }, f)
+            os.replace(sidecar + ".tmp", sidecar)
+            if previous is not None and previous != body_name:
+                _remove_file(os.path.join(self.directory, previous))
+            self._evict(self._scan())
+        with self._lock:
+            self.stored += 1
+        return DownloadCacheEntry(key, body_path, size, etag, last_modified, headers)
+
+    def discard(self, key, entry=None):
+        """Forget `key` (only if it still maps to `entry`, when given) and delete its files."""
+        sidecar = self._sidecar(key)
+        with self._locked():
+            body_name = self._body_name(sidecar)
+            if body_name is None:
+                return
+            body_path = os.path.join(self.directory, body_name)
+            if entry is not None and body_path != entry.path:
+                return
+            _remove_file(sidecar)
+            _remove_file(body_path)
+
+    def _scan(self):
+        """Every entry as (last use, sidecar path, body path, size), least recently used first.
+
+        Bodies no sidecar refers to and sidecars without their body are deleted.
+        Called with the lock held.
+        """
+        sidecars, bodies = {}, {}
+        with os.scandir(self.directory) as items:
+            for item in items:
+                if item.name.endswith(".json"):
+                    sidecars[item.name[:-len(".json")]] = item
+                elif item.name.endswith(".body"):
+                    bodies.setdefault(item.name.split("-", 1)[0], []).append(item)
+        entries = []
+        for digest, sidecar in sidecars.items():
+            candidates = bodies.pop(digest, [])
+            if len(candidates) > 1:
+                # Left behind by a process that died while replacing the entry
+                referenced = self._body_name(sidecar.path)
+                for item in candidates:
+                    if item.name != referenced:
+                        _remove_file(item.path)
+                candidates = [item for item in candidates if item.name == referenced]
+            try:
+                if not candidates:
+                    raise FileNotFoundError(sidecar.path)
+                entries.append((sidecar.stat().st_mtime, sidecar.path, candidates[0].path, candidates[0].stat().st_size))
+            except OSError:
+                _remove_file(sidecar.path)
+        for orphans in bodies.values():
+            for item in orphans:
+                _remove_file(item.path)
+        entries.sort()
+        return entries
+
+    def _evict(self, entries):
+        # Called with the lock held; the newest entry stays even if it alone is over max_bytes
+        total = sum(size for _, _, _, size in entries)
+        for _, sidecar, body_path, size in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            _remove_file(sidecar)
+            _remove_file(body_path)
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def _remove_stale_tmp(self):
+        stale = time.time() - _DOWNLOAD_CACHE_STALE_TMP
+        with os.scandir(self.directory) as items:
+            for item in items:
+                try:
+                    if item.name.endswith(".tmp") and item.stat().st_mtime < stale:
+                        _remove_file(item.path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        entries = size = 0
+        with os.scandir(self.directory) as items:
+            for item in items:
+                try:
+                    if item.name.endswith(".json"):
+                        entries += 1
+                    elif item.name.endswith(".body"):
+                        size += item.stat().st_size
+                except OSError:
+                    pass
+        with self._lock:
+            return {
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stored": self.stored,
+                "evictions": self.evictions,
+            }
+
+
+_download_cache = DownloadCache(DOWNLOAD_CACHE_DIR) if DOWNLOAD_CACHE_DIR else None
+
+
+def _content_length(headers):
+    """A response's Content-Length as an int, or None when it is missing or malformed."""
+    length = headers.get('Content-Length', '').strip()
+    return int(length) if length.isascii() and length.isdigit() else None
+
+
+def _parse_range(header, size):
+    """The single byte range asked for by a Range header, as (first, last) offsets (inclusive).
+
+    Returns None to send the whole body (no, malformed or multi-range header)
+    and False when the range lies outside the body (416).
+    """
+    if not header or not header.strip().lower().startswith('bytes='):
+        return None
+    spec = header.strip()[6:].strip()
+    first, sep, last = spec.partition('-')
+    if not sep or ',' in spec:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0 or size == 0:
+                return False
+            return (max(size - suffix, 0), size - 1)
+        start = int(first)
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end < start):
+        # Syntactically invalid: the header is ignored
+        return None
+    if start >= size:
+        return False
+    return (start, size - 1 if end is None else min(end, size - 1))
+
+
+def _negotiate_encoding(accept_encoding):
+    """Content-coding for an enriched page: "br", "gzip" or None (identity).
+
+    Follows the client's q-values; on a tie brotli wins when it is installed, and
+    the page stays plain when the client explicitly ranks identity higher.
+    """
+    if not COMPRESS_ENRICHED or not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = item.split(";")
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding.strip().lower()] = q
+    wildcard = qualities.get("*", 0.0)
+    offered = ("br", "gzip") if brotli is not None else ("gzip",)
+    best, best_q = None, 0.0
+    for coding in offered:
+        q = qualities.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    if qualities.get("identity", 0.0) > best_q:
+        return None
+    return best
+
+
+class _BodyCompressor:
+    """Incremental gzip/brotli encoder for one response body."""
+
+    def __init__(self, encoding):
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+            self.compress, self.finish = compressor.process, compressor.finish
+        else:
+            compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+            self.compress, self.finish = compressor.compress, compressor.flush
+
+
+def _compress_body(body, encoding):
+    compressor = _BodyCompressor(encoding)
+    return compressor.compress(body) + compressor.finish()
+
+
+def _encoded_etag(etag, encoding):
+    # Each content-coding is a different representation and needs its own strong validator
+    return f'{etag[:-1]}-{encoding}"' if encoding else etag
+
+
+def _vary_accept_encoding(vary):
+    if not vary:
+        return "Accept-Encoding"
+    if vary.strip() == "*" or "accept-encoding" in vary.lower():
+        return vary
+    return f"{vary}, Accept-Encoding"
+
+
+class RequestBodyStream:
+    """File-like view of a client request body for requests to stream upstream.
+
+    read() returns at most `chunk_size` bytes and never reads past `length`, so
+    only one chunk is held at a time and the client is read exactly as fast as
+    Mayan accepts the upload. __len__ lets requests send a Content-Length.
+    Unless the source is seekable (a spooled chunked upload), rewinding is only
+    allowed before the first read: urllib3 then fails a retry instead of
+    replaying a half-sent body.
+    """
+
+    mode = "rb"
+
+    def __init__(self, source, length, chunk_size=UPLOAD_CHUNK_SIZE, seekable=False):
+        self.source = source
+        self.length = length
+        self.chunk_size = chunk_size
+        self.seekable = seekable
+        self.position = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def exhausted(self):
+        return self.position >= self.length
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        data = self.source.read(min(size, remaining))
+        if not data:
+            raise ConnectionError(f"client sent {self.position} of {self.length} body bytes")
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence != 0 or (offset != self.position and not self.seekable):
+            raise OSError("request body stream cannot be rewound")
+        if self.seekable:
+            self.source.seek(offset)
+        self.position = offset
+        return offset
+
+    def close(self):
+        if self.seekable:
+            self.source.close()
+
+
+def _spool_chunked_body(rfile):
+    """Decode a Transfer-Encoding: chunked request body into a spooled temp file.
+
+    Mayan (Django behind gunicorn) ignores request bodies without a
+    Content-Length, so chunked uploads are de-chunked and forwarded with one.
+    Raises ValueError on malformed framing.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY)
+    try:
+        while True:
+            line = rfile.readline(65537)
+            if not line:
+                raise ConnectionError("client closed the connection inside a chunked body")
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise ValueError("malformed chunk size") from None
+            if size < 0:
+                raise ValueError("malformed chunk size")
+            if size == 0:
+                # Skip optional trailers up to the blank line
+                while rfile.readline(65537) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            while size:
+                data = rfile.read(min(size, UPLOAD_CHUNK_SIZE))
+                if not data:
+                    raise ConnectionError("client closed the connection inside a chunked body")
+                spool.write(data)
+                size -= len(data)
+            if rfile.readline(3) not in (b"\r\n", b"\n"):
+                raise ValueError("missing CRLF after chunk data")
+    except BaseException:
+        spool.close()
+        raise
+    length = spool.tell()
+    spool.seek(0)
+    return RequestBodyStream(spool, length, seekable=True)
+
+
+# Recorded with their values pseudonymized (cookies keep their names)
+_RECORD_SECRET_HEADERS = frozenset(('authorization', 'proxy-authorization', 'cookie', 'x-api-key', 'x-csrftoken'))
+# Client addresses and per-request framing are not recorded at all
+_RECORD_DROPPED_HEADERS = frozenset((
+    'content-length', 'expect', 'x-forwarded-for', 'x-real-ip', 'forwarded', REQUEST_ID_HEADER.lower(),
+))
+_RECORD_SECRET_PARAM_RE = re.compile(r"token|key|secret|passw|auth|sign", re.IGNORECASE)
+
+
+class RecordedExchange:
+    """A proxied request and Mayan's response, collected for the traffic recording while it is served."""
+
+    __slots__ = ('t', 'method', 'path', 'headers', 'route', 'upstream', 'upstream_seconds', 'chunks', 'size', 'complete')
+
+    def __init__(self, t, method, path, headers, route):
+        self.t = t
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.route = route
+        self.upstream = None
+        self.upstream_seconds = None
+        self.chunks = []
+        self.size = 0
+        self.complete = False
+
+    def add(self, data, complete=False):
+        self.size += len(data)
+        if self.size <= RECORD_MAX_BODY:
+            self.chunks.append(data)
+        else:
+            # Too large to keep: only its size is recorded
+            self.chunks = []
+        self.complete = complete
+
+    def tap(self, chunks):
+        """Pass body chunks through, keeping a copy; complete once they ran out."""
+        for chunk in chunks:
+            self.add(chunk)
+            yield chunk
+        self.complete = True
+
+
+class TrafficRecorder(threading.Thread):
+    """Writes proxied exchanges to RECORD_DIR for mayan_proxy_replay.py, one file per process.
+
+    The file is JSON lines: a "session" line with the wall-clock start, then
+    "exchange" lines (arrival in seconds since the start, the sanitized request,
+    the status sent to the client, Mayan's status, headers, latency and body
+    reference) and "body" lines (zlib-compressed and base64-encoded, written once
+    per distinct body). Request threads only enqueue: exchanges are dropped when
+    the writer falls behind by `queue_size` exchanges or `queue_bytes` of bodies,
+    and recording stops once max_bytes are written.
+    Secrets become keyed digests, the same value always the same pseudonym, so a
+    replay shares caches between users the way the recorded traffic did.
+    """
+
+    def __init__(self, directory, max_body=RECORD_MAX_BODY, max_bytes=RECORD_MAX_BYTES,
+                 queue_size=RECORD_QUEUE_SIZE, queue_bytes=RECORD_QUEUE_BYTES):
+        super().__init__(name="traffic-recorder", daemon=True)
+        self.directory = directory
+        self.max_body = max_body
+        self.max_bytes = max_bytes
+        self.queue_bytes = queue_bytes
+        self._queue = queue.Queue(queue_size)
+        # Body bytes held by queued exchanges
+        self._queued_bytes = 0
+        self._queued_lock = threading.Lock()
+        # Drawn before prefork workers are forked, so their files agree on pseudonyms
+        self._key = os.urandom(16)
+        self._bodies = set()
+        self._file = None
+        self._start = None
+        self.path = None
+        self.recording = False
+        self.recorded = self.dropped = self.bytes_written = 0
+
+    def open(self):
+        """Create this process's recording file and start accepting exchanges."""
+        os.makedirs(self.directory, exist_ok=True)
+        name = time.strftime("traffic-%Y%m%d-%H%M%S", time.gmtime()) + f"-{os.getpid()}.jsonl"
+        self.path = os.path.join(self.directory, name)
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        self._file = os.fdopen(fd, "w", encoding="ascii")
+        self._start = time.monotonic()
+        self._write({"type": "session", "version": 1, "started": time.time(), "pid": os.getpid(), "max_body": self.max_body})
+        self.recording = True
+
+    def begin(self, method, path, headers, route):
+        """A new exchange to fill in while the request is served, or None when not recording."""
+        if not self.recording:
+            return None
+        return RecordedExchange(time.monotonic() - self._start, method, path, list(headers.items()), route)
+
+    def record(self, exchange, status, duration, request_body_size):
+        held = exchange.size if exchange.chunks else 0
+        with self._queued_lock:
+            if self._queued_bytes + held > self.queue_bytes:
+                self.dropped += 1
+                return
+            self._queued_bytes += held
+        try:
+            self._queue.put_nowait((exchange, status, duration, request_body_size))
+        except queue.Full:
+            with self._queued_lock:
+                self._queued_bytes -= held
+                self.dropped += 1
+
+    def stop(self, timeout=5):
+        """Stop accepting exchanges and wait for the queued ones to be written."""
+        self.recording = False
+        if self.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self.join(timeout)
+
+    def run(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                exchange = item[0]
+                held = exchange.size if exchange.chunks else 0
+                if self.bytes_written < self.max_bytes:
+                    self._write_exchange(*item)
+                    if self.bytes_written >= self.max_bytes:
+                        self.recording = False
+                        logger.warning(f"Traffic recording stopped: {self.path} reached RECORD_MAX_BYTES")
+                with self._queued_lock:
+                    self._queued_bytes -= held
+                if self._queue.empty():
+                    self._file.flush()
+        except (OSError, ValueError) as e:
+            self.recording = False
+            logger.error(f"Traffic recording failed: {e}")
+        finally:
+            self._file.close()
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(',', ':')) + "\n"
+        self._file.write(line)
+        self.bytes_written += len(line)
+
+    def _write_exchange(self, exchange, status, duration, request_body_size):
+        entry = {
+            "type": "exchange",
+            "t": round(exchange.t, 4),
+            "method": exchange.method,
+            "path": self._redact_query(exchange.path),
+            "headers": self._request_headers(exchange.headers),
+            "body_size": request_body_size,
+            "route": exchange.route,
+            "status": status,
+            "duration_ms": round(duration * 1000, 1),
+            "upstream": None,
+        }
+        upstream = exchange.upstream
+        if upstream is not None:
+            body_id, size = None, exchange.size
+            if exchange.complete and size <= self.max_body:
+                if size:
+                    body_id = self._write_body(b"".join(exchange.chunks))
+            else:
+                # Unread or too large: the replay stands in bytes of the same size
+                declared = upstream.headers.get('Content-Length', '')
+                if declared.isdigit():
+                    size = max(size, int(declared))
+            entry["upstream"] = {
+                "status": upstream.status_code,
+                "headers": self._response_headers(upstream.raw.headers.items()),
+                "body": body_id,
+                "size": size,
+                "ms": round(exchange.upstream_seconds * 1000, 1),
+            }
+        self._write(entry)
+        self.recorded += 1
+
+    def _write_body(self, body):
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        if digest not in self._bodies:
+            self._bodies.add(digest)
+            self._write({"type": "body", "id": digest, "data": base64.b64encode(zlib.compress(body)).decode('ascii')})
+        return digest
+
+    def _pseudonym(self, value):
+        return hashlib.blake2b(value.encode('utf-8', 'surrogateescape'), key=self._key, digest_size=8).hexdigest()
+
+    def _pseudonymize_cookies(self, value, separator):
+        pairs = []
+        for pair in value.split(separator):
+            name, eq, secret = pair.strip().partition('=')
+            pairs.append(f"{name}={self._pseudonym(secret)}" if eq else name)
+        return f"{separator} ".join(pairs)
+
+    def _request_headers(self, headers):
+        recorded = []
+        for key, value in headers:
+            k_low = key.lower()
+            if k_low in HOP_BY_HOP_HEADERS or k_low in _RECORD_DROPPED_HEADERS:
+                continue
+            if k_low == 'cookie':
+                value = self._pseudonymize_cookies(value, ';')
+            elif k_low in _RECORD_SECRET_HEADERS:
+                scheme, _, credentials = value.partition(' ')
+                value = f"{scheme} {self._pseudonym(credentials)}" if credentials else self._pseudonym(value)
+            recorded.append([key, value])
+        return recorded
+
+    def _response_headers(self, headers):
+        recorded = []
+        for key, value in headers:
+            k_low = key.lower()
+            if k_low in HOP_BY_HOP_HEADERS or k_low == 'content-length':
+                continue
+            if k_low == 'set-cookie':
+                # Only the name=value pair is secret; the attributes stay as they were
+                cookie, _, attributes = value.partition(';')
+                value = self._pseudonymize_cookies(cookie, ';') + (f";{attributes}" if attributes else "")
+            recorded.append([key, value])
+        return recorded
+
+    def _redact_query(self, path):
+        split = urllib.parse.urlsplit(path)
+        params = urllib.parse.parse_qsl(split.query, keep_blank_values=True)
+        if not any(_RECORD_SECRET_PARAM_RE.search(name) for name, _ in params):
+            return path
+        query = urllib.parse.urlencode([
+            (name, self._pseudonym(value) if _RECORD_SECRET_PARAM_RE.search(name) else value) for name, value in params
+        ])
+        return urllib.parse.urlunsplit(split._replace(query=query))
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "recording": self.recording,
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "queued": self._queue.qsize(),
+            "queued_bytes": self._queued_bytes,
+            "bytes_written": self.bytes_written,
+        }
+
+
+_traffic_recorder = TrafficRecorder(RECORD_DIR) if RECORD_DIR else None
+
+
+def start_traffic_recording():
+    """Start writing this process's traffic recording (no-op without RECORD_DIR)."""
+    if _traffic_recorder is None or _traffic_recorder.is_alive():
+        return
+    try:
+        _traffic_recorder.open()
+    except OSError as e:
+        logger.error(f"Traffic recording disabled: {e}")
+        return
+    _traffic_recorder.start()
+    logger.info(f"Recording traffic to {_traffic_recorder.path}")
+
+
+def stop_traffic_recording():
+    if _traffic_recorder is not None:
+        _traffic_recorder.stop()
+
+
+class _StackSampler(threading.Thread):
+    """Samples one thread's Python stack every `interval` seconds into folded-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+class RequestProfiler:
+    """Profiles 1 in `every` proxied requests (0: off), one at a time, into rotating files.
+
+    "pstats" files are cProfile dumps (python -m pstats, snakeviz); "collapsed"
+    files hold the request thread's stacks sampled every `interval` seconds, one
+    folded stack per line (flamegraph.pl, speedscope). Only the newest `keep`
+    profiles in `directory` are kept. A request that comes due while another one
+    is being profiled defers its turn to the next request.
+    """
+
+    FORMATS = ("pstats", "collapsed")
+
+    def __init__(self, every=PROFILE_SAMPLE_EVERY, directory=PROFILE_DIR, format=PROFILE_FORMAT,
+                 keep=PROFILE_KEEP, interval=PROFILE_INTERVAL):
+        self.every = 0
+        self.format = "pstats"
+        self.configure(every, format)
+        self.directory = directory
+        self.keep = keep
+        self.interval = interval
+        self._counter = itertools.count(1)
+        self._busy = threading.Lock()
+        self._deferred = False
+        self.profiled = self.deferred = 0
+
+    def configure(self, every, format=None):
+        if every < 0:
+            raise ValueError("every must be 0 (off) or more")
+        if format is not None:
+            if format not in self.FORMATS:
+                raise ValueError(f"format must be one of {', '.join(self.FORMATS)}")
+            self.format = format
+        self.every = every
+
+    def due(self, every):
+        """Whether to profile this request; True reserves the profiler for profile()."""
+        if next(self._counter) % every and not self._deferred:
+            return False
+        if not self._busy.acquire(blocking=False):
+            self._deferred = True
+            self.deferred += 1
+            return False
+        self._deferred = False
+        return True
+
+    def profile(self, label, func, *args):
+        """Call func(*args) under the profiler reserved by due() and write out the profile."""
+        if self.format == "collapsed":
+            sampler = _StackSampler(threading.get_ident(), self.interval)
+            sampler.start()
+            try:
+                return func(*args)
+            finally:
+                sampler.stop()
+                self._busy.release()
+                self._write(label, "folded", lambda path: self._write_text(path, sampler.folded()))
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            return func(*args)
+        finally:
+            profiler.disable()
+            self._busy.release()
+            self._write(label, "pstats", profiler.dump_stats)
+
+    @staticmethod
+    def _write_text(path, text):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def _write(self, label, extension, write):
+        now = time.time()
+        # Sortable by name, which is how _rotate finds the oldest
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime(now)) + f".{int(now % 1 * 1000):03d}"
+        name = re.sub(r"[^A-Za-z0-9._-]+", "_", label)
+        path = os.path.join(self.directory, f"profile-{stamp}-{os.getpid()}-{name}.{extension}")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write(path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning(f"Could not write profile {path}: {e}")
+            return
+        self.profiled += 1
+        self._rotate()
+
+    def _rotate(self):
+        try:
+            names = sorted(
+                name for name in os.listdir(self.directory)
+                if name.startswith("profile-") and not name.endswith(".tmp")
+            )
+        except OSError:
+            return
+        for name in names[:max(0, len(names) - self.keep)]:
+            _remove_file(os.path.join(self.directory, name))
+
+    def stats(self):
+        return {
+            "every": self.every,
+            "format": self.format,
+            "directory": self.directory,
+            "profiled": self.profiled,
+            "deferred": self.deferred,
+        }
+
+
+_profiler = RequestProfiler()
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
-logger = logging.getLogger("MayanProxy")
 
+_REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._:/+=-]{1,128}")
 
-def _get_document_id_for_event(event_id):
-    """Look up document_id from TrashedDocumentDeletedInfo by event_id. Returns str or None."""
-    if event_id is None:
-        return None
-    try:
-        import psycopg2
-        conn = psycopg2.connect(
-            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
-        )
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT document_id FROM mayan_event_enrichment_trasheddocumentdeletedinfo WHERE event_id = %s LIMIT 1",
-            (int(event_id),),
-        )
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
-        return str(row[0]) if row else None
-    except Exception as e:
-        logger.debug("DB lookup failed for event %s: %s", event_id, e)
-        return None
 
+def _request_id(value):
+    """The client's request id if it is safe to log and forward, else a new random one."""
+    if value and _REQUEST_ID_RE.fullmatch(value):
+        return value
+    return os.urandom(8).hex()
 
-def _get_document_type_label(doc_type_id):
-    """Look up DocumentType label by id from documents_documenttype. Returns str or None."""
-    if doc_type_id is None:
-        return None
-    try:
-        import psycopg2
-        conn = psycopg2.connect(
-            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
-        )
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT label FROM documents_documenttype WHERE id = %s LIMIT 1",
-            (int(doc_type_id),),
-        )
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
-        return str(row[0]) if row else None
-    except Exception as e:
-        logger.debug("DB lookup failed for document_type %s: %s", doc_type_id, e)
-        return None
 
+class _CountingWriter:
+    """Wraps the handler's wfile to count the bytes sent to the client."""
 
-def _get_document_type_id_from_document(doc_id):
-    """Look up document_type_id from documents_document or documents_trasheddocument. Returns int or None."""
-    if doc_id is None:
-        return None
-    try:
-        import psycopg2
-        conn = psycopg2.connect(
-            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
-        )
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT document_type_id FROM documents_document WHERE id = %s LIMIT 1",
-            (int(doc_id),),
-        )
-        row = cur.fetchone()
-        if row is None:
-            cur.execute(
-                "SELECT document_type_id FROM documents_trasheddocument WHERE id = %s LIMIT 1",
-                (int(doc_id),),
-            )
-            row = cur.fetchone()
-        cur.close()
-        conn.close()
-        return int(row[0]) if row else None
-    except Exception as e:
-        logger.debug("DB lookup failed for document %s: %s", doc_id, e)
-        return None
+    def __init__(self, raw):
+        self._raw = raw
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self._raw.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
 
 
 class MayanProxyHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive; every response below is
+    # framed with Content-Length or chunked encoding (or closes the connection).
+    protocol_version = "HTTP/1.1"
+    # Only while serving: between requests the server waits on the connection (_IdleConnections)
+    timeout = CLIENT_IO_TIMEOUT
+    # Headers and body go out in separate writes; with Nagle the body waits for the
+    # client's delayed ACK of the headers (~40 ms per response)
+    disable_nagle_algorithm = True
+    # Set per proxied request: phase -> seconds, reported in Server-Timing
+    _timings = None
+    _timing_headers_due = False
+
+    def setup(self):
+        super().setup()
+        self.wfile = _CountingWriter(self.wfile)
+
     def log_message(self, format, *args):
         # Suppress default http.server logging to use our own
         return
 
+    def handle(self):
+        # Requests the client already sent are served here; for the next one the
+        # server waits on the connection without holding this thread
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._request_pending():
+            self.handle_one_request()
+
+    def _request_pending(self):
+        """Whether more of a next request has already arrived, without waiting for it."""
+        try:
+            self.connection.setblocking(False)
+            # Reads the socket only into rfile's buffer, which a following request uses
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            try:
+                self.connection.settimeout(self.timeout)
+            except OSError:
+                pass
+
+    def parse_request(self):
+        # A request line has arrived: the connection is busy until it is answered
+        self.server.connections.set_busy(self.connection, True)
+        return super().parse_request()
+
+    def handle_one_request(self):
+        # Only proxied requests (see _proxy_request) report timings
+        self._timings = None
+        try:
+            super().handle_one_request()
+        finally:
+            connections = self.server.connections
+            connections.set_busy(self.connection, False)
+            if connections.draining:
+                self.close_connection = True
+
+    def send_response(self, code, message=None):
+        self._status_code = code
+        super().send_response(code, message)
+        self._timing_headers_due = self._timings is not None
+
+    def end_headers(self):
+        if self._timing_headers_due:
+            self._timing_headers_due = False
+            self.send_header(REQUEST_ID_HEADER, self._request_id)
+            self.send_header('Server-Timing', self._server_timing())
+        super().end_headers()
+
+    def _server_timing(self):
+        """Server-Timing value for the phases done so far, in ms.
+
+        queue: admission wait, upstream: until Mayan's headers arrived, body: reading
+        a buffered events page, parse/fix/serialize: enrichment (fix includes db,
+        the lookups that missed the cache), total: everything up to the headers.
+        """
+        timings = dict(self._timings)
+        if self._budget.db_lookups:
+            timings['db'] = self._budget.db_seconds
+        timings['total'] = time.perf_counter() - self._request_start
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
     def do_GET(self):
+        if self.path in ("/__proxy/stats", "/__proxy/metrics") and not self._admin_allowed():
+            self._send_json(403, {"detail": "Proxy statistics need X-Proxy-Admin-Token or an allowed address."})
+            return
+        if self.path == "/__proxy/stats":
+            self._send_json(200, get_proxy_stats())
+            return
+        if self.path == "/__proxy/metrics":
+            body = render_metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if urllib.parse.urlsplit(self.path).path == "/__proxy/events/feed":
+            self._serve_event_feed()
+            return
         self._proxy_request("GET")
 
     def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path == "/__proxy/profile":
+            self._configure_profiler()
+            return
         self._proxy_request("POST")
 
     def do_PUT(self):
@@ -125,194 +3186,1425 @@ class MayanProxyHandler(http.server.BaseHTTPRequestHandler):
     def do_DELETE(self):
         self._proxy_request("DELETE")
 
+    def _admin_allowed(self):
+        """Whether this client may read the proxy's statistics (PROXY_ADMIN_ALLOW, PROXY_ADMIN_TOKEN)."""
+        if self._admin_token_sent():
+            return True
+        try:
+            address = ipaddress.ip_address(self.client_address[0])
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        return any(address in network for network in PROXY_ADMIN_ALLOW)
+
+    def _admin_token_sent(self):
+        """Whether the request carries X-Proxy-Admin-Token with PROXY_ADMIN_TOKEN (never, when it is unset)."""
+        token = self.headers.get('X-Proxy-Admin-Token', '').encode('utf-8', 'surrogateescape')
+        return bool(PROXY_ADMIN_TOKEN) and hmac.compare_digest(token, PROXY_ADMIN_TOKEN.encode('utf-8'))
+
+    def _send_json(self, status, payload, headers=None):
+        """Answer a proxy-internal endpoint with a JSON body."""
+        body = _json_codec.dumps(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _configure_profiler(self):
+        """POST /__proxy/profile?every=N[&format=pstats|collapsed]: change request profiling at runtime."""
+        # The body, if any, is not read
+        if self.headers.get('Content-Length', '0') != '0' or 'Transfer-Encoding' in self.headers:
+            self.close_connection = True
+        if not self._admin_token_sent():
+            self._send_json(403, {"detail": "Profiling control needs X-Proxy-Admin-Token (PROXY_ADMIN_TOKEN)."})
+            return
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        try:
+            _profiler.configure(int(params.get('every', _profiler.every)), params.get('format'))
+        except ValueError as e:
+            self._send_json(400, {"detail": str(e)})
+            return
+        logger.info(f"Profiling set to 1 in {_profiler.every} requests ({_profiler.format})" if _profiler.every else "Profiling off")
+        self._send_json(200, _profiler.stats())
+
     def _proxy_request(self, method):
-        url = f"{TARGET_URL}{self.path}"
-        headers = {key: value for key, value in self.headers.items() if key.lower() != 'host'}
+        """Forward one request, recording latency, status, bytes and in-flight metrics."""
+        route = _route_class(self.path)
+        self._route = route
+        self._status_code = None
+        self._request_body = None
+        self._access = None
+        self._enrich_seconds = None
+        self._timings = {}
+        self._request_id = _request_id(self.headers.get(REQUEST_ID_HEADER))
+        bytes_out = self.wfile.bytes_written
+        self._request_start = start = time.perf_counter()
+        recorder = _traffic_recorder
+        self._recording = recorder.begin(method, self.path, self.headers, route) if recorder is not None else None
+        _m_in_flight.inc(1, route)
+        self._profiling = False
+        try:
+            with enrichment_budget() as self._budget:
+                every = _profiler.every
+                if every and _profiler.due(every):
+                    self._profiling = True
+                    _profiler.profile(f"{method}-{route}-{self._request_id}", self._forward_request, method)
+                else:
+                    self._forward_request(method)
+        finally:
+            duration = time.perf_counter() - start
+            bytes_out = self.wfile.bytes_written - bytes_out
+            if self._budget.degraded:
+                _m_degraded.inc(1, self._budget.degraded)
+            _m_in_flight.dec(1, route)
+            _m_request_seconds.observe(duration, route)
+            _m_requests.inc(1, route, self._status_code or 0)
+            _m_bytes_out.inc(bytes_out, route)
+            if self._request_body is not None:
+                _m_bytes_in.inc(self._request_body.position, route)
+            if self._recording is not None:
+                body_size = self._request_body.position if self._request_body is not None else 0
+                recorder.record(self._recording, self._status_code, duration, body_size)
+            self._log_access(method, duration, bytes_out)
+
+    def _note_access(self, kind, detail=None):
+        """Record how the request was served; logged with its timings once it is done."""
+        self._access = (kind, detail)
+
+    def _log_access(self, method, duration, bytes_out):
+        kind, detail = self._access or (None, None)
+        slow = LOG_SLOW_REQUEST > 0 and duration >= LOG_SLOW_REQUEST
+        if kind is None:
+            if not slow:
+                return
+            kind = "SLOW"
+        elif not slow and kind in SAMPLED_ACCESS_KINDS and random.random() >= LOG_SAMPLE_RATE:
+            return
+        ms = lambda seconds: round(seconds * 1000, 1) if seconds is not None else None
+        fields = {
+            "kind": kind,
+            "method": method,
+            "path": self.path,
+            "status": self._status_code,
+            "route": self._route,
+            "duration_ms": ms(duration),
+            "queue_ms": ms(self._timings.get('queue')),
+            "upstream_ms": ms(self._timings.get('upstream')),
+            "enrich_ms": ms(self._enrich_seconds),
+            "bytes_out": bytes_out,
+            "request_id": self._request_id,
+        }
+        if self._budget.degraded:
+            fields["degraded"] = self._budget.degraded
+        level = logging.WARNING if slow or kind == "DEGRADED" else logging.INFO
+        detail = f" ({detail})" if detail else ""
+        message = f"{kind}: {method} {self.path}{detail} -> {self._status_code} in {fields['duration_ms']} ms"
+        logger.log(level, message, extra={"access": fields})
+        if slow and SLOW_REQUEST_LOG:
+            breakdown = dict(fields, detail=self._access[1] if self._access else None, db_lookups=self._budget.db_lookups)
+            breakdown.update({f"{name}_ms": ms(seconds) for name, seconds in self._timings.items()})
+            breakdown["db_ms"] = ms(self._budget.db_seconds)
+            slow_logger.warning(message, extra={"access": breakdown})
+
+    def _forward_request(self, method):
+        # Expect: 100-continue is answered by BaseHTTPRequestHandler itself and
+        # Content-Length is set by requests from the body stream
+        headers = {
+            key: value for key, value in self.headers.items()
+            if key.lower() not in ('host', 'expect', 'content-length', 'accept-encoding')
+            and key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in (REQUEST_ID_HEADER.lower(), 'x-mayan-profile')
+        }
+        headers[REQUEST_ID_HEADER] = self._request_id
+        if self._profiling and PROFILE_UPSTREAM_TOKEN:
+            # Have Mayan's events app profile its side of this request too
+            headers['X-Mayan-Profile'] = PROFILE_UPSTREAM_TOKEN
+        self._response_started = False
         
-        # Read body if present
-        content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length) if content_length > 0 else None
+        # Stream the body (if any) straight through to Mayan
+        try:
+            body = self._open_request_body()
+        except ValueError as e:
+            self.send_error(400, f"Bad Request: {e}")
+            return
+        except ConnectionError as e:
+            logger.error(f"Client upload failed: {e}")
+            self.close_connection = True
+            return
+
+        # Determine if we should intercept and fix JSON: routes some enricher handles
+        # (see EnricherRegistry), and only their successful responses
+        self._enrichment = _enrichers.plan_for(self.path)
+        is_events_api = self._enrichment is not None
+        # Passthrough bodies are relayed still encoded, so Mayan may only use codings the
+        # client accepts (requests would otherwise add its own). Events pages are fetched
+        # plain: they are parsed here and compressed again for the client.
+        if is_events_api:
+            headers['Accept-Encoding'] = 'identity'
+        else:
+            headers['Accept-Encoding'] = self.headers.get('Accept-Encoding', 'identity')
+
+        # Enriched events pages are served from the page cache while nothing changed, and
+        # shared with identical requests that arrive while one is being fetched
+        self._cache_fill = self._flight = None
+        if method == "GET" and is_events_api and (COALESCE_REQUESTS or _events_cache_enabled()):
+            cache_key = self._events_cache_key()
+            if _events_cache_enabled():
+                cached, _ = _events_page_cache.get_many((cache_key,))
+                if cached:
+                    self._send_cached_page(cached[cache_key])
+                    return
+                self._cache_fill = (cache_key, _events_page_cache.generation)
+            if COALESCE_REQUESTS:
+                flight, leader = _events_flights.join(cache_key)
+                if leader:
+                    self._flight = flight
+                else:
+                    page = _events_flights.wait(flight)
+                    _m_coalesced.inc(1, "shared" if page is not None else "fetched")
+                    if page is not None:
+                        self._send_cached_page(page, coalesced=True)
+                        return
+            # The proxy validates the enriched page itself; Mayan's validators do not apply to it
+            headers = {
+                key: value for key, value in headers.items()
+                if key.lower() not in ('if-none-match', 'if-modified-since')
+            }
 
+        # Downloads come from the disk cache once Mayan confirms the cached copy is current
+        self._download_fill = self._download_file = entry = None
+        if method == "GET" and _download_cache is not None and self._route == "download":
+            # The cache keeps plain bodies and answers the client's conditionals and ranges itself
+            headers = {
+                key: value for key, value in headers.items()
+                if key.lower() not in ('if-none-match', 'if-modified-since', 'if-range', 'range')
+            }
+            headers['Accept-Encoding'] = 'identity'
+            entry = self._cached_download(headers)
+
+        self._request_body = body
+        self._backend = self._admitted = None
+        response = None
         try:
+            # Wait for a free upstream slot of this route class
+            gate = _admission_gates[self._route]
+            self._timings['queue'] = gate.acquire()
+            self._admitted = gate
+            _m_admission_wait_seconds.observe(self._timings['queue'], self._route)
+
             # Forward the request to Mayan
-            response = requests.request(
-                method=method,
-                url=url,
-                headers=headers,
-                data=body,
-                allow_redirects=False,
-                stream=True # Stream response to handle large files
-            )
+            upstream_start = time.perf_counter()
+            response = self._send_upstream(method, headers, body)
+            self._timings['upstream'] = time.perf_counter() - upstream_start
+            _m_upstream_ttfb.observe(self._timings['upstream'], self._route)
+            if self._recording is not None:
+                self._recording.upstream = response
+                self._recording.upstream_seconds = self._timings['upstream']
+
+            if method == "GET" and _download_cache is not None and self._route == "download":
+                if self._send_download(response, entry):
+                    return
 
-            # Determine if we should intercept and fix JSON
-            # We only care about the events API and successful JSON responses
-            is_events_api = "/api/v4/events/" in self.path
             should_fix = is_events_api and response.status_code == 200
+            shareable = should_fix and _reusable_page(response)
+            if self._flight is not None and not (shareable and (not STREAM_REWRITE or self._fits_page(response, COALESCE_MAX_BODY))):
+                # Nothing to share: let the waiters go fetch their own
+                _events_flights.finish(self._flight)
             
             if should_fix:
-                content = response.content # Fully load for JSON fixing
-                try:
-                    data = json.loads(content)
-                    if self._fix_data(data):
-                        fixed_content = json.dumps(data, ensure_ascii=False).encode('utf-8')
-                        self._send_proxied_response(response, fixed_content, headers_mod={'X-Mayan-Fix': 'Applied', 'Content-Length': str(len(fixed_content))})
-                        logger.info(f"FIXED: {method} {self.path}")
-                        return
-                    else:
-                        self._send_proxied_response(response, content)
-                        logger.info(f"PASS: {method} {self.path} (No fix needed)")
-                        return
-                except Exception as e:
-                    logger.error(f"Error parsing/fixing JSON: {e}")
-                    self._send_proxied_response(response, content)
+                if STREAM_REWRITE and not self._keeps_page(response):
+                    self._send_streamed_fix(response)
+                else:
+                    # Fully load for JSON fixing
+                    body_start = time.perf_counter()
+                    content = response.content
+                    self._timings['body'] = time.perf_counter() - body_start
+                    if self._recording is not None:
+                        self._recording.add(content, complete=True)
+                    self._send_fixed_response(response, content)
             else:
                 # Transparently pass through everything else
                 self._send_proxied_response(response)
                 if is_events_api:
-                    logger.info(f"PROXY: {method} {self.path} ({response.status_code})")
+                    self._note_access("PROXY")
 
+        except AdmissionRejected as e:
+            _m_admission_rejected.inc(1, self._route, e.reason)
+            self._send_json(503, {"detail": "Mayan is busy, try again later."}, {'Retry-After': str(ADMIT_RETRY_AFTER)})
+            self._note_access("REJECTED", e.reason)
         except Exception as e:
-            logger.error(f"Proxy connection failed: {e}")
-            self.send_error(502, f"Bad Gateway: Could not connect to {TARGET_URL}")
+            if self._response_started:
+                # Headers are already on the wire; the only safe signal left is to drop the connection
+                logger.error(f"Proxy response aborted: {e}")
+                self.close_connection = True
+            else:
+                logger.error(f"Proxy connection failed: {e}")
+                upstream = self._backend.url if self._backend is not None else "Mayan"
+                self.send_error(502, f"Bad Gateway: Could not connect to {upstream}")
+        finally:
+            if response is not None:
+                # Returns the upstream connection to the pool (or discards it if unread)
+                response.close()
+            if self._backend is not None:
+                _upstream_balancer.release(self._backend)
+            if self._admitted is not None:
+                self._admitted.release()
+            if self._flight is not None:
+                _events_flights.finish(self._flight)
+            if self._download_fill is not None:
+                _download_cache.fills.finish(self._download_fill)
+            if self._download_file is not None:
+                self._download_file.close()
+            if body is not None:
+                if not body.exhausted:
+                    # Unread upload bytes are still on the socket; it cannot carry another request
+                    self.close_connection = True
+                body.close()
 
-    def _send_proxied_response(self, response, override_content=None, headers_mod=None):
+    def _send_upstream(self, method, headers, body):
+        """Send the request to a Mayan replica, moving on to another one if the connect fails."""
+        tried = []
+        while True:
+            self._backend = backend = _upstream_balancer.acquire(exclude=tried)
+            tried.append(backend)
+            try:
+                return _upstream_request(
+                    method,
+                    f"{backend.url}{self.path}",
+                    headers=headers,
+                    data=body,
+                    allow_redirects=False,
+                    stream=True # Stream response to handle large files
+                )
+            except requests.exceptions.RequestException as e:
+                if not _is_connect_failure(e):
+                    raise
+                _upstream_balancer.connect_failed(backend)
+                if not _upstream_balancer.can_fail_over(method, body, tried):
+                    raise
+                _upstream_balancer.release(backend)
+                self._backend = None
+                _m_upstream_failovers.inc()
+                logger.warning(f"Connect to {backend.url} failed, retrying {method} {self.path} on another replica")
+
+    def _cached_download(self, headers):
+        """The disk cache entry for this download, with its body opened, or None.
+
+        A cold key is fetched by one request; identical ones wait for that fill
+        rather than download the file too. The entry's validators are added to
+        the upstream `headers`.
+        """
+        key = self.path
+        entry = _download_cache.get(key)
+        if entry is None:
+            flight, leader = _download_cache.fills.join(key)
+            if leader:
+                self._download_fill = flight
+                return None
+            _download_cache.fills.wait(flight, DOWNLOAD_CACHE_FILL_WAIT)
+            entry = _download_cache.get(key)
+            if entry is None:
+                return None
+        # Held open so the body survives eviction while Mayan is asked about it
+        self._download_file = _download_cache.open(entry)
+        if self._download_file is None:
+            return None
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return entry
+
+    def _send_download(self, response, entry):
+        """Answer a download from the disk cache, filling it on the way; False to pass `response` through."""
+        if entry is not None:
+            if response.status_code == 304 or (response.status_code == 200 and entry.matches(response)):
+                response.close()
+                self._release_upstream()
+                # A revalidation may refresh the session
+                cookies = [('Set-Cookie', value) for key, value in response.raw.headers.items() if key.lower() == 'set-cookie']
+                self._send_cached_file(entry, self._download_file, "HIT", cookies)
+                self._note_access("CACHED", "disk")
+                return True
+            if response.status_code in (200, 404, 410):
+                _download_cache.discard(entry.key, entry)
+        if response.status_code != 200:
+            return False
+        return self._fill_download(response)
+
+    def _release_upstream(self):
+        """Give back the replica and the admission slot early: the rest comes from disk."""
+        if self._backend is not None:
+            _upstream_balancer.release(self._backend)
+            self._backend = None
+        if self._admitted is not None:
+            self._admitted.release()
+            self._admitted = None
+
+    def _fill_download(self, response):
+        """Store a download in the disk cache while sending it; False if it does not qualify.
+
+        Clients asking for a range or sending conditionals get their answer from
+        the stored file once it is complete; everyone else is streamed to as
+        the body arrives.
+        """
+        cache = _download_cache
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        length = _content_length(response.headers)
+        if (not (etag or last_modified) or 'content-encoding' in response.headers
+                or 'no-store' in response.headers.get('Cache-Control', '').lower()
+                # A length that cannot be parsed cannot be checked either: not cached
+                or (length is None and 'content-length' in response.headers)
+                or (length is not None and length > cache.max_entry)):
+            return False
+        headers = [
+            (key, value) for key, value in response.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in (
+                'content-length', 'content-encoding', 'content-range', 'accept-ranges', 'date', 'server', 'set-cookie',
+            )
+        ]
+        streaming = not any(self.headers.get(name) for name in ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since'))
+        size = 0
+        tmp = cache.new_body_file()
+        try:
+            with tmp:
+                if streaming:
+                    self._send_upstream_headers(response, {'Accept-Ranges': 'bytes', 'X-Mayan-Cache': 'MISS'})
+                    if length is not None:
+                        self.send_header('Content-Length', str(length))
+                        self.end_headers()
+                        chunked = False
+                    else:
+                        chunked = self._end_headers_streaming()
+                for chunk in self._recorded(response.iter_content(chunk_size=64 * 1024)):
+                    size += len(chunk)
+                    if size <= cache.max_entry or not streaming:
+                        tmp.write(chunk)
+                    if streaming:
+                        self._write_body(chunk, chunked)
+                if streaming:
+                    self._finish_body(chunked)
+            if length is not None and size != length:
+                # Mayan's body was cut short: never hand it out as complete. A streamed
+                # response is dropped mid-body, the others become a 502
+                raise ConnectionError(f"Mayan sent {size} of {length} bytes of {self.path}")
+            if size > cache.max_entry:
+                if not streaming:
+                    with open(tmp.name, 'rb') as f:
+                        entry = DownloadCacheEntry(self.path, tmp.name, size, etag, last_modified, headers)
+                        self._send_cached_file(entry, f, "MISS")
+                _remove_file(tmp.name)
+                return True
+            # Opened first: the body stays readable even if another process replaces or evicts it
+            f = None if streaming else open(tmp.name, 'rb')
+            try:
+                entry = cache.store(self.path, tmp.name, size, etag, last_modified, headers)
+            except BaseException:
+                if f is not None:
+                    f.close()
+                raise
+        except BaseException:
+            _remove_file(tmp.name)
+            raise
+        if self._download_fill is not None:
+            cache.fills.finish(self._download_fill)
+        if f is not None:
+            with f:
+                self._send_cached_file(entry, f, "MISS")
+        self._note_access("PROXY", "stored in download cache")
+        return True
+
+    def _send_cached_file(self, entry, f, cache_status, extra_headers=()):
+        """Send a download from disk with sendfile, answering the client's conditionals and Range."""
+        self._response_started = True
+        if self._not_modified(entry):
+            self.send_response(304)
+            for key, value in entry.headers:
+                if key.lower() in ('etag', 'last-modified', 'cache-control', 'expires', 'vary'):
+                    self.send_header(key, value)
+            self.end_headers()
+            return
+        byte_range = None
+        if_range = self.headers.get('If-Range')
+        # If-Range needs a strong validator match; otherwise the whole body is sent
+        if if_range is None or (if_range == entry.etag and not if_range.startswith('W/')) or if_range == entry.last_modified:
+            byte_range = _parse_range(self.headers.get('Range'), entry.size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', f"bytes */{entry.size}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        first, last = byte_range or (0, entry.size - 1)
+        self.send_response(206 if byte_range else 200)
+        for key, value in list(entry.headers) + list(extra_headers):
+            self.send_header(key, value)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('X-Mayan-Cache', cache_status)
+        if byte_range:
+            self.send_header('Content-Range', f"bytes {first}-{last}/{entry.size}")
+        count = last - first + 1
+        self.send_header('Content-Length', str(count))
+        self.end_headers()
+        if count > 0:
+            self.wfile.bytes_written += self.connection.sendfile(f, first, count)
+
+    def _not_modified(self, entry):
+        """Client conditionals against a cached download (If-None-Match wins over If-Modified-Since)."""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return bool(entry.etag) and _etag_matches(if_none_match, entry.etag)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if not (if_modified_since and entry.last_modified):
+            return False
+        try:
+            return email.utils.parsedate_to_datetime(entry.last_modified) <= email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    def _open_request_body(self):
+        """Return the client request body as a RequestBodyStream, or None if there is none."""
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return _spool_chunked_body(self.rfile)
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            raise ValueError("invalid Content-Length")
+        if content_length < 0:
+            raise ValueError("invalid Content-Length")
+        if content_length == 0:
+            return None
+        return RequestBodyStream(self.rfile, content_length)
+
+    def _events_cache_key(self):
+        """Page cache key: path and query, the host the URLs are rewritten to, who is asking and
+        which representation (Mayan's API negotiates on Accept)."""
+        return (self.path, self._proxy_base(), self._auth_identity(), self.headers.get('Accept', ''))
+
+    def _auth_identity(self):
+        """Digest of the headers that decide what Mayan shows (and in which language)."""
+        identity = hashlib.blake2b(digest_size=16)
+        for name in ('Authorization', 'Cookie', 'Accept-Language'):
+            identity.update(self.headers.get(name, '').encode('utf-8', 'surrogateescape'))
+            identity.update(b"\0")
+        return identity.hexdigest()
+
+    def _serve_event_feed(self):
+        """New enriched events, as server-sent events or (without Accept: text/event-stream) a long poll.
+
+        Resumes after the Last-Event-ID header or the `after` query parameter;
+        the long poll waits up to `timeout` seconds (FEED_LONG_POLL_TIMEOUT at most).
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        try:
+            after = self.headers.get('Last-Event-ID') or query.get('after', [''])[0]
+            after = int(after) if after else None
+            timeout = min(float(query.get('timeout', [FEED_LONG_POLL_TIMEOUT])[0]), FEED_LONG_POLL_TIMEOUT)
+        except ValueError:
+            self._send_json(400, {"detail": "Last-Event-ID, after and timeout must be numbers"})
+            return
+        headers = {name: self.headers[name] for name in ('Authorization', 'Cookie', 'Accept-Language') if name in self.headers}
+        headers['Accept'] = 'application/json'
+        proxy_base = self._proxy_base()
+        try:
+            feed, subscriber = _event_feeds.subscribe((proxy_base, self._auth_identity()), headers, proxy_base, after)
+        except FeedUnavailable:
+            self._send_json(503, {"detail": "Too many feed subscribers"}, {'Retry-After': str(max(1, round(FEED_POLL_INTERVAL)))})
+            return
+        try:
+            if 'text/event-stream' in self.headers.get('Accept', ''):
+                self._stream_feed(feed, subscriber)
+            else:
+                self._long_poll_feed(feed, subscriber, timeout)
+        finally:
+            feed.unsubscribe(subscriber)
+
+    def _stream_feed(self, feed, subscriber):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-store')
+        # Keeps buffering reverse proxies (nginx) from holding events back
+        self.send_header('X-Accel-Buffering', 'no')
+        chunked = self._end_headers_streaming()
+        # When the stream ends the client reconnects (with Last-Event-ID) anyway
+        self.close_connection = True
+        try:
+            self._write_body(b"retry: 3000\n\n", chunked)
+            last_write = time.monotonic()
+            while True:
+                # Woken at least every second to notice a shutdown
+                events = feed.next_events(subscriber, min(1.0, FEED_HEARTBEAT))
+                if events:
+                    self._write_body(b"".join(
+                        b"id: %d\ndata: %b\n\n" % (event_id, _json_codec.dumps(event))
+                        for event_id, event in events
+                    ), chunked)
+                    last_write = time.monotonic()
+                elif time.monotonic() - last_write >= FEED_HEARTBEAT:
+                    self._write_body(b": keepalive\n\n", chunked)
+                    last_write = time.monotonic()
+                if subscriber.dropped or feed.stopped or self.server.connections.draining:
+                    break
+            if feed.error is not None:
+                self._write_body(b'event: error\ndata: {"status": %d}\n\n' % feed.error, chunked)
+            self._finish_body(chunked)
+        except OSError:
+            # The client went away
+            self.close_connection = True
+
+    def _long_poll_feed(self, feed, subscriber, timeout):
+        deadline = time.monotonic() + timeout
+        events = []
+        while not (events or subscriber.dropped or feed.stopped):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            events = feed.next_events(subscriber, remaining)
+        if feed.error is not None and not events:
+            self._send_json(feed.error, {"detail": "Mayan refused the events feed"})
+            return
+        self._send_json(200, {
+            "last_id": events[-1][0] if events else subscriber.cursor,
+            "events": [event for _, event in events],
+        })
+
+    def _keeps_page(self, response):
+        """True when this page will be cached or shared, which needs the whole body (so no streaming)."""
+        if self._flight is not None and not self._flight.done.is_set():
+            return True
+        return self._cache_fill is not None and _reusable_page(response) and self._fits_page(response, EVENTS_CACHE_MAX_BODY)
+
+    @staticmethod
+    def _fits_page(response, limit):
+        length = _content_length(response.headers)
+        return length is not None and 'content-encoding' not in response.headers and length <= limit
+
+    def _send_cached_page(self, page, coalesced=False):
+        """Replay a page from the page cache, or one shared by an identical in-flight request."""
+        encoding = self._client_encoding(page.body)
+        etag = _encoded_etag(page.etag, encoding)
+        if _etag_matches(self.headers.get('If-None-Match'), etag):
+            self._send_not_modified(etag)
+            self._note_access("NOT MODIFIED", "coalesced" if coalesced else "cache hit")
+            return
+        body = self._compressed(page.body, encoding, page) if encoding else page.body
+        self._response_started = True
+        self.send_response(page.status)
+        for key, value in page.headers:
+            if key.lower() != 'etag':
+                self.send_header(key, value)
+        self.send_header('ETag', etag)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('X-Mayan-Cache', 'COALESCED' if coalesced else 'HIT')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self._note_access("COALESCED" if coalesced else "CACHED")
+
+    def _client_encoding(self, body):
+        """Content-coding to send an enriched body with, or None when it stays plain."""
+        if len(body) < COMPRESS_MIN_SIZE:
+            return None
+        return _negotiate_encoding(self.headers.get('Accept-Encoding'))
+
+    def _compressed(self, body, encoding, page=None):
+        """Compress an enriched body, reusing the variant kept on its cached page."""
+        if page is None:
+            return _compress_body(body, encoding)
+        # Requests sharing a page compress it once per coding
+        with page.lock:
+            encoded = page.encoded.get(encoding)
+            if encoded is None:
+                encoded = page.encoded[encoding] = _compress_body(body, encoding)
+        return encoded
+
+    def _send_not_modified(self, etag):
+        self._response_started = True
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+    def _send_fixed_response(self, response, content):
+        """Fix a buffered events page and send it (unchanged if it cannot be parsed).
+
+        Pages without a trashed_document_deleted event only need their URLs
+        rewritten, which is done on the raw bytes without deserializing. The
+        result carries a strong ETag and is stored in the page cache when the
+        request is cacheable.
+        """
+        enrich_start = time.perf_counter()
+        try:
+            if not self._enrichment.mentions(content):
+                fixed_content, rewrites = _rewrite_urls_in_bytes(content, self._proxy_base())
+                if not rewrites:
+                    fixed_content = None
+                self._timings['fix'] = time.perf_counter() - enrich_start
+            else:
+                data = _json_codec.loads(content)
+                parsed = time.perf_counter()
+                changed = self._fix_data(data)
+                fixed = time.perf_counter()
+                fixed_content = _json_codec.dumps(data) if changed else None
+                self._timings.update(parse=parsed - enrich_start, fix=fixed - parsed, serialize=time.perf_counter() - fixed)
+        except Exception as e:
+            logger.error(f"Error parsing/fixing JSON: {e}")
+            self._send_proxied_response(response, content)
+            return
+        self._enrich_seconds = time.perf_counter() - enrich_start
+        _m_enrichment_seconds.observe(self._enrich_seconds, "buffered")
+
+        body = fixed_content if fixed_content is not None else content
+        headers_mod = {
+            'ETag': _strong_etag(body),
+            'Vary': _vary_accept_encoding(response.headers.get('Vary')),
+        }
+        if fixed_content is not None:
+            headers_mod['X-Mayan-Fix'] = 'Applied'
+        if self._budget.degraded:
+            # Served as is this once (and to requests coalesced onto it); the next request
+            # tries the lookups again
+            headers_mod['X-Mayan-Degraded'] = self._budget.degraded
+        page = self._keep_page(response, body, headers_mod)
+
+        encoding = self._client_encoding(body)
+        etag = _encoded_etag(headers_mod['ETag'], encoding)
+        if _etag_matches(self.headers.get('If-None-Match'), etag):
+            self._send_not_modified(etag)
+            self._note_access("NOT MODIFIED")
+            return
+        if encoding:
+            body = self._compressed(body, encoding, page)
+            headers_mod.update({'ETag': etag, 'Content-Encoding': encoding})
+        self._send_proxied_response(response, body, headers_mod=headers_mod)
+        if self._budget.degraded:
+            self._note_access("DEGRADED", self._budget.degraded)
+        elif fixed_content is not None:
+            self._note_access("FIXED")
+        else:
+            self._note_access("PASS", "No fix needed")
+
+    def _keep_page(self, response, body, headers_mod):
+        """Store an enriched page (uncompressed) in the page cache and share it with coalesced
+        requests, as far as each applies; returns the page, or None."""
+        cacheable = (
+            self._cache_fill is not None and not self._budget.degraded
+            and len(body) <= EVENTS_CACHE_MAX_BODY and _reusable_page(response)
+        )
+        shared = self._flight is not None and len(body) <= COALESCE_MAX_BODY and _reusable_page(response)
+        if not (cacheable or shared) or 'set-cookie' in response.headers:
+            return None
+        overridden = {key.lower() for key in headers_mod}
+        headers = [
+            (key, value) for key, value in response.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in overridden
+            and key.lower() not in ('content-encoding', 'content-length', 'date', 'server', 'etag')
+        ]
+        headers.extend(headers_mod.items())
+        page = CachedPage(response.status_code, headers, body, headers_mod['ETag'])
+        if cacheable:
+            cache_key, generation = self._cache_fill
+            _events_page_cache.set_many({cache_key: page}, generation)
+        if shared:
+            _events_flights.finish(self._flight, page)
+        return page
+
+    def _send_streamed_fix(self, response):
+        """Enrich an events page while it streams through (STREAM_REWRITE).
+
+        Headers go out with the first rewritten piece, so bodies that turn out not
+        to be an events page are still buffered and handled by _send_fixed_response.
+        """
+        rewriter = StreamingEventsRewriter(self._proxy_base(), self._enrichment)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        chunks = self._recorded(response.iter_content(chunk_size=64 * 1024))
+        # Streamed pages are large by construction, so the size threshold does not apply
+        encoding = _negotiate_encoding(self.headers.get('Accept-Encoding'))
+        compressor = _BodyCompressor(encoding) if encoding else None
+        headers_mod = {'X-Mayan-Fix': 'Streamed', 'Vary': _vary_accept_encoding(response.headers.get('Vary'))}
+        if encoding:
+            headers_mod['Content-Encoding'] = encoding
+        chunked = None
+        try:
+            for chunk in chunks:
+                pieces = rewriter.feed(decoder.decode(chunk))
+                if pieces:
+                    if chunked is None:
+                        self._mark_degraded(headers_mod)
+                        self._send_upstream_headers(response, headers_mod)
+                        chunked = self._end_headers_streaming()
+                    data = "".join(pieces).encode('utf-8')
+                    self._write_body(compressor.compress(data) if compressor else data, chunked)
+            pieces = rewriter.feed(decoder.decode(b"", final=True)) + rewriter.close()
+        except NotStreamable:
+            content = (rewriter.buffered() + decoder.decode(b"", final=True)).encode('utf-8')
+            content += b"".join(chunks)
+            self._send_fixed_response(response, content)
+            return
+        if chunked is None:
+            self._mark_degraded(headers_mod)
+            self._send_upstream_headers(response, headers_mod)
+            chunked = self._end_headers_streaming()
+        data = "".join(pieces).encode('utf-8')
+        if compressor:
+            data = compressor.compress(data) + compressor.finish()
+        self._write_body(data, chunked)
+        self._finish_body(chunked)
+        self._enrich_seconds = self._timings['fix'] = rewriter.elapsed
+        _m_enrichment_seconds.observe(rewriter.elapsed, "streamed")
+        if self._budget.degraded:
+            # Headers may have gone out before the failing batch, so this is only logged
+            self._note_access("DEGRADED", f"streamed, {self._budget.degraded}")
+        elif rewriter.changed:
+            self._note_access("FIXED", "streamed")
+        else:
+            self._note_access("PASS", "streamed, no fix needed")
+
+    def _mark_degraded(self, headers_mod):
+        if self._budget.degraded:
+            headers_mod['X-Mayan-Degraded'] = self._budget.degraded
+
+    def _send_upstream_headers(self, response, headers_mod=None, raw=False):
+        """Send the status line and the upstream headers, leaving the header block open for framing.
+
+        With `raw` the body is relayed exactly as Mayan encoded it, so its
+        Content-Encoding is kept.
+        """
+        self._response_started = True
         self.send_response(response.status_code)
+        headers_mod = headers_mod or {}
+        overridden = {key.lower() for key in headers_mod}
         
         # Copy headers from original response
         for key, value in response.headers.items():
             k_low = key.lower()
-            # Skip hop-by-hop and encoding headers we might have changed or handled differently
-            if k_low in ('content-encoding', 'transfer-encoding', 'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'upgrade'):
+            # Skip hop-by-hop and encoding headers we might have changed or handled differently;
+            # Content-Length is recomputed together with the message framing
+            if k_low in HOP_BY_HOP_HEADERS or k_low == 'content-length':
+                continue
+            if k_low == 'content-encoding' and not raw:
                 continue
-            if headers_mod and key in headers_mod:
+            if k_low in overridden:
                 continue
             # Content-Type needs to be preserved exactly
             self.send_header(key, value)
         
         # Add/Override headers
-        if headers_mod:
-            for key, value in headers_mod.items():
+        for key, value in headers_mod.items():
+            if key.lower() != 'content-length':
                 self.send_header(key, value)
-        
-        self.end_headers()
-        
-        if override_content:
+
+    def _send_proxied_response(self, response, override_content=None, headers_mod=None):
+        self._send_upstream_headers(response, headers_mod, raw=override_content is None)
+
+        if response.status_code in (204, 304) or response.status_code < 200:
+            # No message body allowed
+            self.end_headers()
+            return
+
+        if override_content is not None:
+            self.send_header('Content-Length', str(len(override_content)))
+            self.end_headers()
             self.wfile.write(override_content)
+            return
+
+        # The body is relayed still content-encoded, so Mayan's length applies as is
+        # (a malformed one is dropped and the body sent chunked)
+        upstream_length = _content_length(response.headers)
+        if upstream_length is not None:
+            self.send_header('Content-Length', str(upstream_length))
+            self.end_headers()
+            chunked = False
         else:
-            # Stream the content if not overridden
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    self.wfile.write(chunk)
+            chunked = self._end_headers_streaming()
 
-    def _fix_data(self, data):
-        """Recursively find and fix 'Unable to find serializer' strings and internal URLs."""
-        if not isinstance(data, (dict, list)):
-            return False
-        
-        changed = False
+        # Stream the raw bytes (only the transfer framing is undone by urllib3)
+        for chunk in self._recorded(response.raw.stream(8192, decode_content=False)):
+            if chunk:
+                self._write_body(chunk, chunked)
+        self._finish_body(chunked)
+
+    def _recorded(self, chunks):
+        """Mayan's body chunks, copied into the traffic recording on their way through."""
+        return self._recording.tap(chunks) if self._recording is not None else chunks
+
+    def _end_headers_streaming(self):
+        """End the header block for a body of unknown length. Returns True if it will be chunked."""
+        if self.request_version == 'HTTP/1.1':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            return True
+        # HTTP/1.0 client: delimit the body by closing the connection
+        self.send_header('Connection', 'close')
+        self.close_connection = True
+        self.end_headers()
+        return False
+
+    def _write_body(self, data, chunked):
+        if not data:
+            return
+        if chunked:
+            self.wfile.write(b"%x\r\n%b\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def _finish_body(self, chunked):
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def _proxy_base(self):
         host = self.headers.get('Host', f"localhost:{PORT}")
         proto = "https" if self.headers.get('X-Forwarded-Proto') == 'https' else "http"
-        proxy_base = f"{proto}://{host}"
-
-        # 1. Broad URL Rewrite: Catch any string that looks like an internal Mayan URL
-        if isinstance(data, dict):
-            for k, v in list(data.items()):
-                if isinstance(v, str):
-                    for t_url in TARGET_URLS:
-                        if t_url in v:
-                            data[k] = v.replace(t_url, proxy_base)
-                            changed = True
-                elif isinstance(v, (dict, list)):
-                    if self._fix_data(v):
-                        changed = True
-        
-        elif isinstance(data, list):
-            for i, item in enumerate(data):
-                if isinstance(item, (dict, list)):
-                    if self._fix_data(item):
-                        changed = True
-                elif isinstance(item, str):
-                    for t_url in TARGET_URLS:
-                        if t_url in item:
-                            data[i] = item.replace(t_url, proxy_base)
-                            changed = True
-
-        # 2. Specific Event Fixes (only for dicts that look like events)
-        if isinstance(data, dict) and 'verb' in data:
-            # Check for trashed_document_deleted event
-            verb = data.get('verb', {})
-            verb_id = verb.get('id') if isinstance(verb, dict) else str(verb)
-            
-            if "trashed_document_deleted" in verb_id:
-                # Fix 'target' field
-                target = data.get('target')
-                is_unable = isinstance(target, str) and "Unable to find serializer" in target
-                obj_id = data.get('target_object_id')
-                
-                # Always create/update target dict for trashed_document_deleted
-                if is_unable or not isinstance(target, dict):
-                    data['target'] = {'id': int(obj_id) if obj_id is not None else None}
-                    target = data['target']
-                    changed = True
-                    logger.debug(f"Fixed 'Unable to find serializer' for event {data.get('id')}")
-                else:
-                    target = data['target']
-                
-                # Determine document_id based on target content type
-                target_ct = data.get('target_content_type', {})
-                model = target_ct.get('model') if isinstance(target_ct, dict) else None
-                
-                if model == 'document':
-                    # target_object_id IS the document id when target is Document
-                    if target.get('document_id') != (int(obj_id) if obj_id is not None else None):
-                        target['document_id'] = int(obj_id) if obj_id is not None else None
-                        changed = True
-                        logger.info(f"Event {data.get('id')}: Set document_id={obj_id} (from Document target)")
-                    # Add document_type for extraction: document_data.get('document_type', {}).get('label')
-                    if 'document_type' not in target or not isinstance(target.get('document_type'), dict):
-                        doc_type_id = _get_document_type_id_from_document(obj_id)
-                        doc_type_label = _get_document_type_label(doc_type_id)
-                        if doc_type_label is not None:
-                            target['document_type'] = {'id': int(doc_type_id), 'label': doc_type_label}
-                            changed = True
-
-                elif model == 'documenttype':
-                    # target_object_id is the document TYPE id, NOT the deleted doc id
-                    # Look up real document_id from TrashedDocumentDeletedInfo by event_id
-                    event_id = data.get('id')
-                    doc_id = _get_document_id_for_event(event_id)
-                    
-                    if doc_id:
-                        target['id'] = int(doc_id)
-                        target['document_id'] = int(doc_id)
-                        changed = True
-                        logger.info(f"Event {event_id}: Set id={doc_id} and document_id={doc_id} (from DB lookup, doc_type={obj_id})")
-                    else:
-                        target['document_id'] = None
-                        changed = True
-                        logger.warning(f"Event {event_id}: Could not find document_id in DB for doc_type={obj_id}")
-                    # Add document_type for extraction: document_data.get('document_type', {}).get('label')
-                    doc_type_id = obj_id or target.get('document_type_id')
-                    if target.pop('document_type_id', None) is not None:
-                        changed = True
-                    if ('document_type' not in target or not isinstance(target.get('document_type'), dict)) and doc_type_id is not None:
-                        doc_type_label = _get_document_type_label(doc_type_id)
-                        if doc_type_label is not None:
-                            target['document_type'] = {'id': int(doc_type_id), 'label': doc_type_label}
-                            changed = True
-                
-        return changed
+        return f"{proto}://{host}"
 
-if __name__ == "__main__":
-    socketserver.TCPServer.allow_reuse_address = True
-    with socketserver.TCPServer(("", PORT), MayanProxyHandler) as httpd:
-        logger.info("\n=======================================")
-        logger.info("   MAYAN EVENT ENRICHMENT PROXY STARTED")
-        logger.info("=======================================")
-        logger.info(f" Listening on: http://localhost:{PORT}")
-        logger.info(f" Forwarding to: {TARGET_URL}")
-        logger.info("=======================================\n")
+    def _fix_data(self, data):
+        return _fix_events_data(data, self._proxy_base(), self._enrichment)
+
+
+class _ConnectionTracker:
+    """Client connections held by one server, so a worker can drain on shutdown.
+
+    A keep-alive connection is idle while waiting for its next request line and
+    busy while a request is served. Draining closes the idle ones at once and
+    waits for the busy ones to finish their current request.
+    """
+
+    def __init__(self):
+        self.draining = False
+        self._busy = {}
+        self._cond = threading.Condition()
+
+    def add(self, conn):
+        with self._cond:
+            self._busy[conn] = False
+
+    def remove(self, conn):
+        with self._cond:
+            self._busy.pop(conn, None)
+            self._cond.notify_all()
+
+    def set_busy(self, conn, busy):
+        with self._cond:
+            if conn in self._busy:
+                self._busy[conn] = busy
+
+    def drain(self, timeout):
+        """Close idle connections and wait up to `timeout` seconds for the rest.
+
+        Returns the number of connections still open afterwards.
+        """
+        with self._cond:
+            self.draining = True
+            for conn, busy in self._busy.items():
+                if not busy:
+                    # Wakes the handler blocked on reading the next request line
+                    try:
+                        conn.shutdown(socket.SHUT_RD)
+                    except OSError:
+                        pass
+            self._cond.wait_for(lambda: not self._busy, timeout)
+            return len(self._busy)
+
+
+class _IdleConnections(threading.Thread):
+    """Keep-alive connections waiting for their next request, watched by one selector.
+
+    A parked connection is handed to `dispatch` as soon as it is readable (a new
+    request, or the client closing it), so idle clients hold no worker thread.
+    Connections parked for longer than `idle_timeout`, or the oldest one when
+    evict_oldest() is called, are handed to `close` instead.
+    """
+
+    def __init__(self, dispatch, close, idle_timeout=CLIENT_IDLE_TIMEOUT):
+        super().__init__(name="proxy-idle-connections", daemon=True)
+        self.idle_timeout = idle_timeout
+        self._dispatch = dispatch
+        self._close = close
+        # conn -> (client_address, deadline); parked in order, so the oldest comes first
+        self._parked = OrderedDict()
+        self._commands = deque()
+        self._closing = False
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+
+    def __len__(self):
+        return len(self._parked)
+
+    def park(self, conn, client_address):
+        self._command("park", conn, client_address)
+
+    def evict_oldest(self):
+        self._command("evict")
+
+    def close_all(self):
+        """Close every parked connection, and those parked from now on."""
+        self._command("close_all")
+
+    def stop(self):
+        self._command("exit")
+
+    def _command(self, *command):
+        # The selector and _parked are only touched on this thread
+        self._commands.append(command)
+        try:
+            self._waker.send(b"\0")
+        except OSError:
+            # Buffer full: a wakeup is already pending
+            pass
+
+    def run(self):
+        while True:
+            timeout = None
+            if self._parked:
+                _, deadline = next(iter(self._parked.values()))
+                timeout = max(0.0, deadline - time.monotonic())
+            for key, _ in self._selector.select(timeout):
+                if key.fileobj is self._wakeup:
+                    try:
+                        while self._wakeup.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                client_address, _ = self._unpark(key.fileobj)
+                self._dispatch(key.fileobj, client_address)
+            while self._commands:
+                command, *args = self._commands.popleft()
+                if command == "park":
+                    self._park(*args)
+                elif command == "evict" and self._parked:
+                    conn = next(iter(self._parked))
+                    self._close(conn, self._unpark(conn)[0])
+                elif command == "close_all":
+                    self._closing = True
+                    for conn in list(self._parked):
+                        self._close(conn, self._unpark(conn)[0])
+                elif command == "exit":
+                    self._selector.close()
+                    self._wakeup.close()
+                    self._waker.close()
+                    return
+            now = time.monotonic()
+            while self._parked:
+                conn, (client_address, deadline) = next(iter(self._parked.items()))
+                if deadline > now:
+                    break
+                self._unpark(conn)
+                self._close(conn, client_address)
+
+    def _park(self, conn, client_address):
+        if self._closing:
+            self._close(conn, client_address)
+            return
+        try:
+            self._selector.register(conn, selectors.EVENT_READ)
+        except (ValueError, OSError):
+            # Closed meanwhile (e.g. by a drain)
+            self._close(conn, client_address)
+            return
+        self._parked[conn] = (client_address, time.monotonic() + self.idle_timeout)
+
+    def _unpark(self, conn):
+        self._selector.unregister(conn)
+        return self._parked.pop(conn)
+
+
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    """TCPServer that hands readable client connections to a bounded worker pool.
+
+    A worker serves a connection's request (and any pipelined behind it), then
+    parks the connection in _IdleConnections until the next request arrives, so
+    idle keep-alive clients don't occupy workers. At most `max_connections`
+    client connections are held at once; at the limit the longest-idle one is
+    closed to admit a new client, or the accept loop stops pulling from the
+    listen backlog until a busy connection finishes.
+    """
+    allow_reuse_address = True
+    request_queue_size = PROXY_LISTEN_BACKLOG
+
+    def __init__(self, server_address, handler_class, workers=PROXY_WORKERS, max_connections=PROXY_MAX_CONNECTIONS, reuse_port=False):
+        self.reuse_port = reuse_port
+        self.connections = _ConnectionTracker()
+        # Created before binding so server_close() works if the bind fails
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="proxy-worker")
+        self._connection_slots = threading.BoundedSemaphore(max_connections)
+        self.idle_connections = _IdleConnections(self._dispatch, self._close_connection)
+        super().__init__(server_address, handler_class)
+        self.idle_connections.start()
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        if not self._connection_slots.acquire(blocking=False):
+            self.idle_connections.evict_oldest()
+            self._connection_slots.acquire()
+        self.connections.add(request)
+        # Served once its first request arrives
+        self.idle_connections.park(request, client_address)
+
+    def _dispatch(self, request, client_address):
+        try:
+            self._executor.submit(self._process_request_worker, request, client_address)
+        except RuntimeError:
+            # Executor already shut down (server is stopping)
+            self._close_connection(request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        keep_alive = False
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+            keep_alive = not handler.close_connection and not self.connections.draining
+        except Exception:
+            self.handle_error(request, client_address)
+        if keep_alive:
+            self.idle_connections.park(request, client_address)
+        else:
+            self._close_connection(request, client_address)
+
+    def _close_connection(self, request, client_address=None):
+        self.shutdown_request(request)
+        self.connections.remove(request)
+        self._connection_slots.release()
+
+    def drain(self, timeout=PROXY_DRAIN_TIMEOUT):
+        """Stop listening and let in-flight requests finish; call after serve_forever returns."""
+        self.socket.close()
+        self.idle_connections.close_all()
+        return self.connections.drain(timeout)
+
+    def server_close(self):
+        super().server_close()
+        self.idle_connections.stop()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class _ClientConnection:
+    """A client socket as the asyncio engine hands it to the handler.
+
+    The event loop reads each request's head itself; the handler's rfile returns
+    those bytes (`unread`) before reading from the socket again.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.unread = b""
+
+    def makefile(self, mode, buffering=-1):
+        if "r" in mode:
+            return io.BufferedReader(_ClientConnectionReader(self))
+        return self.sock.makefile(mode, buffering)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class _ClientConnectionReader(io.RawIOBase):
+    def __init__(self, connection):
+        self._connection = connection
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        connection = self._connection
+        if connection.unread:
+            n = min(len(buffer), len(connection.unread))
+            buffer[:n] = connection.unread[:n]
+            connection.unread = connection.unread[n:]
+            return n
+        try:
+            return connection.sock.recv_into(buffer)
+        except BlockingIOError:
+            return None
+
+
+# Request heads larger than this are handed to the handler unfinished (which rejects them)
+_MAX_REQUEST_HEAD = 65536
+
+
+class AsyncioHTTPServer:
+    """Client connections on an asyncio event loop; requests are served on a bounded executor.
+
+    The loop accepts connections, waits on idle keep-alive connections and reads
+    each request's head, so neither idle nor slow-to-send clients hold a worker.
+    The upstream client (requests) and the DB driver (psycopg2) are blocking, so
+    a request whose head has arrived is served on the executor. At most
+    `max_connections` connections are held; at the limit the longest-idle one is
+    closed to admit a new client. Exposes the same serve_forever/shutdown/
+    server_close surface as socketserver servers so __main__ can treat both
+    modes alike.
+    """
+
+    def __init__(self, server_address, handler_class, workers=PROXY_WORKERS, max_connections=PROXY_MAX_CONNECTIONS, reuse_port=False):
+        self.server_address = server_address
+        self.RequestHandlerClass = handler_class
+        self.workers = workers
+        self.max_connections = max_connections
+        self.connections = _ConnectionTracker()
+        self.socket = socket.create_server(server_address, backlog=PROXY_LISTEN_BACKLOG, reuse_port=reuse_port)
+        self.socket.setblocking(False)
+        self._loop = None
+        self._accept_task = None
+        self._executor = None
+        self._slots = None
+        # connection -> its task while waiting for a next request, longest idle first
+        self._idle = OrderedDict()
+        self._tasks = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.max_connections)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="proxy-worker")
+        self._accept_task = asyncio.current_task()
+        try:
+            while True:
+                if self._slots.locked() and self._idle:
+                    # Full: make room by closing the longest-idle keep-alive connection
+                    _, task = self._idle.popitem(last=False)
+                    task.cancel()
+                await self._slots.acquire()
+                try:
+                    sock, client_address = await self._loop.sock_accept(self.socket)
+                except OSError as e:
+                    self._slots.release()
+                    logger.error(f"Accept failed: {e}")
+                    continue
+                task = self._loop.create_task(self._serve_connection(sock, client_address))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # Drain while the loop still runs so idle connections see the drain and close
+            await self._loop.run_in_executor(None, self.drain)
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _serve_connection(self, sock, client_address):
+        sock.setblocking(False)
+        conn = _ClientConnection(sock)
+        self.connections.add(conn)
+        try:
+            while not self.connections.draining:
+                head = await self._read_request_head(conn)
+                if not head:
+                    break
+                conn.unread = head
+                keep_alive = await self._loop.run_in_executor(self._executor, self._handle_requests, conn, client_address)
+                if not keep_alive:
+                    break
+                # The handler left it in timeout mode; the loop needs it non-blocking
+                sock.setblocking(False)
+        finally:
+            self._idle.pop(conn, None)
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            sock.close()
+            self.connections.remove(conn)
+            self._slots.release()
+
+    async def _read_request_head(self, conn):
+        """The client's next request head and whatever followed it; b"" if it closed or timed out."""
+        self._idle[conn] = asyncio.current_task()
+        try:
+            data = await asyncio.wait_for(self._loop.sock_recv(conn.sock, _MAX_REQUEST_HEAD), CLIENT_IDLE_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            return b""
+        finally:
+            self._idle.pop(conn, None)
+        while data and b"\n\r\n" not in data and b"\n\n" not in data and len(data) < _MAX_REQUEST_HEAD:
+            try:
+                more = await asyncio.wait_for(self._loop.sock_recv(conn.sock, _MAX_REQUEST_HEAD), CLIENT_IO_TIMEOUT)
+            except (asyncio.TimeoutError, OSError):
+                return b""
+            if not more:
+                # Closed mid-head: the handler answers what arrived
+                break
+            data += more
+        return data
+
+    def _handle_requests(self, conn, client_address):
+        """Serve the request the loop read the head of (and any pipelined after it); True to keep the connection."""
+        try:
+            handler = self.RequestHandlerClass(conn, client_address, self)
+        except Exception as e:
+            logger.error(f"Connection from {client_address} failed: {e}")
+            return False
+        return not handler.close_connection and not self.connections.draining
+
+    def drain(self, timeout=PROXY_DRAIN_TIMEOUT):
+        """Stop listening and let in-flight requests finish (runs as the accept loop ends)."""
+        self.socket.close()
+        return self.connections.drain(timeout)
+
+    def shutdown(self):
+        if self._loop is not None and self._accept_task is not None:
+            self._loop.call_soon_threadsafe(self._accept_task.cancel)
+
+    def server_close(self):
+        self.socket.close()
+
+
+def make_server(server_address=("", PORT), mode=PROXY_MODE, reuse_port=False):
+    """Build the proxy server for the configured concurrency engine."""
+    if mode == "asyncio":
+        return AsyncioHTTPServer(server_address, MayanProxyHandler, reuse_port=reuse_port)
+    if mode != "threaded":
+        raise ValueError(f"Unknown PROXY_MODE {mode!r} (expected 'threaded' or 'asyncio')")
+    return ThreadPoolHTTPServer(server_address, MayanProxyHandler, reuse_port=reuse_port)
+
+
+def serve(reuse_port=False):
+    """Run one proxy server until SIGTERM or Ctrl-C, then drain in-flight requests."""
+    start_background_logging()
+    start_cache_listener()
+    start_upstream_health_checks()
+    start_traffic_recording()
+    with make_server(reuse_port=reuse_port) as httpd:
+        def _stop(signum, frame):
+            # shutdown() waits for serve_forever to return, so it can't run on this thread
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, _stop)
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
-            logger.info("\nProxy shutting down...")
+            pass
+        remaining = httpd.drain()
+        if remaining:
+            logger.warning(f"Closing with {remaining} connection(s) still busy after {PROXY_DRAIN_TIMEOUT}s")
+    stop_traffic_recording()
+    logger.info(f"Proxy process {os.getpid()} stopped")
+
+
+class PreforkSupervisor:
+    """Forks worker processes that each run serve() on a SO_REUSEPORT socket.
+
+    The kernel spreads incoming connections across the workers, so JSON parsing
+    and enrichment scale past the GIL. Workers that die are restarted (after a
+    pause if they died right after starting); SIGTERM or SIGINT is forwarded to
+    every worker, which stops accepting and drains before exiting.
+    """
+
+    RESTART_DELAY = 1.0
+
+    def __init__(self, processes=PROXY_PROCESSES):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("PROXY_PROCESSES > 1 needs SO_REUSEPORT, which this platform lacks")
+        self.processes = processes
+        self._workers = {}
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        for _ in range(self.processes):
+            self._spawn()
+        while not self._stopping:
+            self._reap(restart=True)
+            time.sleep(0.2)
+        self._stop_workers()
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            # Child: default signal handling, then serve until told to stop
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                serve(reuse_port=True)
+            except Exception:
+                logger.exception("Proxy worker crashed")
+                code = 1
+            finally:
+                stop_background_logging()
+                logging.shutdown()
+                os._exit(code)
+        self._workers[pid] = time.monotonic()
+        logger.info(f"Started proxy worker {pid}")
+
+    def _reap(self, restart):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self._workers.pop(pid, None)
+            if started is None:
+                continue
+            if not restart or self._stopping:
+                continue
+            logger.warning(f"Proxy worker {pid} exited ({self._describe_status(status)}), restarting")
+            if time.monotonic() - started < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY)
+            self._spawn()
+
+    @staticmethod
+    def _describe_status(status):
+        if os.WIFSIGNALED(status):
+            return f"signal {os.WTERMSIG(status)}"
+        return f"exit code {os.WEXITSTATUS(status)}"
+
+    def _stop_workers(self):
+        logger.info(f"Stopping {len(self._workers)} proxy worker(s)...")
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + PROXY_DRAIN_TIMEOUT + 2
+        while self._workers and time.monotonic() < deadline:
+            self._reap(restart=False)
+            time.sleep(0.1)
+        for pid in self._workers:
+            logger.warning(f"Proxy worker {pid} did not stop in time, killing it")
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+
+if __name__ == "__main__":
+    logger.info("\n=======================================")
+    logger.info("   MAYAN EVENT ENRICHMENT PROXY STARTED")
+    logger.info("=======================================")
+    logger.info(f" Listening on: http://localhost:{PORT}")
+    logger.info(f" Forwarding to: {', '.join(UPSTREAM_URLS)}")
+    logger.info(f" Engine: {PROXY_MODE} ({PROXY_WORKERS} workers, {PROXY_MAX_CONNECTIONS} max connections)")
+    logger.info(f" Processes: {PROXY_PROCESSES}")
+    logger.info(f" JSON codec: {_json_codec.name}")
+    logger.info("=======================================\n")
+    start_background_logging()
+    if PROXY_PROCESSES > 1:
+        PreforkSupervisor().run()
+    else:
+        serve()
+    logger.info("Proxy shut down")
@@ -0,0 +1,425 @@
+"""Benchmark harness for mayan_proxy.py.
+
+Starts a stub Mayan upstream serving synthetic events pages and the proxy in
+front of it (each in its own process), drives GET requests at several
+concurrency levels and prints one JSON document with throughput, latency
+percentiles and peak proxy RSS per level. The proxy is restarted for every
+level so each peak RSS is measured from a cold process.
+
+Enrichment lookups go to a fake in-process database by default (optionally
+with a per-query delay), with the lookup and page caches off so every page is
+enriched. With --db postgres they go to the Postgres configured through the
+usual DB_* environment variables and the caches work as in production (add
+--env EVENTS_CACHE_TTL=0 to measure enrichment rather than page cache hits).
+
+    python mayan_proxy_bench.py --concurrency 1,8,32 --page-size 50 \\
+        --trashed-share 0.3 --output before.json
+    python mayan_proxy_bench.py --concurrency 1,8,32 --page-size 50 \\
+        --trashed-share 0.3 --compare before.json
+
+Extra proxy settings are passed with --env, e.g. --env STREAM_REWRITE=1.
+"""
+import argparse
+import http.client
+import http.server
+import json
+import os
+import platform
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+UPSTREAM_BASE = "http://mayan-app:8000"
+DOCUMENT_TYPES = 50
+
+
+def synthetic_events_page(page, page_size, trashed_share):
+    """One Mayan events API page; every 1/trashed_share-th event is a trashed_document_deleted one."""
+    results = []
+    trashed_every = round(1 / trashed_share) if trashed_share > 0 else 0
+    first_id = 1_000_000 - page * page_size
+    for index in range(page_size):
+        event_id = first_id - index
+        document_id = event_id % 100_000 + 1
+        event = {
+            "actor": {"id": 1, "url": f"{UPSTREAM_BASE}/api/v4/users/1/", "username": "admin"},
+            "actor_content_type": {"app_label": "auth", "id": 4, "model": "user"},
+            "action_object": None,
+            "action_object_content_type": None,
+            "id": event_id,
+            "target": {
+                "id": document_id,
+                "label": f"document-{document_id}.pdf",
+                "url": f"{UPSTREAM_BASE}/api/v4/documents/{document_id}/",
+                "file_list_url": f"{UPSTREAM_BASE}/api/v4/documents/{document_id}/files/",
+            },
+            "target_content_type": {"app_label": "documents", "id": 23, "model": "document"},
+            "target_object_id": str(document_id),
+            "timestamp": "2024-01-01T00:00:00.000000Z",
+            "url": f"{UPSTREAM_BASE}/api/v4/events/{event_id}/",
+            "verb": {"id": "documents.document_create", "label": "Document created"},
+        }
+        if trashed_every and index % trashed_every == 0:
+            event["verb"] = {"id": "documents.trashed_document_deleted", "label": "Trashed document deleted"}
+            event["target"] = "Unable to find serializer for object"
+            if index % 2:
+                # Deleted through its document type: the document id comes from the DB
+                event["target_content_type"] = {"app_label": "documents", "id": 21, "model": "documenttype"}
+                event["target_object_id"] = str(document_id % DOCUMENT_TYPES + 1)
+        results.append(event)
+    return {
+        "count": 100 * page_size,
+        "next": f"{UPSTREAM_BASE}/api/v4/events/?page={page + 2}",
+        "previous": f"{UPSTREAM_BASE}/api/v4/events/?page={page}" if page else None,
+        "results": results,
+    }
+
+
+class FakeLookupDB:
+    """Stands in for mayan_proxy's DBPool: answers the prepared lookups from arithmetic.
+
+    `latency` seconds are slept per query to model a database round trip.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.queries = 0
+
+    def execute(self, name, params):
+        self.queries += 1
+        if self.latency:
+            time.sleep(self.latency)
+        ids = params[0]
+        if name == "mp_event_document_ids":
+            return [(event_id, event_id % 100_000 + 1) for event_id in ids]
+        if name in ("mp_document_type_ids", "mp_trashed_document_type_ids"):
+            return [(doc_id, doc_id % DOCUMENT_TYPES + 1) for doc_id in ids]
+        if name == "mp_document_type_labels":
+            return [(type_id, f"Type {type_id}") for type_id in ids if type_id <= DOCUMENT_TYPES]
+        raise KeyError(name)
+
+    def stats(self):
+        return {"fake": True, "queries": self.queries, "max": 0, "idle": 0, "in_use": 0}
+
+
+def run_upstream(args):
+    """Stub Mayan: serves pre-rendered events pages (page=N cycles through --pages of them)."""
+    pages = [
+        json.dumps(synthetic_events_page(page, args.page_size, args.trashed_share)).encode("utf-8")
+        for page in range(args.pages)
+    ]
+    latency = args.upstream_latency_ms / 1000
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            return
+
+        def do_GET(self):
+            page = 0
+            if "page=" in self.path:
+                page = int(self.path.split("page=")[1].split("&")[0]) % len(pages)
+            if latency:
+                time.sleep(latency)
+            body = pages[page]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+        request_queue_size = 1024
+
+    Server(("127.0.0.1", args.port), Handler).serve_forever()
+
+
+def run_proxy(args):
+    """The proxy under test, configured through the environment before it is imported."""
+    os.environ["PROXY_PORT"] = str(args.port)
+    os.environ["TARGET_URL"] = f"http://127.0.0.1:{args.upstream_port}"
+    os.environ.pop("UPSTREAM_URLS", None)
+    # The proxy under test must not record the benchmark traffic (or a replay over its recording)
+    os.environ.pop("RECORD_DIR", None)
+    if args.db == "fake":
+        # No NOTIFY source, so the lookup and page caches stay off and every page is enriched
+        os.environ.setdefault("LOOKUP_CACHE_SIZE", "0")
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import mayan_proxy
+
+    logging.getLogger("MayanProxy").setLevel(args.proxy_log_level)
+    if args.db == "fake":
+        mayan_proxy._db_pool = FakeLookupDB(args.fake_db_latency_ms / 1000)
+    if mayan_proxy.PROXY_PROCESSES > 1:
+        mayan_proxy.PreforkSupervisor().run()
+    else:
+        mayan_proxy.serve()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, process, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"process exited with code {process.returncode} before listening on {port}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+
+def _child_args(args, role, port):
+    argv = [sys.executable, os.path.abspath(__file__), role, "--port", str(port)]
+    for name in ("upstream_port", "page_size", "trashed_share", "pages", "upstream_latency_ms",
+                 "db", "fake_db_latency_ms", "proxy_log_level"):
+        argv += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    for item in args.env:
+        argv += ["--env", item]
+    return argv
+
+
+def _process_tree(pid):
+    """pid plus all its descendants (Linux /proc); just pid elsewhere."""
+    pids, index = [pid], 0
+    while index < len(pids):
+        try:
+            for task in os.listdir(f"/proc/{pids[index]}/task"):
+                with open(f"/proc/{pids[index]}/task/{task}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+        index += 1
+    return pids
+
+
+def _peak_rss_kib(pid):
+    """Sum of VmHWM (kernel-tracked peak RSS) over the proxy and its workers, or None."""
+    total = None
+    for member in _process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total = (total or 0) + int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def drive_load(port, concurrency, total_requests, pages, accept_encoding):
+    """Send `total_requests` GETs from `concurrency` keep-alive clients; returns latencies and error count."""
+    latencies = []
+    errors = [0]
+    counter = iter(range(total_requests))
+    lock = threading.Lock()
+    headers = {"Host": f"127.0.0.1:{port}"}
+    if accept_encoding:
+        headers["Accept-Encoding"] = accept_encoding
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        own = []
+        failed = 0
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                break
+            start = time.perf_counter()
+            try:
+                conn.request("GET", f"/api/v4/events/?page={index % pages}", headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                continue
+            own.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def bench_level(args, concurrency):
+    port = _free_port()
+    proxy = subprocess.Popen(_child_args(args, "_proxy", port), stdout=subprocess.DEVNULL)
+    try:
+        _wait_for_port(port, proxy)
+        if args.warmup:
+            drive_load(port, min(concurrency, args.warmup), args.warmup, args.pages, args.accept_encoding)
+        started = time.perf_counter()
+        latencies, errors = drive_load(port, concurrency, args.requests, args.pages, args.accept_encoding)
+        elapsed = time.perf_counter() - started
+        peak_rss = _peak_rss_kib(proxy.pid)
+    finally:
+        proxy.terminate()
+        try:
+            _, _, usage = os.wait4(proxy.pid, 0)
+        except ChildProcessError:
+            usage = None
+    if peak_rss is None and usage is not None:
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        peak_rss = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(_percentile(latencies, 0.50)),
+            "p95": ms(_percentile(latencies, 0.95)),
+            "p99": ms(_percentile(latencies, 0.99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "peak_rss_mib": round(peak_rss / 1024, 1) if peak_rss is not None else None,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current):
+    """Human-readable deltas against an earlier result file, on stderr."""
+    before = {level["concurrency"]: level for level in baseline["results"]}
+    print(f"vs {baseline.get('revision') or 'baseline'}:", file=sys.stderr)
+    for level in current["results"]:
+        old = before.get(level["concurrency"])
+        if old is None:
+            continue
+        deltas = []
+        for label, new_value, old_value in (
+            ("rps", level["throughput_rps"], old["throughput_rps"]),
+            ("p50", level["latency_ms"]["p50"], old["latency_ms"]["p50"]),
+            ("p99", level["latency_ms"]["p99"], old["latency_ms"]["p99"]),
+            ("rss", level["peak_rss_mib"], old["peak_rss_mib"]),
+        ):
+            if new_value is None or not old_value:
+                continue
+            deltas.append(f"{label} {old_value} -> {new_value} ({(new_value - old_value) / old_value:+.1%})")
+        print(f"  c={level['concurrency']}: " + ", ".join(deltas), file=sys.stderr)
+
+
+def run_benchmark(args):
+    args.upstream_port = _free_port()
+    upstream = subprocess.Popen(_child_args(args, "_upstream", args.upstream_port), stdout=subprocess.DEVNULL)
+    try:
+        _wait_for_port(args.upstream_port, upstream)
+        results = [bench_level(args, concurrency) for concurrency in args.concurrency]
+    finally:
+        upstream.terminate()
+        upstream.wait()
+    report = {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "page_size": args.page_size,
+            "trashed_share": args.trashed_share,
+            "pages": args.pages,
+            "upstream_latency_ms": args.upstream_latency_ms,
+            "db": args.db,
+            "fake_db_latency_ms": args.fake_db_latency_ms if args.db == "fake" else None,
+            "accept_encoding": args.accept_encoding,
+            "env": dict(item.partition("=")[::2] for item in args.env),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+def _concurrency_levels(value):
+    return [int(level) for level in value.split(",") if level.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark mayan_proxy.py against a stub Mayan upstream.")
+    parser.add_argument("role", nargs="?", default="bench", choices=("bench", "_upstream", "_proxy"),
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--concurrency", type=_concurrency_levels, default=[1, 8, 32],
+                        help="comma-separated client concurrency levels (default: 1,8,32)")
+    parser.add_argument("--requests", type=int, default=2000, help="measured requests per level")
+    parser.add_argument("--warmup", type=int, default=100, help="unmeasured requests before each level")
+    parser.add_argument("--page-size", type=int, default=50, help="events per page")
+    parser.add_argument("--trashed-share", type=float, default=0.2,
+                        help="share of trashed_document_deleted events per page (0 to 1)")
+    parser.add_argument("--pages", type=int, default=20, help="distinct pages the requests cycle through")
+    parser.add_argument("--upstream-latency-ms", type=float, default=0.0, help="delay added by the stub upstream")
+    parser.add_argument("--db", choices=("fake", "postgres"), default="fake",
+                        help="lookup database: in-process fake, or the Postgres from DB_* variables")
+    parser.add_argument("--fake-db-latency-ms", type=float, default=0.0, help="delay per fake DB query")
+    parser.add_argument("--accept-encoding", default="", help="Accept-Encoding sent by the clients")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra proxy environment setting (repeatable)")
+    parser.add_argument("--proxy-log-level", default="INFO", help="MayanProxy logger level in the proxy")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--compare", help="print deltas against an earlier JSON report (stderr)")
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--upstream-port", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.role == "_upstream":
+        run_upstream(args)
+    elif args.role == "_proxy":
+        run_proxy(args)
+    else:
+        run_benchmark(args)
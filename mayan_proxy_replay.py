@@ -0,0 +1,361 @@
+"""Replay traffic recorded by mayan_proxy.py (RECORD_DIR) against a stub Mayan.
+
+Starts a stub upstream that answers every request with what Mayan answered
+when it was recorded (same status, headers, body and latency; bodies that were
+too large to record are stood in for by bytes of the same size) and the proxy
+in front of it, each in its own process. The recorded requests are then sent
+to the proxy on their original schedule, sped up by --speed (0: as fast as
+--clients allow), and one JSON document is printed with throughput, latency
+percentiles per route class, how far sends fell behind the schedule, status
+mismatches against the recording and peak proxy RSS.
+
+Enrichment lookups go to the benchmark's fake in-process database unless
+--db postgres is given (see mayan_proxy_bench.py).
+
+    RECORD_DIR=/var/lib/mayan-proxy/traffic python mayan_proxy.py
+    python mayan_proxy_replay.py /var/lib/mayan-proxy/traffic/traffic-*.jsonl \\
+        --speed 4 --output before.json
+    python mayan_proxy_replay.py /var/lib/mayan-proxy/traffic/traffic-*.jsonl \\
+        --speed 4 --compare before.json
+
+Extra proxy settings are passed with --env, e.g. --env STREAM_REWRITE=1.
+Requests to /__proxy/ endpoints (stats, metrics, the events feed) are not
+recorded, so they are not replayed either.
+"""
+import argparse
+import base64
+import http.client
+import http.server
+import itertools
+import json
+import os
+import platform
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+from mayan_proxy_bench import (
+    _free_port, _git_revision, _peak_rss_kib, _percentile, _wait_for_port, run_proxy,
+)
+
+# Response bodies that were not recorded are served as repeats of this block
+FILLER = b"\0" * (64 * 1024)
+
+
+def read_recording(paths, bodies=True):
+    """Exchanges from recording files, in arrival order (with "at": seconds since the first), and the bodies by id.
+
+    Files of several proxy processes are merged on their wall-clock start. A
+    line cut short by a process that died while writing ends that file.
+    """
+    exchanges, body_data = [], {}
+    for path in paths:
+        started = None
+        with open(path, encoding="ascii") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print(f"{path}: stopped at a truncated line", file=sys.stderr)
+                    break
+                kind = entry.get("type")
+                if kind == "session":
+                    started = entry["started"]
+                elif kind == "exchange":
+                    entry["at"] = started + entry["t"]
+                    exchanges.append(entry)
+                elif kind == "body" and bodies:
+                    body_data[entry["id"]] = zlib.decompress(base64.b64decode(entry["data"]))
+    exchanges.sort(key=lambda entry: entry["at"])
+    if exchanges:
+        first = exchanges[0]["at"]
+        for entry in exchanges:
+            entry["at"] -= first
+    return exchanges, body_data
+
+
+def run_upstream(args):
+    """Stub Mayan: answers each method and path with its recorded responses, in recorded order (cycling).
+
+    A request without conditionals is never answered with a recorded 304 (the
+    proxy under test may cache differently than the recorded one did).
+    """
+    exchanges, bodies = read_recording(args.recording)
+    responses = {}
+    for entry in exchanges:
+        if entry["upstream"] is not None:
+            responses.setdefault((entry["method"], entry["path"]), []).append(entry["upstream"])
+    cursors, full_cursors = {}, {}
+    for key, recorded in responses.items():
+        cursors[key] = itertools.cycle(recorded)
+        full = [response for response in recorded if response["status"] != 304]
+        if full:
+            full_cursors[key] = itertools.cycle(full)
+    lock = threading.Lock()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            return
+
+        def _read_request_body(self):
+            if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    self.rfile.read(size + 2)
+                    if size == 0:
+                        return
+            remaining = int(self.headers.get("Content-Length", 0))
+            while remaining:
+                remaining -= len(self.rfile.read(min(remaining, 64 * 1024)))
+
+        def _answer(self):
+            self._read_request_body()
+            key = (self.command, self.path)
+            conditional = self.headers.get("If-None-Match") or self.headers.get("If-Modified-Since")
+            with lock:
+                cursor = cursors.get(key) if conditional else full_cursors.get(key, cursors.get(key))
+                recorded = next(cursor) if cursor is not None else None
+            if recorded is None:
+                body = json.dumps({"detail": "Not in the recording."}).encode("utf-8")
+                self.send_response(404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if args.upstream_latency and recorded["ms"]:
+                time.sleep(recorded["ms"] / 1000)
+            body = bodies.get(recorded["body"], b"") if recorded["body"] else None
+            size = len(body) if body is not None else recorded["size"]
+            self.send_response(recorded["status"])
+            for key, value in recorded["headers"]:
+                if key.lower() not in ("server", "date"):
+                    self.send_header(key, value)
+            no_body = self.command == "HEAD" or recorded["status"] in (204, 304) or recorded["status"] < 200
+            if not no_body:
+                self.send_header("Content-Length", str(size))
+            self.end_headers()
+            if no_body:
+                return
+            if body is not None:
+                self.wfile.write(body)
+                return
+            while size:
+                block = FILLER[:size]
+                self.wfile.write(block)
+                size -= len(block)
+
+        do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = _answer
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+        request_queue_size = 1024
+
+        def handle_error(self, request, client_address):
+            # The proxy drops connections whose body it does not need (e.g. a download it has on disk)
+            if not isinstance(sys.exc_info()[1], ConnectionError):
+                super().handle_error(request, client_address)
+
+    Server(("127.0.0.1", args.port), Handler).serve_forever()
+
+
+def _child_args(args, role, port):
+    argv = [sys.executable, os.path.abspath(__file__), *args.recording, "--role", role, "--port", str(port)]
+    for name in ("upstream_port", "db", "fake_db_latency_ms", "proxy_log_level"):
+        argv += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    if not args.upstream_latency:
+        argv.append("--no-upstream-latency")
+    for item in args.env:
+        argv += ["--env", item]
+    return argv
+
+
+def drive_replay(port, exchanges, speed, clients):
+    """Send the recorded requests on schedule from up to `clients` keep-alive connections.
+
+    Returns one (route, seconds, lag, status, recorded status) tuple per request;
+    seconds and status are None when it failed to get an answer.
+    """
+    results = []
+    upload = b"\0" * max((entry["body_size"] for entry in exchanges), default=0)
+    queue_iter = iter(exchanges)
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        own = []
+        while True:
+            with lock:
+                entry = next(queue_iter, None)
+            if entry is None:
+                break
+            due = start + entry["at"] / speed if speed else time.perf_counter()
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            sent = time.perf_counter()
+            headers = dict(entry["headers"])
+            body = upload[:entry["body_size"]] if entry["body_size"] else None
+            try:
+                conn.request(entry["method"], entry["path"], body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+                if response.will_close:
+                    conn.close()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                own.append((entry["route"], None, sent - due, None, entry["status"]))
+                continue
+            own.append((entry["route"], time.perf_counter() - sent, sent - due, status, entry["status"]))
+        conn.close()
+        with lock:
+            results.extend(own)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def _summary(results, elapsed):
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    latencies = sorted(seconds for _, seconds, _, _, _ in results if seconds is not None)
+    lags = sorted(max(0.0, lag) for _, _, lag, _, _ in results)
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, seconds, _, status, _ in results if seconds is None or status >= 500),
+        "status_mismatches": sum(1 for _, _, _, status, recorded in results if status != recorded),
+        "throughput_rps": round(len(results) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(_percentile(latencies, 0.50)),
+            "p95": ms(_percentile(latencies, 0.95)),
+            "p99": ms(_percentile(latencies, 0.99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "schedule_lag_ms": {
+            "p50": ms(_percentile(lags, 0.50)),
+            "p99": ms(_percentile(lags, 0.99)),
+            "max": ms(lags[-1] if lags else None),
+        },
+    }
+
+
+def compare(baseline, current):
+    """Human-readable deltas against an earlier result file, on stderr."""
+    print(f"vs {baseline.get('revision') or 'baseline'}:", file=sys.stderr)
+    for route, level in current["routes"].items():
+        old = baseline["routes"].get(route)
+        if old is None:
+            continue
+        deltas = []
+        for label, new_value, old_value in (
+            ("p50", level["latency_ms"]["p50"], old["latency_ms"]["p50"]),
+            ("p99", level["latency_ms"]["p99"], old["latency_ms"]["p99"]),
+            ("errors", level["errors"], old["errors"]),
+        ):
+            if new_value is None or not old_value:
+                continue
+            deltas.append(f"{label} {old_value} -> {new_value} ({(new_value - old_value) / old_value:+.1%})")
+        print(f"  {route}: " + ", ".join(deltas), file=sys.stderr)
+    old_rss, new_rss = baseline.get("peak_rss_mib"), current.get("peak_rss_mib")
+    if old_rss and new_rss is not None:
+        print(f"  rss {old_rss} -> {new_rss} ({(new_rss - old_rss) / old_rss:+.1%})", file=sys.stderr)
+
+
+def run_replay(args):
+    exchanges, _ = read_recording(args.recording, bodies=False)
+    if args.limit:
+        exchanges = exchanges[:args.limit]
+    if not exchanges:
+        sys.exit("no exchanges in the recording")
+    args.upstream_port = _free_port()
+    port = _free_port()
+    upstream = subprocess.Popen(_child_args(args, "_upstream", args.upstream_port), stdout=subprocess.DEVNULL)
+    proxy = None
+    try:
+        _wait_for_port(args.upstream_port, upstream, timeout=120)
+        proxy = subprocess.Popen(_child_args(args, "_proxy", port), stdout=subprocess.DEVNULL)
+        _wait_for_port(port, proxy)
+        results, elapsed = drive_replay(port, exchanges, args.speed, args.clients)
+        peak_rss = _peak_rss_kib(proxy.pid)
+    finally:
+        if proxy is not None:
+            proxy.terminate()
+            proxy.wait()
+        upstream.terminate()
+        upstream.wait()
+    by_route = {}
+    for result in results:
+        by_route.setdefault(result[0], []).append(result)
+    report = {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "recording": [os.path.basename(path) for path in args.recording],
+            "recorded_duration_s": round(exchanges[-1]["at"], 3),
+            "speed": args.speed,
+            "clients": args.clients,
+            "upstream_latency": args.upstream_latency,
+            "db": args.db,
+            "fake_db_latency_ms": args.fake_db_latency_ms if args.db == "fake" else None,
+            "env": dict(item.partition("=")[::2] for item in args.env),
+        },
+        "duration_s": round(elapsed, 3),
+        "total": _summary(results, elapsed),
+        "routes": {route: _summary(route_results, elapsed) for route, route_results in sorted(by_route.items())},
+        "peak_rss_mib": round(peak_rss / 1024, 1) if peak_rss is not None else None,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded traffic through mayan_proxy.py against a stub Mayan.")
+    parser.add_argument("recording", nargs="+", help="recording files written by the proxy under RECORD_DIR")
+    parser.add_argument("--role", default="replay", choices=("replay", "_upstream", "_proxy"), help=argparse.SUPPRESS)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="schedule speed-up: 1 replays at the recorded pace, 0 as fast as possible")
+    parser.add_argument("--clients", type=int, default=64, help="maximum concurrent client connections")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N requests")
+    parser.add_argument("--no-upstream-latency", dest="upstream_latency", action="store_false",
+                        help="answer at once instead of with Mayan's recorded latency")
+    parser.add_argument("--db", choices=("fake", "postgres"), default="fake",
+                        help="lookup database: in-process fake, or the Postgres from DB_* variables")
+    parser.add_argument("--fake-db-latency-ms", type=float, default=0.0, help="delay per fake DB query")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra proxy environment setting (repeatable)")
+    parser.add_argument("--proxy-log-level", default="INFO", help="MayanProxy logger level in the proxy")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--compare", help="print deltas against an earlier JSON report (stderr)")
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--upstream-port", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.role == "_upstream":
+        run_upstream(args)
+    elif args.role == "_proxy":
+        run_proxy(args)
+    else:
+        run_replay(args)
@@ -0,0 +1,1048 @@
+"""Tests for mayan_proxy.py against a stub Mayan upstream, both served in-process."""
+import gzip
+import http.client
+import http.server
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mayan_proxy  # noqa: E402
+
+
+class StubMayanHandler(http.server.BaseHTTPRequestHandler):
+    """Events API that negotiates on Accept like DRF: the browsable API for browsers, else JSON."""
+
+    protocol_version = "HTTP/1.1"
+    requests_seen = 0
+    last_headers = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        StubMayanHandler.requests_seen += 1
+        StubMayanHandler.last_headers = self.headers
+        if "/download/" in self.path:
+            self.send_download()
+            return
+        if "hangup" in self.path:
+            # Close the kept-alive connection after answering, as an idle timeout would
+            self.close_connection = True
+        if "slow" in self.path:
+            # Long enough for concurrent identical requests to coalesce
+            time.sleep(0.3)
+        if "text/html" in self.headers.get("Accept", ""):
+            body, content_type = b"<html><body>Event list</body></html>", "text/html; charset=utf-8"
+        elif "trashed" in self.path:
+            body = json.dumps({"count": 1, "next": None, "previous": None, "results": [trashed_event(10, "documenttype", 5)]}).encode()
+            content_type = "application/json"
+        elif "bare" in self.path:
+            # Not a paginated page: a bare list of events
+            body = json.dumps([{"id": 1, "url": "http://mayan-app:8000/api/v4/events/1/"}]).encode()
+            content_type = "application/json"
+        else:
+            body = json.dumps({"count": 1, "next": None, "previous": None, "results": [{"id": 1}]}).encode()
+            content_type = "application/json"
+        vary = self.server.vary
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("X-Stub-Path", self.path)
+        if vary:
+            self.send_header("Vary", vary)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """Echo what arrived of the upload: Mayan only reads bodies with a Content-Length."""
+        StubMayanHandler.requests_seen += 1
+        length = self.headers.get("Content-Length")
+        data = self.rfile.read(int(length)) if length else b""
+        body = json.dumps({
+            "content_length": length,
+            "transfer_encoding": self.headers.get("Transfer-Encoding"),
+            "body": data.decode("latin-1"),
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_download(self):
+        body = b"d" * 1000
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("ETag", '"v1"')
+        if "badlength" in self.path:
+            self.send_header("Content-Length", "1000 bytes")
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        elif "truncated" in self.path:
+            self.send_header("Content-Length", str(len(body) * 2))
+            self.close_connection = True
+        else:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ProxyTestCase(unittest.TestCase):
+    """Runs the proxy in front of StubMayanHandler, with the events page cache live."""
+
+    upstream_vary = "Accept, Cookie"
+    engine = mayan_proxy.ThreadPoolHTTPServer
+    workers = 4
+
+    def setUp(self):
+        self.upstream = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubMayanHandler)
+        self.upstream.vary = self.upstream_vary
+        self.upstream.daemon_threads = True
+        threading.Thread(target=self.upstream.serve_forever, daemon=True).start()
+        self.addCleanup(self.upstream.server_close)
+        self.addCleanup(self.upstream.shutdown)
+        StubMayanHandler.requests_seen = 0
+
+        upstream_url = "http://127.0.0.1:%d" % self.upstream.server_address[1]
+        for patch in (
+            mock.patch.object(mayan_proxy, "_upstream_balancer", mayan_proxy.UpstreamBalancer([upstream_url])),
+            mock.patch.object(mayan_proxy._cache_listener, "live", True),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        mayan_proxy._events_page_cache.clear()
+        self.addCleanup(mayan_proxy._events_page_cache.clear)
+
+        self.proxy = self.engine(("127.0.0.1", 0), mayan_proxy.MayanProxyHandler, workers=self.workers)
+        self.port = self.proxy.socket.getsockname()[1]
+        threading.Thread(target=self.proxy.serve_forever, daemon=True).start()
+        self.addCleanup(self.proxy.server_close)
+        self.addCleanup(self.proxy.shutdown)
+
+    def get(self, path, headers=None, method="GET"):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        try:
+            connection.request(method, path, headers=headers or {})
+            response = connection.getresponse()
+            return response, response.read()
+        finally:
+            connection.close()
+
+
+class EventsPageCacheAcceptTests(ProxyTestCase):
+    def test_clients_with_different_accept_get_their_own_representation(self):
+        response, body = self.get("/api/v4/events/", {"Accept": "text/html"})
+        self.assertTrue(response.getheader("Content-Type").startswith("text/html"))
+
+        response, body = self.get("/api/v4/events/", {"Accept": "application/json"})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Type"), "application/json")
+        self.assertIsNone(response.getheader("X-Mayan-Cache"))
+        self.assertEqual(json.loads(body)["count"], 1)
+
+        # The JSON page is cached for JSON clients only
+        response, body = self.get("/api/v4/events/", {"Accept": "application/json"})
+        self.assertEqual(response.getheader("X-Mayan-Cache"), "HIT")
+        response, body = self.get("/api/v4/events/", {"Accept": "text/html"})
+        self.assertIsNone(response.getheader("X-Mayan-Cache"))
+        self.assertTrue(body.startswith(b"<html>"))
+        self.assertEqual(StubMayanHandler.requests_seen, 3)
+
+
+class EventsPageCacheVaryTests(ProxyTestCase):
+    upstream_vary = "Accept, X-Tenant"
+
+    def test_page_varying_on_headers_outside_the_key_is_not_cached(self):
+        for _ in range(2):
+            response, body = self.get("/api/v4/events/", {"Accept": "application/json"})
+            self.assertEqual(response.status, 200)
+            self.assertIsNone(response.getheader("X-Mayan-Cache"))
+        self.assertEqual(StubMayanHandler.requests_seen, 2)
+
+
+class CoalescingTests(ProxyTestCase):
+    def get_concurrently(self, path, headers, clients=3):
+        with ThreadPoolExecutor(clients) as pool:
+            return list(pool.map(lambda _: self.get(path, headers), range(clients)))
+
+    def test_concurrent_json_requests_share_one_page(self):
+        results = self.get_concurrently("/api/v4/events/?slow", {"Accept": "application/json"})
+        self.assertEqual(StubMayanHandler.requests_seen, 1)
+        self.assertEqual(sorted(r.getheader("X-Mayan-Cache") or "" for r, _ in results), ["", "COALESCED", "COALESCED"])
+        self.assertTrue(all(json.loads(body)["count"] == 1 for _, body in results))
+
+    def test_non_json_responses_are_not_shared(self):
+        results = self.get_concurrently("/api/v4/events/?slow", {"Accept": "text/html"})
+        self.assertEqual(StubMayanHandler.requests_seen, 3)
+        self.assertTrue(all(r.getheader("X-Mayan-Cache") is None for r, _ in results))
+        self.assertTrue(all(body.startswith(b"<html>") for _, body in results))
+
+
+def closed_port_url():
+    """A local URL nothing listens on, so connects to it are refused."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return "http://127.0.0.1:%d" % sock.getsockname()[1]
+
+
+class UpstreamFailoverTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dead_url = closed_port_url()
+        self.balancer = mayan_proxy.UpstreamBalancer([self.dead_url, mayan_proxy._upstream_balancer.backends[0].url])
+        patch = mock.patch.object(mayan_proxy, "_upstream_balancer", self.balancer)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_refused_connects_move_to_another_replica(self):
+        for _ in range(4):
+            response, _ = self.get("/api/v4/documents/")
+            self.assertEqual(response.status, 200)
+        stats = self.balancer.stats()
+        self.assertGreaterEqual(stats[self.dead_url]["connect_failures"], 1)
+        self.assertEqual(StubMayanHandler.requests_seen, 4)
+        # Released once the handler is done, just after the client has the response
+        deadline = time.monotonic() + 5
+        while any(backend.outstanding for backend in self.balancer.backends) and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual([backend.outstanding for backend in self.balancer.backends], [0, 0])
+
+    def test_no_failover_when_attempts_are_used_up(self):
+        with mock.patch.object(mayan_proxy, "UPSTREAM_FAILOVER_ATTEMPTS", 0):
+            statuses = {self.get("/api/v4/documents/")[0].status for _ in range(4)}
+        self.assertEqual(statuses, {200, 502})
+
+
+class UpstreamHealthTests(unittest.TestCase):
+    @staticmethod
+    def picks(balancer, requests=6):
+        picked = set()
+        for _ in range(requests):
+            backend = balancer.acquire()
+            balancer.release(backend)
+            picked.add(backend)
+        return picked
+
+    def test_failed_checks_take_a_replica_out_until_one_passes(self):
+        balancer = mayan_proxy.UpstreamBalancer(["http://a", "http://b"])
+        a, b = balancer.backends
+        for _ in range(mayan_proxy.UPSTREAM_HEALTH_FAILURES):
+            self.assertTrue(a.healthy)
+            balancer.check_result(a, False)
+        self.assertFalse(a.healthy)
+        self.assertEqual(self.picks(balancer), {b})
+        balancer.check_result(a, True)
+        self.assertEqual(self.picks(balancer), {a, b})
+
+    def test_all_replicas_down_are_still_used(self):
+        balancer = mayan_proxy.UpstreamBalancer(["http://a", "http://b"])
+        for backend in balancer.backends:
+            for _ in range(mayan_proxy.UPSTREAM_HEALTH_FAILURES):
+                balancer.check_result(backend, False)
+        self.assertEqual(self.picks(balancer), set(balancer.backends))
+
+    def test_checker_probes_each_replica(self):
+        upstream = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubMayanHandler)
+        upstream.vary = None
+        threading.Thread(target=upstream.serve_forever, daemon=True).start()
+        self.addCleanup(upstream.server_close)
+        self.addCleanup(upstream.shutdown)
+        live, dead = "http://127.0.0.1:%d" % upstream.server_address[1], closed_port_url()
+        balancer = mayan_proxy.UpstreamBalancer([live, dead])
+        for patch in (
+            mock.patch.object(mayan_proxy, "UPSTREAM_HEALTH_INTERVAL", 0.02),
+            mock.patch.object(mayan_proxy, "UPSTREAM_HEALTH_PATH", "/api/v4/"),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        mayan_proxy.UpstreamHealthChecker(balancer).start()
+        deadline = time.monotonic() + 5
+        while balancer.backends[1].healthy and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual([backend.healthy for backend in balancer.backends], [True, False])
+
+
+class EncodingNegotiationTests(unittest.TestCase):
+    def negotiate(self, accept_encoding, brotli=False):
+        with mock.patch.object(mayan_proxy, "brotli", object() if brotli else None):
+            return mayan_proxy._negotiate_encoding(accept_encoding)
+
+    def test_q_values(self):
+        cases = [
+            (None, None),
+            ("", None),
+            ("gzip", "gzip"),
+            ("deflate", None),
+            ("gzip;q=0", None),
+            ("gzip;q=0.0, *", None),
+            ("*", "gzip"),
+            ("*;q=0", None),
+            ("GZIP; Q=0.5", "gzip"),
+            ("gzip;level=1;q=0", None),
+            ("gzip;q=bogus", None),
+        ]
+        for accept_encoding, expected in cases:
+            with self.subTest(accept_encoding=accept_encoding):
+                self.assertEqual(self.negotiate(accept_encoding), expected)
+
+    def test_brotli_is_preferred_when_installed(self):
+        self.assertEqual(self.negotiate("gzip, br", brotli=True), "br")
+        self.assertEqual(self.negotiate("gzip, br;q=0.5", brotli=True), "gzip")
+        self.assertEqual(self.negotiate("br;q=0, *", brotli=True), "gzip")
+        self.assertEqual(self.negotiate("gzip, br"), "gzip")
+
+    def test_identity(self):
+        self.assertIsNone(self.negotiate("identity"))
+        self.assertIsNone(self.negotiate("identity, gzip;q=0.5"))
+        self.assertEqual(self.negotiate("identity;q=0.5, gzip"), "gzip")
+        self.assertEqual(self.negotiate("identity;q=0, gzip"), "gzip")
+        # A tie goes to compression
+        self.assertEqual(self.negotiate("identity, gzip"), "gzip")
+
+
+class CompressionProxyTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.object(mayan_proxy, "COMPRESS_MIN_SIZE", 0)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_enriched_page_follows_the_client_q_values(self):
+        response, body = self.get("/api/v4/events/", {"Accept-Encoding": "gzip"})
+        self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+        self.assertIn("Accept-Encoding", response.getheader("Vary"))
+        self.assertEqual(json.loads(gzip.decompress(body))["count"], 1)
+        # The cached page is sent plain to a client refusing gzip
+        response, body = self.get("/api/v4/events/", {"Accept-Encoding": "gzip;q=0, identity"})
+        self.assertEqual(response.getheader("X-Mayan-Cache"), "HIT")
+        self.assertIsNone(response.getheader("Content-Encoding"))
+        self.assertEqual(json.loads(body)["count"], 1)
+
+
+class ChunkedUploadTests(unittest.TestCase):
+    def spool(self, raw):
+        return mayan_proxy._spool_chunked_body(io.BytesIO(raw))
+
+    def test_chunks_are_decoded_with_extensions_and_trailers(self):
+        body = self.spool(b"5;name=value\r\nhello\r\n1\r\n \r\n5\r\nworld\r\n0\r\nX-Trailer: yes\r\n\r\nNEXT")
+        self.assertEqual(len(body), 11)
+        self.assertEqual(body.read(), b"hello world")
+        body.close()
+
+    def test_large_uploads_spill_to_disk(self):
+        with mock.patch.object(mayan_proxy, "UPLOAD_SPOOL_MAX_MEMORY", 16):
+            body = self.spool(b"20\r\n" + b"x" * 32 + b"\r\n0\r\n\r\n")
+        self.assertTrue(body.source._rolled)
+        self.assertEqual((len(body), body.read()), (32, b"x" * 32))
+        # Spooled bodies can be replayed to another replica
+        body.seek(0)
+        self.assertEqual(body.read(), b"x" * 32)
+        body.close()
+
+    def test_malformed_framing_is_rejected(self):
+        for raw in (b"zz\r\nhello\r\n0\r\n\r\n", b"-5\r\nhello\r\n0\r\n\r\n", b"5\r\nhelloXX0\r\n\r\n"):
+            with self.assertRaises(ValueError):
+                self.spool(raw)
+        with self.assertRaises(ConnectionError):
+            self.spool(b"a\r\nhello")
+
+
+class UploadProxyTests(ProxyTestCase):
+    def send_raw(self, request):
+        with socket.create_connection(("127.0.0.1", self.port), timeout=10) as sock:
+            sock.sendall(request)
+            response = http.client.HTTPResponse(sock)
+            response.begin()
+            return response, response.read()
+
+    def test_chunked_upload_reaches_mayan_with_a_content_length(self):
+        response, body = self.send_raw(
+            b"POST /api/v4/documents/upload/ HTTP/1.1\r\nHost: proxy\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"4\r\nabcd\r\n3\r\nefg\r\n0\r\n\r\n"
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(body), {"content_length": "7", "transfer_encoding": None, "body": "abcdefg"})
+
+    def test_malformed_chunk_framing_gets_400(self):
+        response, _ = self.send_raw(
+            b"POST /api/v4/documents/upload/ HTTP/1.1\r\nHost: proxy\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"xyz\r\nabcd\r\n0\r\n\r\n"
+        )
+        self.assertEqual(response.status, 400)
+        self.assertEqual(StubMayanHandler.requests_seen, 0)
+
+    def test_sized_upload_is_streamed_through(self):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        self.addCleanup(connection.close)
+        connection.request("POST", "/api/v4/documents/upload/", body=b"y" * 200000)
+        response = connection.getresponse()
+        echoed = json.loads(response.read())
+        self.assertEqual((response.status, echoed["content_length"], len(echoed["body"])), (200, "200000", 200000))
+
+
+def read_response(f):
+    """One response from a buffered socket file: (status, headers, body); needs a Content-Length."""
+    status = int(f.readline().split()[1])
+    headers = {}
+    for line in iter(f.readline, b"\r\n"):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, headers, f.read(int(headers["content-length"]))
+
+
+class KeepAliveTests(ProxyTestCase):
+    """Client keep-alive on the threaded engine, with a single worker."""
+
+    workers = 1
+
+    def connect(self):
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        self.addCleanup(sock.close)
+        return sock, sock.makefile("rb")
+
+    def request(self, path, headers=""):
+        return ("GET %s HTTP/1.1\r\nHost: proxy\r\n%s\r\n" % (path, headers)).encode()
+
+    def test_requests_reuse_the_connection(self):
+        sock, f = self.connect()
+        for index in range(3):
+            sock.sendall(self.request("/api/v4/documents/?n=%d" % index))
+            status, headers, _ = read_response(f)
+            self.assertEqual((status, headers["x-stub-path"]), (200, "/api/v4/documents/?n=%d" % index))
+            self.assertNotEqual(headers.get("connection"), "close")
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        sock, f = self.connect()
+        sock.sendall(b"".join(self.request("/api/v4/documents/?n=%d" % index) for index in range(4)))
+        paths = [read_response(f)[1]["x-stub-path"] for _ in range(4)]
+        self.assertEqual(paths, ["/api/v4/documents/?n=%d" % index for index in range(4)])
+
+    def test_idle_connection_does_not_hold_the_worker(self):
+        idle, idle_file = self.connect()
+        idle.sendall(self.request("/api/v4/documents/"))
+        self.assertEqual(read_response(idle_file)[0], 200)
+        # The only worker is free for another client while the first one sits idle
+        started = time.monotonic()
+        sock, f = self.connect()
+        sock.sendall(self.request("/api/v4/documents/"))
+        self.assertEqual(read_response(f)[0], 200)
+        self.assertLess(time.monotonic() - started, 2)
+        # ... and the idle connection still works
+        idle.sendall(self.request("/api/v4/documents/"))
+        self.assertEqual(read_response(idle_file)[0], 200)
+
+    def test_connection_close_is_honoured(self):
+        sock, f = self.connect()
+        sock.sendall(self.request("/api/v4/documents/", "Connection: close\r\n"))
+        self.assertEqual(read_response(f)[0], 200)
+        self.assertEqual(f.read(), b"")
+
+
+class AsyncioKeepAliveTests(KeepAliveTests):
+    """The same keep-alive behaviour on the asyncio engine."""
+
+    engine = mayan_proxy.AsyncioHTTPServer
+
+
+class UpstreamPoolTests(ProxyTestCase):
+    def test_connections_mayan_closed_are_not_reused(self):
+        for _ in range(5):
+            response, _ = self.get("/api/v4/documents/?hangup")
+            self.assertEqual(response.status, 200)
+            time.sleep(0.05)
+        # Each request reached Mayan once: no failed attempt on a dead connection was retried
+        self.assertEqual(StubMayanHandler.requests_seen, 5)
+
+
+class AdmissionGateTests(unittest.TestCase):
+    def test_full_queue_is_rejected_and_slots_pass_to_waiters_in_order(self):
+        gate = mayan_proxy.AdmissionGate("test", limit=1, queue_size=3, timeout=5)
+        gate.acquire()
+        admitted = []
+
+        def wait(name):
+            gate.acquire()
+            admitted.append(name)
+
+        threads = []
+        for name in ("first", "second", "third"):
+            thread = threading.Thread(target=wait, args=(name,))
+            thread.start()
+            threads.append(thread)
+            # Queue the waiters in a known order
+            while gate.stats()["waiting"] < len(threads):
+                time.sleep(0.005)
+        with self.assertRaises(mayan_proxy.AdmissionRejected) as rejected:
+            gate.acquire()
+        self.assertEqual(rejected.exception.reason, "queue_full")
+        for thread in threads:
+            gate.release()
+            thread.join(5)
+        self.assertEqual(admitted, ["first", "second", "third"])
+        self.assertEqual(gate.stats()["active"], 1)
+        gate.release()
+        self.assertEqual((gate.stats()["active"], gate.stats()["rejected"]), (0, 1))
+
+    def test_wait_times_out(self):
+        gate = mayan_proxy.AdmissionGate("test", limit=1, queue_size=1, timeout=0.05)
+        gate.acquire()
+        with self.assertRaises(mayan_proxy.AdmissionRejected) as rejected:
+            gate.acquire()
+        self.assertEqual(rejected.exception.reason, "timeout")
+        self.assertEqual(gate.stats()["waiting"], 0)
+
+
+class AdmissionProxyTests(ProxyTestCase):
+    def test_request_beyond_the_queue_gets_503_with_retry_after(self):
+        gate = mayan_proxy.AdmissionGate("other", limit=1, queue_size=0)
+        with mock.patch.dict(mayan_proxy._admission_gates, {"other": gate}):
+            with ThreadPoolExecutor(1) as pool:
+                slow = pool.submit(self.get, "/api/v4/documents/?slow")
+                while gate.stats()["active"] == 0:
+                    time.sleep(0.005)
+                response, body = self.get("/api/v4/documents/")
+                self.assertEqual(slow.result()[0].status, 200)
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.getheader("Retry-After"), str(mayan_proxy.ADMIT_RETRY_AFTER))
+        self.assertIn("detail", json.loads(body))
+        self.assertEqual(StubMayanHandler.requests_seen, 1)
+
+
+class AdmissionDefaultTests(ProxyTestCase):
+    def test_admission_control_is_off_unless_configured(self):
+        self.assertEqual({gate.limit for gate in mayan_proxy._admission_gates.values()}, {0})
+        with ThreadPoolExecutor(12) as pool:
+            results = list(pool.map(lambda page: self.get("/api/v4/documents/1/pages/%d/image/?slow" % page), range(12)))
+        self.assertEqual([response.status for response, _ in results], [200] * 12)
+
+
+class AdminEndpointTests(ProxyTestCase):
+    def test_stats_and_metrics_need_an_allowed_address_or_the_token(self):
+        for path in ("/__proxy/stats", "/__proxy/metrics"):
+            response, _ = self.get(path)
+            self.assertEqual(response.status, 200)
+            with mock.patch.object(mayan_proxy, "PROXY_ADMIN_ALLOW", []), \
+                    mock.patch.object(mayan_proxy, "PROXY_ADMIN_TOKEN", "s3cret"):
+                response, body = self.get(path)
+                self.assertEqual(response.status, 403)
+                self.assertNotIn(b"127.0.0.1", body)
+                response, _ = self.get(path, {"X-Proxy-Admin-Token": "wrong"})
+                self.assertEqual(response.status, 403)
+                response, _ = self.get(path, {"X-Proxy-Admin-Token": "s3cret"})
+                self.assertEqual(response.status, 200)
+
+
+class DownloadFillTests(ProxyTestCase):
+    DOWNLOAD = "/api/v4/documents/1/files/2/download/"
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = mayan_proxy.DownloadCache(tmp.name, max_bytes=10 ** 6)
+        patch = mock.patch.object(mayan_proxy, "_download_cache", self.cache)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_download_is_stored_and_served_from_disk(self):
+        response, body = self.get(self.DOWNLOAD)
+        self.assertEqual((response.status, response.getheader("X-Mayan-Cache"), len(body)), (200, "MISS", 1000))
+        response, body = self.get(self.DOWNLOAD, {"Range": "bytes=0-9"})
+        self.assertEqual((response.status, response.getheader("X-Mayan-Cache"), body), (206, "HIT", b"d" * 10))
+
+    def test_malformed_length_is_passed_through_uncached(self):
+        response, body = self.get(self.DOWNLOAD + "?badlength")
+        self.assertEqual((response.status, len(body)), (200, 1000))
+        self.assertIsNone(response.getheader("X-Mayan-Cache"))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_truncated_body_is_never_served_as_complete(self):
+        response, _ = self.get(self.DOWNLOAD + "?truncated", {"Range": "bytes=0-"})
+        self.assertEqual(response.status, 502)
+        with self.assertRaises(http.client.IncompleteRead):
+            self.get(self.DOWNLOAD + "?truncated")
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+
+class ProfilingTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        for patch in (
+            mock.patch.object(mayan_proxy, "_profiler", mayan_proxy.RequestProfiler(every=1, directory=tmp.name)),
+            mock.patch.object(mayan_proxy, "PROXY_ADMIN_TOKEN", "admin-secret"),
+            mock.patch.object(mayan_proxy, "PROXY_ADMIN_ALLOW", []),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_profiled_requests_carry_the_upstream_token_only(self):
+        with mock.patch.object(mayan_proxy, "PROFILE_UPSTREAM_TOKEN", "upstream-secret"):
+            response, _ = self.get("/api/v4/events/", {"X-Mayan-Profile": "forged"})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(StubMayanHandler.last_headers.get_all("X-Mayan-Profile"), ["upstream-secret"])
+        # Written once the response is out
+        deadline = time.monotonic() + 5
+        while not os.listdir(self.directory) and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_one_admin_token_guards_profiling_and_statistics(self):
+        for headers, status in (({}, 403), ({"X-Proxy-Admin-Token": "wrong"}, 403), ({"X-Proxy-Admin-Token": "admin-secret"}, 200)):
+            response, _ = self.get("/__proxy/profile?every=0", headers, method="POST")
+            self.assertEqual(response.status, status)
+            response, _ = self.get("/__proxy/stats", headers)
+            self.assertEqual(response.status, status)
+        self.assertEqual(mayan_proxy._profiler.every, 0)
+
+    def test_no_upstream_token_is_sent_by_default(self):
+        response, _ = self.get("/api/v4/events/", {"X-Mayan-Profile": "forged"})
+        self.assertEqual(response.status, 200)
+        self.assertIsNone(StubMayanHandler.last_headers.get("X-Mayan-Profile"))
+
+
+class DownloadCacheTests(unittest.TestCase):
+    """Two DownloadCache instances on one directory stand in for two prefork workers."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def store(self, cache, key, size):
+        with cache.new_body_file() as f:
+            f.write(b"x" * size)
+        return cache.store(key, f.name, size, '"%s"' % key, None, [])
+
+    def files(self, suffix):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(suffix))
+
+    def test_cap_holds_across_processes(self):
+        first = mayan_proxy.DownloadCache(self.directory, max_bytes=1000)
+        second = mayan_proxy.DownloadCache(self.directory, max_bytes=1000)
+        for index in range(3):
+            self.store(first, "/a%d" % index, 300)
+            self.store(second, "/b%d" % index, 300)
+        on_disk = sum(os.path.getsize(os.path.join(self.directory, name)) for name in self.files(".body"))
+        self.assertLessEqual(on_disk, 1000)
+        self.assertEqual(first.stats()["bytes"], on_disk)
+        self.assertEqual(len(self.files(".body")), len(self.files(".json")))
+        # Each process sees the other's entries
+        self.assertIsNotNone(first.get("/b2"))
+
+    def test_replacing_a_key_from_another_process_removes_the_old_body(self):
+        first = mayan_proxy.DownloadCache(self.directory, max_bytes=10000)
+        second = mayan_proxy.DownloadCache(self.directory, max_bytes=10000)
+        old = self.store(first, "/doc", 100)
+        new = self.store(second, "/doc", 200)
+        self.assertEqual(self.files(".body"), [os.path.basename(new.path)])
+        self.assertEqual(first.get("/doc").size, 200)
+        self.assertFalse(os.path.exists(old.path))
+
+    def test_orphans_are_removed_at_startup(self):
+        cache = mayan_proxy.DownloadCache(self.directory, max_bytes=10000)
+        entry = self.store(cache, "/doc", 100)
+        with open(os.path.join(self.directory, "0" * 40 + "-orphan.body"), "wb") as f:
+            f.write(b"y")
+        with open(os.path.join(self.directory, "1" * 40 + ".json"), "w") as f:
+            f.write("{}")
+        mayan_proxy.DownloadCache(self.directory, max_bytes=10000)
+        self.assertEqual(self.files(".body"), [os.path.basename(entry.path)])
+        self.assertEqual(len(self.files(".json")), 1)
+
+
+class LookupDB:
+    """Stands in for mayan_proxy's DBPool, answering the prepared lookups from `tables` and logging each query."""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.queries = []
+
+    def execute(self, name, params):
+        self.queries.append((name, list(params[0])))
+        rows = self.tables.get(name, {})
+        return [(key, rows[key]) for key in params[0] if key in rows]
+
+    def stats(self):
+        return {"queries": len(self.queries)}
+
+
+def trashed_event(event_id, model, object_id):
+    return {
+        "id": event_id,
+        "verb": {"id": "documents.trashed_document_deleted", "name": "trashed_document_deleted"},
+        "target_content_type": {"model": model},
+        "target_object_id": str(object_id),
+        "target": None,
+    }
+
+
+class TrashedDocumentEnrichmentTests(unittest.TestCase):
+    def setUp(self):
+        self.db = LookupDB({
+            "mp_event_document_ids": {10: 100, 11: 101},
+            "mp_document_type_ids": {200: 5},
+            "mp_trashed_document_type_ids": {201: 6},
+            "mp_document_type_labels": {5: "Invoice", 6: "Letter"},
+        })
+        patch = mock.patch.object(mayan_proxy, "_db_pool", self.db)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def fix(self, page):
+        plan = mayan_proxy._enrichers.plan_for(mayan_proxy.EVENTS_API_PATH)
+        return mayan_proxy._fix_events_data(page, "http://proxy", plan)
+
+    def test_page_is_resolved_with_one_query_per_table(self):
+        page = {"results": [
+            trashed_event(10, "documenttype", 5),
+            trashed_event(11, "documenttype", 5),
+            trashed_event(12, "documenttype", 6),
+            trashed_event(13, "document", 200),
+            trashed_event(14, "document", 201),
+            {"id": 15, "verb": {"id": "documents.document_create"}, "target": {"id": 1}},
+        ]}
+        self.assertTrue(self.fix(page))
+        targets = [event["target"] for event in page["results"]]
+        self.assertEqual(targets[0], {"id": 100, "document_id": 100, "document_type": {"id": 5, "label": "Invoice"}})
+        self.assertEqual(targets[1], {"id": 101, "document_id": 101, "document_type": {"id": 5, "label": "Invoice"}})
+        # No deletion record: the document is unknown, the type still labelled
+        self.assertEqual(targets[2], {"id": 6, "document_id": None, "document_type": {"id": 6, "label": "Letter"}})
+        self.assertEqual(targets[3], {"id": 200, "document_id": 200, "document_type": {"id": 5, "label": "Invoice"}})
+        self.assertEqual(targets[4], {"id": 201, "document_id": 201, "document_type": {"id": 6, "label": "Letter"}})
+        self.assertEqual(targets[5], {"id": 1})
+        # Each distinct id is asked for once, in one = ANY($1) query per lookup
+        self.assertEqual(sorted(self.db.queries), [
+            ("mp_document_type_ids", [200, 201]),
+            ("mp_document_type_labels", [5, 6]),
+            ("mp_event_document_ids", [10, 11, 12]),
+            ("mp_trashed_document_type_ids", [201]),
+        ])
+
+    def test_query_count_does_not_grow_with_the_page(self):
+        page = {"results": [trashed_event(event_id, "documenttype", 5) for event_id in range(1000, 1200)]}
+        self.fix(page)
+        self.assertEqual([name for name, _ in self.db.queries], ["mp_event_document_ids", "mp_document_type_labels"])
+        for argument_types, sql in mayan_proxy.DB_PREPARED_STATEMENTS.values():
+            self.assertEqual(argument_types, "bigint[]")
+            self.assertIn("= ANY($1)", sql)
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def test_opens_after_threshold_and_closes_on_a_successful_probe(self):
+        breaker = mayan_proxy.CircuitBreaker("test", threshold=2, cooldown=0.1)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.15)
+        # One probe per cooldown
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.trips, 1)
+
+    def test_failed_probe_keeps_it_open(self):
+        breaker = mayan_proxy.CircuitBreaker("test", threshold=1, cooldown=0.1)
+        breaker.record_failure()
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+    def test_db_pool_suspends_a_failing_lookup(self):
+        import psycopg2
+        pool = mayan_proxy.DBPool(maxconn=1)
+        with mock.patch.object(pool, "_execute", side_effect=psycopg2.OperationalError("down")) as execute:
+            for _ in range(mayan_proxy.DB_BREAKER_THRESHOLD):
+                with self.assertRaises(psycopg2.OperationalError):
+                    pool.execute("mp_document_type_labels", ([1],))
+            with self.assertRaises(mayan_proxy.DBUnavailable):
+                pool.execute("mp_document_type_labels", ([1],))
+            self.assertEqual(execute.call_count, mayan_proxy.DB_BREAKER_THRESHOLD)
+            # Other lookups are not suspended with it
+            with self.assertRaises(psycopg2.OperationalError):
+                pool.execute("mp_event_document_ids", ([1],))
+
+
+class EnrichmentBudgetTests(unittest.TestCase):
+    def test_statement_timeout_shrinks_to_the_budget_then_the_deadline_is_enforced(self):
+        budget = mayan_proxy.EnrichmentBudget(0.05)
+        timeout = mayan_proxy.DBPool._statement_timeout(budget)
+        self.assertLessEqual(timeout, 50)
+        time.sleep(0.06)
+        with self.assertRaises(mayan_proxy.EnrichmentDeadlineExceeded):
+            mayan_proxy.DBPool._statement_timeout(budget)
+
+    def test_no_deadline_leaves_the_configured_statement_timeout(self):
+        budget = mayan_proxy.EnrichmentBudget(0)
+        self.assertEqual(mayan_proxy.DBPool._statement_timeout(budget), mayan_proxy.DB_STATEMENT_TIMEOUT_MS or None)
+
+
+class FailingLookupDB:
+    def __init__(self, error):
+        self.error = error
+
+    def execute(self, name, params):
+        raise self.error
+
+    def stats(self):
+        return {}
+
+
+class DegradedEnrichmentTests(ProxyTestCase):
+    def get_trashed_page(self, error):
+        with mock.patch.object(mayan_proxy, "_db_pool", FailingLookupDB(error)):
+            return self.get("/api/v4/events/?trashed", {"Accept": "application/json"})
+
+    def test_page_is_served_unenriched_with_the_reason(self):
+        for error, reason in (
+            (mayan_proxy.DBUnavailable("open"), "circuit-open"),
+            (mayan_proxy.EnrichmentDeadlineExceeded("late"), "deadline"),
+        ):
+            response, body = self.get_trashed_page(error)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.getheader("X-Mayan-Degraded"), reason)
+            # The lookup did not run, so the document is not claimed to be unknown
+            self.assertNotIn("document_id", json.loads(body)["results"][0]["target"])
+
+    def test_degraded_pages_are_not_cached(self):
+        self.get_trashed_page(mayan_proxy.DBUnavailable("open"))
+        response, _ = self.get_trashed_page(mayan_proxy.DBUnavailable("open"))
+        self.assertIsNone(response.getheader("X-Mayan-Cache"))
+        self.assertEqual(StubMayanHandler.requests_seen, 2)
+
+
+class EventFeedTests(unittest.TestCase):
+    """Polls are simulated by publishing to a feed whose thread is never started."""
+
+    def setUp(self):
+        self.feeds = mayan_proxy.EventFeeds()
+        self.feed = mayan_proxy.EventFeed(self.feeds, "key", {}, "http://proxy")
+
+    def publish(self, *event_ids):
+        self.feed._publish([(event_id, {"id": event_id}) for event_id in event_ids], baseline=self.feed.last_id is None)
+
+    def ids(self, subscriber):
+        return [event_id for event_id, _ in self.feed.next_events(subscriber, 0.01)]
+
+    def test_new_subscribers_get_only_later_events(self):
+        self.publish(1, 2, 3)
+        subscriber = self.feed.subscribe()
+        self.publish(4, 5)
+        self.assertEqual(self.ids(subscriber), [4, 5])
+
+    def test_resume_after_an_event_from_the_history(self):
+        self.publish(1, 2, 3, 4, 5)
+        subscriber = self.feed.subscribe(after=3)
+        self.publish(6)
+        self.assertEqual(self.ids(subscriber), [4, 5, 6])
+        self.assertEqual(self.ids(subscriber), [])
+
+    def test_subscriber_too_far_behind_is_dropped_and_resumes(self):
+        self.publish(1)
+        subscriber = self.feed.subscribe()
+        with mock.patch.object(mayan_proxy, "FEED_SUBSCRIBER_BUFFER", 3):
+            self.publish(2, 3, 4, 5, 6)
+        self.assertTrue(subscriber.dropped)
+        self.assertNotIn(subscriber, self.feed.subscribers)
+        self.assertEqual(self.feeds.stats()["dropped"], 1)
+        # What fit is still handed over, without waiting
+        started = time.monotonic()
+        self.assertEqual([event_id for event_id, _ in self.feed.next_events(subscriber, 5)], [2, 3, 4])
+        self.assertLess(time.monotonic() - started, 1)
+        resumed = self.feed.subscribe(after=4)
+        self.assertEqual(self.ids(resumed), [5, 6])
+
+
+class EventFeedProxyTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        for patch in (
+            mock.patch.object(mayan_proxy, "_event_feeds", mayan_proxy.EventFeeds()),
+            mock.patch.object(mayan_proxy, "FEED_POLL_INTERVAL", 0.05),
+            # Feed threads stop polling as soon as their last subscriber leaves
+            mock.patch.object(mayan_proxy, "FEED_IDLE_TIMEOUT", 0),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_long_poll_resumes_after_the_given_id(self):
+        response, body = self.get("/__proxy/events/feed?after=0&timeout=5")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(body), {"last_id": 1, "events": [{"id": 1}]})
+        started = time.monotonic()
+        response, body = self.get("/__proxy/events/feed?after=1&timeout=0.2")
+        self.assertEqual(json.loads(body), {"last_id": 1, "events": []})
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_malformed_after_gets_400(self):
+        response, _ = self.get("/__proxy/events/feed?after=latest")
+        self.assertEqual(response.status, 400)
+
+
+class StreamingRewriteTests(unittest.TestCase):
+    def setUp(self):
+        self.db = LookupDB({"mp_event_document_ids": {10: 100}, "mp_document_type_labels": {5: "Invoice"}})
+        patch = mock.patch.object(mayan_proxy, "_db_pool", self.db)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.plan = mayan_proxy._enrichers.plan_for(mayan_proxy.EVENTS_API_PATH)
+
+    def page(self):
+        results = [
+            {"id": event_id, "verb": {"id": "documents.document_edited"}, "number": 12345678,
+             "url": "http://mayan-app:8000/api/v4/events/%d/" % event_id}
+            for event_id in range(1, 6)
+        ]
+        results.insert(2, trashed_event(10, "documenttype", 5))
+        return {"count": 6, "next": "http://mayan-app:8000/api/v4/events/?page=2", "results": results, "previous": None}
+
+    def test_elements_split_across_chunks_match_the_buffered_rewrite(self):
+        text = json.dumps(self.page())
+        rewriter = mayan_proxy.StreamingEventsRewriter("http://proxy", self.plan, batch_size=2)
+        pieces = []
+        for start in range(0, len(text), 7):
+            pieces += rewriter.feed(text[start:start + 7])
+            if start < len(text) // 2:
+                sent_early = len(pieces)
+        pieces += rewriter.close()
+        self.assertGreater(sent_early, 0)
+        expected = self.page()
+        mayan_proxy._fix_events_data(expected, "http://proxy", self.plan)
+        self.assertEqual(json.loads("".join(pieces)), expected)
+        self.assertTrue(rewriter.changed)
+        self.assertEqual(expected["results"][2]["target"]["document_id"], 100)
+        self.assertNotIn("mayan-app", "".join(pieces))
+
+    def test_bodies_that_are_not_a_page_are_not_streamable(self):
+        for text in ('[{"id": 1}]', '{"data": [1], "results": []}'):
+            rewriter = mayan_proxy.StreamingEventsRewriter("http://proxy", self.plan)
+            with self.assertRaises(mayan_proxy.NotStreamable):
+                rewriter.feed(text, final=True)
+            self.assertEqual(rewriter.buffered(), text)
+
+
+class StreamingProxyTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        # Pages to be cached or shared are buffered whole, so both are off here
+        for patch in (
+            mock.patch.object(mayan_proxy, "STREAM_REWRITE", True),
+            mock.patch.object(mayan_proxy, "COALESCE_REQUESTS", False),
+            mock.patch.object(mayan_proxy._cache_listener, "live", False),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_page_is_streamed(self):
+        response, body = self.get("/api/v4/events/", {"Accept": "application/json"})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("X-Mayan-Fix"), "Streamed")
+        self.assertEqual(json.loads(body)["results"], [{"id": 1}])
+
+    def test_not_streamable_body_is_buffered(self):
+        response, body = self.get("/api/v4/events/?bare", {"Accept": "application/json"})
+        self.assertEqual(response.status, 200)
+        self.assertNotEqual(response.getheader("X-Mayan-Fix"), "Streamed")
+        self.assertEqual(json.loads(body)[0]["id"], 1)
+        self.assertNotIn(b"mayan-app", body)
+
+
+class TrafficRecorderTests(unittest.TestCase):
+    """The recorder is never started, so every exchange stays queued."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.recorder = mayan_proxy.TrafficRecorder(tmp.name, queue_size=100, queue_bytes=1000)
+
+    def exchange(self, size):
+        exchange = mayan_proxy.RecordedExchange(0.0, "GET", "/api/v4/events/", [], "events")
+        exchange.add(b"x" * size, complete=True)
+        return exchange
+
+    def test_queue_is_bounded_by_body_bytes(self):
+        for _ in range(3):
+            self.recorder.record(self.exchange(400), 200, 0.01, 0)
+        stats = self.recorder.stats()
+        self.assertEqual((stats["queued"], stats["queued_bytes"], stats["dropped"]), (2, 800, 1))
+        # Exchanges without a kept body still fit
+        self.recorder.record(self.exchange(0), 200, 0.01, 0)
+        self.assertEqual(self.recorder.stats()["queued"], 3)
+
+
+class RouteClassTests(unittest.TestCase):
+    def test_events_are_the_enriched_routes(self):
+        for path in ("/api/v4/events/", "/api/v4/events/?page=2"):
+            self.assertEqual(mayan_proxy._route_class(path), "events")
+            self.assertIsNotNone(mayan_proxy._enrichers.plan_for(path))
+        # Not enriched, so neither counted nor admitted as events
+        self.assertEqual(mayan_proxy._route_class("/foo/api/v4/events/"), "other")
+        self.assertIsNone(mayan_proxy._enrichers.plan_for("/foo/api/v4/events/"))
+        self.assertEqual(mayan_proxy._route_class("/api/v4/documents/1/files/2/download/"), "download")
+
+
+class JsonCodecTests(unittest.TestCase):
+    # Each on its own: either one alone makes orjson hand the whole page to the json module
+    BIG_INTEGERS = b'{"count":1,"results":[{"id":18446744073709551616,"min":-9223372036854775809,"max":18446744073709551615,"ratio":1.5}]}'
+    NON_FINITE = b'{"count":1,"results":[{"id":2,"nan":NaN,"inf":Infinity,"ninf":-Infinity,"label":"caf\xc3\xa9"}]}'
+
+    def codecs(self):
+        codecs = [mayan_proxy.StdlibJsonCodec()]
+        if mayan_proxy.orjson is not None:
+            codecs.append(mayan_proxy.OrjsonCodec())
+        return codecs
+
+    def test_round_trip_keeps_integers_beyond_64_bits(self):
+        for codec in self.codecs():
+            with self.subTest(codec=codec.name):
+                data = codec.loads(self.BIG_INTEGERS)
+                self.assertEqual(data["results"][0]["id"], 18446744073709551616)
+                self.assertEqual(data["results"][0]["min"], -9223372036854775809)
+                self.assertEqual(codec.dumps(data), self.BIG_INTEGERS)
+
+    def test_round_trip_keeps_nan_and_infinity(self):
+        for codec in self.codecs():
+            with self.subTest(codec=codec.name):
+                self.assertEqual(codec.dumps(codec.loads(self.NON_FINITE)), self.NON_FINITE)
+
+    def test_codecs_agree_on_a_page_with_nothing_unusual(self):
+        page = b'{"count":1,"next":null,"results":[{"id":1,"url":"http://mayan-app:8000/api/v4/events/1/"}]}'
+        self.assertEqual({codec.dumps(codec.loads(page)) for codec in self.codecs()}, {page})
+
+
+class BackgroundLoggingTests(unittest.TestCase):
+    def test_full_queue_drops_info_but_writes_warnings(self):
+        written = []
+        capture = logging.Handler()
+        capture.emit = written.append
+        handler = mayan_proxy._DroppingQueueHandler(queue.Queue(1))
+        handler.handle(logging.makeLogRecord({"msg": "queued", "levelno": logging.INFO}))
+        dropped = mayan_proxy._DroppingQueueHandler.dropped
+        with mock.patch.object(mayan_proxy, "_log_handlers", [capture]):
+            handler.handle(logging.makeLogRecord({"msg": "routine", "levelno": logging.INFO}))
+            handler.handle(logging.makeLogRecord({"msg": "slow request", "levelno": logging.WARNING}))
+        self.assertEqual(mayan_proxy._DroppingQueueHandler.dropped, dropped + 1)
+        self.assertEqual([record.getMessage() for record in written], ["slow request"])
+
+
+if __name__ == "__main__":
+    unittest.main()